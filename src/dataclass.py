@@ -88,6 +88,14 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         self.current_step = 0
         self.tpu_size = 32
         self.default_sleep_duration = 0.1
+        self.inference_batch_size = 1  # prompts sampled together in one call when not training
+        self.inference_batch_timeout = 0.05  # seconds to wait for more prompts before sampling a partial batch
+        self.interface_slots = 64  # requests that can wait for or run on the TPU at the same time
+        self.stream_block_size = 8  # tokens sampled per TPU call for streamed requests
+        self.prefix_cache_bytes = 0  # host memory for decode states of earlier prompts to resume from, 0 disables it
+        self.prefix_cache_max_replay = 64  # prompt tokens sampling may step through after resuming instead of prefill
+        self.prefix_cache_report_every = 100  # prompts between two prints of the prefix cache statistics
+        self.peak_flops_per_core = 61.5e12  # bfloat16 peak of one TPU v3 core, used for model FLOPs utilization
         self.lookahead_steps = 0
         self.lookahead_alpha = 0
         self.momentum = 0.95
@@ -123,25 +131,45 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         self.iterations = 2500
         self.initial_autoregressive_position = 128
         self.use_autoregressive_sampling = False
+        self.use_decode_cache = True  # sample with cached attention keys and values if all layers support it
         self.sampling_temperature = 0
+        self.sampling_top_k = 0  # sample only from the k most likely tokens, 0 samples from all of them
+        self.sampling_top_p = 1.  # sample only from the most likely tokens that together have at least this probability
+        self.draft_model = ""  # session config of a smaller gpt model that proposes tokens for speculative sampling
+        self.draft_tokens = 4  # tokens the draft model proposes per forward pass of the model
+        self.stop_tokens = []  # token ids that end a sample early, in addition to padding_token
         self.weight_centralisation = True
         self.shuffle_input_filenames = True
         self.calc_accuracy = False
         self.num_of_sample = 10
+        self.render_workers = 4  # processes that render video samples in the background
+        self.render_queue_size = 8  # video samples that may wait for rendering before sampling waits as well
         self.web_workers = 1
+        self.web_max_concurrent_requests = 64  # requests one web worker handles at once, more get HTTP 429
+        self.web_tokenizer_threads = 4  # threads per web worker that run the tokenizer
         self.equal_debugging_items_per_check = 16
         self.group_linear_factor = 2
         self.embedding_stddev = 0.04
         self.color_quantization_value = 256
         self.experts = 64
+        self.expert_top_k = 2  # experts mixture_of_experts routes every token to
+        self.expert_group_size = 1024  # tokens of a sample that compete for the capacity of the experts together
+        self.expert_capacity_factor = 1.25  # tokens per expert and group, relative to an even split of all choices
+        self.expert_balance_loss = 1e-2  # weight of the auxiliary loss that keeps the experts evenly used
         self.pkm_axes = 2  # 2 axis = features^2 keys, 3 axis = features^3 keys...
+        self.pkm_top_k = 32  # values every query of product_key_memory reads, also the sub-keys kept per axis
         self.use_bit_fold_input_pipeline = False
         self.bit_fold_value = 4
+        self.compress_infeed = False  # Enqueue tokens and frames as uint8/uint16 and widen them on device
+        self.shift_tokens_on_device = False  # Language-only: infeed one token window, slice token_x/token_y on device
         self.debug_train_step = False
         self.model_mode = 'jannet'
         self.optimizer = 'learning_rate'
+        self.sparse_embedding_updates = True  # lazily update only the gathered rows of embeddings and their states
         self.multi_loss_strategy = "linear"
-        self.memory_reduction_strategy = "revnet"
+        self.memory_reduction_strategy = "revnet"  # revnet, momentum, checkpoint, none or auto (see model/planner.py)
+        self.memory_budget_per_core = 8 * 2 ** 30  # bytes of stored activations the "auto" strategy may use per core
+        self.memory_planner_strategies = ["none", "checkpoint"]
         self.debug_gradients = False
         self.use_initial_position_embedding = False
         self.intermediate_feed_forward_multiplier = None
@@ -149,6 +177,7 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         self.other_color = "\x1b[0m"
         self.scale_by_depth = True
         self.z_loss = 1e-4
+        self.fused_norm = True  # norms run as one operation with a hand-written gradient instead of many small ones
         self.block_config = [{'layer': ["norm-group-shift-scale",
                                         "feed_forward-in_relu-group-in_glu_add-in_norm"]
                               },
@@ -163,6 +192,7 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         self.mesh: typing.Optional[mtf.Mesh] = None
         self.d_assignment: typing.Optional[DeviceAssignment] = None
         self.mesh_impl: typing.Optional[mtf.simd_mesh_impl.SimdMeshImpl] = None
+        self.draft_params: typing.Optional[ModelParameter] = None  # draft_model, loaded by main
         self.num_cores = 0
         self.num_hosts = 0
         self.num_cores_per_host = 0
@@ -213,9 +243,6 @@ class ModelParameter(typing.Dict[str, typing.Any]):
             self.features = self.features_per_head * self.heads
         if self.features_per_head is None:
             self.features_per_head = self.features // self.heads
-        if self.use_video and (self.frame_width * self.frame_height // self.patch_size) % self.experts:
-            raise ValueError("Frame size has to be divisible by number of experts. Set \"experts\" to 1 if you're not "
-                             "using MoE")
         if self.intermediate_feed_forward_multiplier is None:
             self.intermediate_feed_forward_multiplier = self.group_linear_factor / self.heads
         if not self.use_video and self.language_token_per_frame != self.sequence_length:
@@ -234,8 +261,10 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         split_heads = self.heads > 1
         self.mesh_shape = ','.join([f"b:{self.tpu_size // self.heads:.0f}"] * split_batch +
                                    [f"h:{self.heads:.0f}"] * split_heads)
+        split_experts = split_batch and self.experts % (self.tpu_size // self.heads) == 0
         self.layout = ','.join([f"batch:b"] * split_batch +
-                               [f"heads:h"] * split_heads)
+                               [f"heads:h"] * split_heads +
+                               [f"experts:b"] * split_experts)
         self.variable_dtype = mtf.VariableDType(self.storage_dtype, self.slice_dtype, self.calculation_dtype)
         self.optimizer_dtype = mtf.VariableDType(self.storage_dtype, self.optimizer_slice_dtype,
                                                  self.optimizer_calculation_dtype)
@@ -256,7 +285,7 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         if self.use_bit_fold_input_pipeline:
             self.channel_color_size = self.channel_color_size // self.fold_count
 
-        self.product_key_value_vectors = self.features_per_head ** 2
+        self.product_key_value_vectors = self.features_per_head ** self.pkm_axes
         self.product_key_value_dim = mtf.Dimension("product_key_value_dim", self.product_key_value_vectors)
         self.head_dim = mtf.Dimension("heads", self.heads)
         self.head_dimensions = [self.head_dim]
@@ -301,6 +330,10 @@ class ModelParameter(typing.Dict[str, typing.Any]):
                                           self.sequence_dim,
                                           self.token_patch_dim])
         self.frame_mask_shape = mtf.Shape([self.batch_dim, self.sequence_dim])
+        self.shift_tokens_on_device = self.shift_tokens_on_device and self.output_offset > 0 and not self.use_video
+        self.token_input_shape = mtf.Shape([self.batch_dim,
+                                            mtf.Dimension("_sequence", self.sequence_dim.size + self.output_offset),
+                                            self.token_patch_dim])
 
         if self.use_video:
             self.input_pipeline_shape['frame'] = self.frame_input_shape
@@ -312,7 +345,9 @@ class ModelParameter(typing.Dict[str, typing.Any]):
             self.discrete_dim = [mtf.Dimension("discrete", self.channel_color_size * self.color_quantization_value)]
             self.discrete_color_dim = mtf.Dimension("color_quantization", self.color_quantization_value)
 
-        if self.use_language:
+        if self.use_language and self.shift_tokens_on_device:
+            self.input_pipeline_shape['token'] = self.token_input_shape
+        elif self.use_language:
             self.input_pipeline_shape['token_x'] = self.token_dim_shape
             self.input_pipeline_shape['token_y'] = self.token_dim_shape
 
@@ -325,6 +360,9 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         self.attention_idx = 0
         self.variable_cache = {}
         self.cached_parameters = {}
+        self.cached_masks = {}
+        self.decode_state = None  # DecodeState while building the model for incremental decoding
+        self.loss_gradient = None  # gradient the optimizer seeds the loss with, auxiliary losses get the same one
         self.debug_outfeed = {}
 
     def __getitem__(self, key: str) -> typing.Any:
@@ -365,6 +403,8 @@ def align_tensor_op(x):
         tensors.extend([x['vid_msk_src'], x['vid_msk_tgt']])
     if 'token_x' in x:
         tensors.extend([x['token_x'], x['token_y']])
+    if 'token' in x:
+        tensors.append(x['token'])
     if 'txt_msk' in x:
         tensors.append(x['txt_msk'])
     return tensors
@@ -12,6 +12,22 @@ tf = tf2.compat.v1
 Dataset = tf2.data.Dataset
 
 
+def infeed_dtype(params: ModelParameter, value_count: int) -> tf.DType:
+    """
+    Smallest dtype that can hold value_count distinct non-negative values when infeed compression is enabled.
+    :param params: ModelParameter
+    :param value_count: number of distinct values, such as the vocab size
+    :return: dtype the tensor should be enqueued with
+    """
+    if not params.compress_infeed:
+        return tf.int32
+    if value_count <= 2 ** 8:
+        return tf.uint8
+    if value_count <= 2 ** 16:
+        return tf.uint16
+    return tf.int32
+
+
 def split_files(filenames, slice_index, slice_count, seed, runs_log=None):
     if not filenames:
         raise ValueError
@@ -491,7 +507,10 @@ def dataset(params: ModelParameter, sub_batch_size, slice_index, slice_count, _)
     """
 
     def memory_op(x):
-        x['frame'] = tf.cast(x['frame'], tf.int32)
+        x['frame'] = tf.cast(x['frame'], infeed_dtype(params, params.color_quantization_value))
+        for key in ('token_x', 'token_y'):
+            if key in x:
+                x[key] = tf.cast(x[key], infeed_dtype(params, params.vocab_size))
         return x
 
     weights = []
@@ -542,7 +561,9 @@ def gpt_neo_input(params: ModelParameter, sub_batch_size: int, slice_index: int,
 
     def _memory_func(x):
         shp = (sub_batch_size, params.sequence_length // params.token_patch_size + params.output_offset, params.token_patch_size)
-        x = tf.cast(tf.reshape(x, shp), tf.int32)
+        x = tf.cast(tf.reshape(x, shp), infeed_dtype(params, params.vocab_size))
+        if params.shift_tokens_on_device:
+            return {'token': x}
         if params.output_offset > 0:
             vals1 = x[:, :params.sequence_length]
             vals2 = x[:, params.output_offset:params.sequence_length + params.output_offset]
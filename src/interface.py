@@ -1,12 +1,18 @@
+import functools
 import multiprocessing
+import queue
 import random
+import threading
 import time
 import typing
+from concurrent.futures import Future, ProcessPoolExecutor
 
 import numpy as np
 from transformers import GPT2TokenizerFast
 
 from .dataclass import ModelParameter
+from .model.decode import prefix_cached, resumable_before_prefill
+from .prefix_cache import PrefixCache
 from .utils_core import chunks, color_print
 
 
@@ -34,8 +40,7 @@ def render_video(model_output: typing.List[typing.Tuple[np.ndarray, typing.List[
 
             sub_frame = model_output[sub_idx][0][idx]
             sub_frame = sub_frame * (params.color_quantization_value - 1)
-            import scipy.ndimage
-            sub_frame = scipy.ndimage.zoom(sub_frame, (upscale, upscale, 1), order=0)
+            sub_frame = np.repeat(np.repeat(sub_frame, upscale, axis=0), upscale, axis=1)
             sub_frame = np.uint8(sub_frame)
             cv2.cvtColor(sub_frame, cv2.COLOR_RGB2BGR)
 
@@ -58,6 +63,14 @@ def render_video(model_output: typing.List[typing.Tuple[np.ndarray, typing.List[
     writer.release()
 
 
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(vocab_size: int) -> typing.Optional[GPT2TokenizerFast]:
+    """
+    The GPT-2 tokenizer for BPE vocabularies, None for byte-level ones. Loaded once per process.
+    """
+    return GPT2TokenizerFast.from_pretrained('gpt2') if vocab_size > 256 else None
+
+
 def process_token_output(token_out: np.ndarray, padding_token: int = -1, do_argmax: bool = True,
                          bpe_tokenizer: GPT2TokenizerFast = None) -> typing.List[str]:
     _shape = token_out.shape
@@ -67,25 +80,21 @@ def process_token_output(token_out: np.ndarray, padding_token: int = -1, do_argm
         token_out = np.argmax(token_out, axis=2)
     else:
         token_out = np.reshape(token_out, newshape=(_shape[0], _shape[1] * _shape[2]))
+    token_out = token_out.astype(np.int64)
 
-    token_out_str = []
-
-    for token in token_out:
-        if padding_token > -1 and padding_token in token:
-            token = token[:token.tolist().index(padding_token)]
+    # Every row ends before its first padding token.
+    lengths = np.full(token_out.shape[0], token_out.shape[1])
+    if padding_token > -1:
+        padding = token_out == padding_token
+        lengths = np.where(padding.any(1), padding.argmax(1), lengths)
 
-        if bpe_tokenizer is None:
-            token_out_str.append(
-                "".join(
-                    chr(tok) if tok > 31 and tok != 127 and tok != 10 else " "
-                    for tok in token
-                )
-            )
+    if bpe_tokenizer is not None:
+        return bpe_tokenizer.batch_decode([token[:length].tolist() for token, length in zip(token_out, lengths)])
 
-        else:
-            token_out_str.append(bpe_tokenizer.decode([int(tok) for tok in token]))
-
-    return token_out_str
+    # Tokens are code points, control characters become spaces. UTF-32 decodes all rows without a loop per token.
+    printable = (token_out > 31) & (token_out != 127) & (token_out != 10)
+    code_points = np.where(printable, token_out, ord(' ')).astype('<u4')
+    return [token[:length].tobytes().decode('utf-32-le') for token, length in zip(code_points, lengths)]
 
 
 def process_video_output(out_frame: np.ndarray, params: ModelParameter) -> np.ndarray:
@@ -98,8 +107,31 @@ def process_video_output(out_frame: np.ndarray, params: ModelParameter) -> np.nd
     return out_frame
 
 
+_RENDER_PARAMS: typing.Optional[ModelParameter] = None
+
+
+def _set_render_params(params: ModelParameter):
+    global _RENDER_PARAMS
+    _RENDER_PARAMS = params
+
+
+def _render(model_output: typing.List[typing.Tuple[np.ndarray, typing.List[str]]], count: int):
+    render_video(model_output, count, _RENDER_PARAMS)
+
+
 def gen_sample_fn(params: ModelParameter):
     state = {'sample_index': 0}
+    renderer = None
+    if params.model_mode == 'jannet':
+        # Videos are rendered in the background, so that sampling only waits once render_queue_size are pending.
+        # Forked workers inherit params instead of unpickling them.
+        renderer = ProcessPoolExecutor(params.render_workers, multiprocessing.get_context('fork'),
+                                       _set_render_params, (params,))
+    pending = threading.BoundedSemaphore(params.render_queue_size)
+
+    def _rendered(future: Future):
+        pending.release()
+        future.result()
 
     def _video_fn(out):
         print('sample_idx:', state['sample_index'])
@@ -129,17 +161,18 @@ def gen_sample_fn(params: ModelParameter):
 
         render_input.append((frame_out, token_out))
 
-        render_video(render_input, state['sample_index'], params)
+        pending.acquire()
+        renderer.submit(_render, render_input, state['sample_index']).add_done_callback(_rendered)
 
         state['sample_index'] += 1
         if state['sample_index'] >= params.num_of_sample:
+            renderer.shutdown(wait=True)
             exit()
 
     def _text_fn(out):
         print('sample_idx:', state['sample_index'])
 
-        bpe_tokenizer = GPT2TokenizerFast.from_pretrained('gpt2') if params.vocab_size != 256 and \
-                                                                     params.vocab_size > 256 else None
+        bpe_tokenizer = load_tokenizer(params.vocab_size)
 
         if params.use_autoregressive_sampling:
 
@@ -175,8 +208,7 @@ def gen_sample_fn(params: ModelParameter):
 
 
 def get_command_line_input_and_output_fn(params: ModelParameter):
-    bpe_tokenizer = GPT2TokenizerFast.from_pretrained('gpt2') if params.vocab_size != 256 and \
-                                                                 params.vocab_size > 256 else None
+    bpe_tokenizer = load_tokenizer(params.vocab_size)
 
     samp_temp = params.sampling_temperature
     end_iter = params.sequence_length
@@ -208,8 +240,9 @@ def get_command_line_input_and_output_fn(params: ModelParameter):
             query = np.reshape(np.array(query, np.int32), newshape=(1, params.sequence_length, 1))
             break
 
-        return query, np.array([iter_pos], np.int32), \
-               np.array([samp_temp], np.float32), np.array([end_iter], np.int32)
+        batch = params.train_batch_size
+        return np.repeat(query, batch, 0), np.array([iter_pos] * batch, np.int32), \
+               np.array([samp_temp] * batch, np.float32), np.array([end_iter] * batch, np.int32)
 
     def output_fn(out):
         color_print(params, 'Responds:')
@@ -228,29 +261,49 @@ class InvalidTokenError(ValueError):
     pass
 
 
+def _shared_array(dtype: np.dtype, shape: typing.List[int]) -> np.ndarray:
+    """
+    numpy view of a buffer in shared memory. Processes forked afterwards read and write the same memory.
+    """
+    dtype = np.dtype(dtype)
+    buffer = multiprocessing.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+    return np.frombuffer(buffer, dtype).reshape(shape)
+
+
 class InterfaceWrapper:
+    """
+    Hands prompts from request handlers to the sampling loop and the responses back. Every request owns one slot of
+    shared memory for its prompt and response, so no array is pickled. Slots are handed out through a queue, which
+    doubles as atomic id allocation, and waiting happens on pipes and events instead of polling.
+    Streamed requests are sampled stream_block_size tokens per TPU call. After each call, their sampled tokens become
+    the prompt of the next one, until they reach their end or a stop token.
+    """
+
     def __init__(self, params: ModelParameter):
         self.params = params
-        self.manager = multiprocessing.Manager()
-        self.input_prompt_id = self.manager.Value(int, 0)
-        self.tpu_input_id = self.manager.Value(int, 0)
-        self.output_prompt_id = self.manager.Value(int, 0)
-        self.input = self.manager.dict()
-        self.output = self.manager.dict()
-
-    def blocked_get(self, inp: dict, key: int):
-        while key not in inp:
-            time.sleep(self.params.default_sleep_duration)
-        return inp.pop(key)
-
-    def increment(self, idx) -> int:
-        prompt_id = idx.get()
-        idx.set(prompt_id + 1)
-        return prompt_id
-
-    def complete(self, query: typing.List[int], temperature: float, response_len: int, debug: bool = False,
-                 asynchronous: bool = False) -> typing.Union[typing.Callable, typing.Tuple[np.array, np.array],
-                                                             np.array]:
+        slots = params.interface_slots
+        token_shape = [dim.size for dim in params.token_dim_shape][1:]
+        self.prompt = _shared_array(np.int32, [slots] + token_shape)
+        self.response = _shared_array(np.float32, [slots] + token_shape)
+        self.iter_pos = _shared_array(np.int32, [slots])
+        self.temperature = _shared_array(np.float32, [slots])
+        self.end_iterations = _shared_array(np.int32, [slots])
+        self.streamed = _shared_array(np.bool_, [slots])
+        self.position = _shared_array(np.int32, [slots])  # response is valid up to here
+        self.finished = _shared_array(np.bool_, [slots])
+        self.done = [multiprocessing.Event() for _ in range(slots)]  # set whenever position or finished changed
+        self.free = multiprocessing.Queue()
+        self.requests = multiprocessing.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.batches = []  # slots of every batch that was handed to the TPU but has no output yet
+        self.prefix_cache = None
+        if prefix_cached(params):
+            self.prefix_cache = PrefixCache(params.prefix_cache_bytes, resumable_before_prefill(params),
+                                            params.prefix_cache_max_replay)
+
+    def _submit(self, query: typing.List[int], temperature: float, response_len: int, streamed: bool
+                ) -> typing.Tuple[int, int, int]:
         iter_pos = len(query)
 
         if iter_pos >= self.params.sequence_length:
@@ -258,26 +311,133 @@ class InterfaceWrapper:
         if query and max(query) >= self.params.vocab_size:
             raise InvalidTokenError
 
-        prompt_id = self.increment(self.input_prompt_id)
+        slot = self.free.get()
 
         query = query + [random.randint(0, self.params.vocab_size - 1) for _ in range((self.params.sequence_length - len(query)))]
-        query = np.reshape(np.array(query, np.int32), newshape=(1, self.params.sequence_length, 1))
+        end = min(response_len + iter_pos, self.params.sequence_length)
+        self.prompt[slot] = np.reshape(np.array(query, np.int32), self.prompt.shape[1:])
+        self.iter_pos[slot] = iter_pos
+        self.temperature[slot] = temperature
+        self.end_iterations[slot] = end
+        self.streamed[slot] = streamed
+        self.position[slot] = iter_pos
+        self.finished[slot] = False
+        self.done[slot].clear()
+        self.requests.put(slot)
+        return slot, iter_pos, end
+
+    def _wait(self, slot: int) -> typing.Tuple[int, bool]:
+        self.done[slot].wait()
+        self.done[slot].clear()
+        return int(self.position[slot]), bool(self.finished[slot])
 
-        self.input[prompt_id] = (query, np.array([iter_pos], np.int32), np.array([temperature], np.float32),
-                                 np.array([min(response_len + len(query), self.params.sequence_length)], np.int32))
+    def complete(self, query: typing.List[int], temperature: float, response_len: int, debug: bool = False,
+                 asynchronous: bool = False) -> typing.Union[typing.Callable, typing.Tuple[np.array, np.array],
+                                                             np.array]:
+        slot, iter_pos, end = self._submit(query, temperature, response_len, False)
 
         def _result():
-            response = self.blocked_get(self.output, prompt_id)[0].astype(np.int64)
-            out = response[0, iter_pos:].flatten()
+            while not self._wait(slot)[1]:
+                pass
+            response = self.response[slot:slot + 1].astype(np.int64)
+            self.free.put(slot)
+            out = response[0, iter_pos:end].flatten()
+            # The sampling loop pads everything after a stop token, so the response ends at the first padding.
+            padding = np.flatnonzero(out == self.params.padding_token)
+            if padding.size:
+                out = out[:padding[0]]
             return (out, response) if debug else out
 
         return _result if asynchronous else _result()
 
-    def input_query(self):
-        return self.blocked_get(self.input, self.increment(self.tpu_input_id))
+    def stream(self, query: typing.List[int], temperature: float, response_len: int
+               ) -> typing.Iterator[np.array]:
+        """
+        Like complete, but yields the new tokens after every TPU call instead of waiting for the full response.
+        A stop token is the last token yielded.
+        """
+        slot, sent, _ = self._submit(query, temperature, response_len, True)
+        try:
+            finished = False
+            while not finished:
+                position, finished = self._wait(slot)
+                if position > sent:
+                    yield self.response[slot, sent:position].flatten().astype(np.int64)
+                sent = position
+        finally:
+            if not finished:  # the consumer stopped early, end the request at its next TPU call
+                self.end_iterations[slot] = 0
+                while not self._wait(slot)[1]:
+                    pass
+            self.free.put(slot)
+
+    def input_query(self) -> typing.Tuple[np.array, np.array, np.array, np.array]:
+        """
+        Collect up to train_batch_size pending prompts into one batch. After the first prompt arrived, this waits at
+        most inference_batch_timeout seconds for more. Unused rows start at the end of the sequence, so they are
+        done before the first step.
+        """
+        slots = [self.requests.get()]
+        deadline = time.time() + self.params.inference_batch_timeout
+        while len(slots) < self.params.train_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                slots.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        end = self.end_iterations[slots]
+        end = np.where(self.streamed[slots], np.minimum(end, self.iter_pos[slots] + self.params.stream_block_size), end)
+        unused = self.params.train_batch_size - len(slots)
+        inputs = (np.concatenate([self.prompt[slots], np.zeros((unused,) + self.prompt.shape[1:], np.int32)], 0),
+                  np.array(self.iter_pos[slots].tolist() + [self.params.sequence_length] * unused, np.int32),
+                  np.array(self.temperature[slots].tolist() + [0] * unused, np.float32),
+                  np.array(end.tolist() + [self.params.sequence_length] * unused, np.int32))
+
+        # Without a hit, the model prefills at the shortest prompt, which is where the returned states belong to.
+        position, states = int(inputs[1].min()), None
+        if self.prefix_cache is not None:
+            position, states = self.prefix_cache.lookup([self.prompt[slot].flatten() for slot in slots],
+                                                        self.iter_pos[slots].tolist())
+            if states:
+                inputs += (np.array(position, np.int32),
+                           *[np.stack([row[idx] for row in states] + [np.zeros_like(states[0][idx])] * unused)
+                             for idx in range(len(states[0]))])
+            else:
+                position = int(inputs[1].min())
+            every = self.params.prefix_cache_report_every
+            if self.prefix_cache.lookups // every > (self.prefix_cache.lookups - len(slots)) // every:
+                color_print(self.params, repr(self.prefix_cache))
+        self.batches.append((slots, end, position, states is not None))
+        return inputs
 
     def output_responds(self, out):
-        self.output[self.increment(self.output_prompt_id)] = out
+        slots, ends, position, cached = self.batches.pop(0)
+        if self.prefix_cache is not None and not cached:
+            states = out[1 + len(self.params.debug_outfeed):]
+            for idx, slot in enumerate(slots):
+                self.prefix_cache.store(self.prompt[slot].flatten(), position, [state[idx] for state in states])
+        for idx, (slot, end) in enumerate(zip(slots, ends)):
+            self.response[slot] = out[0][idx]
+            if not self.streamed[slot]:
+                self.position[slot] = end
+                self.finished[slot] = True
+                self.done[slot].set()
+                continue
+
+            # The sampling loop pads everything after a stop token, so the response ends at the first padding.
+            tokens = self.response[slot].flatten()[self.iter_pos[slot]:end]
+            stopped = np.isin(tokens, [self.params.padding_token] + list(self.params.stop_tokens))
+            padding = np.flatnonzero(tokens == self.params.padding_token)
+            self.position[slot] = self.iter_pos[slot] + (padding[0] if padding.size else tokens.size)
+            self.finished[slot] = stopped.any() or end >= self.end_iterations[slot]
+            if not self.finished[slot]:
+                self.prompt[slot] = self.response[slot]
+                self.iter_pos[slot] = end
+                self.requests.put(slot)
+            self.done[slot].set()
 
 
 def get_similarity_input_and_output_fn(params: ModelParameter):
@@ -291,7 +451,7 @@ def get_similarity_input_and_output_fn(params: ModelParameter):
 
             out = [interface.complete(query=query, temperature=0.0, response_len=params.sequence_length, debug=True,
                                       asynchronous=True) for _ in range(params.equal_debugging_items_per_check)]
-            base, *out = [f() for f in out]
+            base, *out = [f()[1][0, len(query):] for f in out]  # untrimmed, so that all have the same length
 
             score = float(np.mean([np.mean(np.equal(base, o)) * 100 for o in out]))
             print(f"test:{idx} similarity score: {score:6.2f}%\n")
@@ -70,14 +70,14 @@ def main(args: argparse.Namespace) -> None:
 
     params.current_step = int(estimator_lib._load_global_step_from_checkpoint_dir(params.model_path))
 
-    # If run mode == sample, set the batch size to one
+    # If run mode == sample, sample inference_batch_size prompts at once
     if not params.train:
         if params.debug_sample:
             params.train_batch_size = 2
             params.use_autoregressive_sampling = True
             params.sampling_temperature = 0
         else:
-            params.train_batch_size = 1
+            params.train_batch_size = params.inference_batch_size
 
         params = ModelParameter(params)
 
@@ -96,6 +96,23 @@ def main(args: argparse.Namespace) -> None:
         raise ValueError(f"model_mode need to be 'jannet' or 'gpt' {params.model_mode}, "
                          "is a not supported option.")
 
+    # Load the draft model that proposes tokens for speculative sampling
+    if params.draft_model and not params.train:
+        if params.use_video:
+            raise ValueError("Speculative sampling needs a language-only 'gpt' model.")
+        draft_path = params.draft_model
+        draft_path = draft_path if draft_path.endswith(".json") else f"session_configs/{draft_path}.json"
+        with open(draft_path) as f:
+            draft = jsonpickle.loads(f.read())
+        # The draft samples the same tokens as the model, on the same mesh.
+        draft.update({key: params[key] for key in ('train', 'train_batch_size', 'sequence_length', 'vocab_size',
+                                                   'padding_token', 'token_patch_size', 'use_language', 'use_video',
+                                                   'tpu_size', 'use_autoregressive_sampling')})
+        params.draft_params = ModelParameter(draft)
+        if params.draft_params.mesh_shape != params.mesh_shape:
+            raise ValueError(f"The draft model has to fit the mesh {params.mesh_shape}, its heads give it "
+                             f"{params.draft_params.mesh_shape}.")
+
     # Add to params: auto_layout, auto_layout_and_mesh_shape, use_tpu, num_cores
     mesh_shape = mtf.convert_to_shape(params.mesh_shape)
     params.num_cores = mesh_shape.size
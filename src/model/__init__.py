@@ -6,11 +6,14 @@ import tensorflow as tf
 from .activation import activate
 from .backend import linear, linear_from_features, linear_to_features
 from .basic import activated_linear
+from .decode import decoding, full_dim, select_position
 from .embedding import embed, gather_embed
 from .frontend import block_part_fn
 from .momentumnet import MomentumOperation
 from .normalization import norm
+from .planner import plan_memory_reduction
 from .revnet import RevGradOp
+from .spatial import build_attention_masks
 from ..dataclass import BlockArgs, BlockConfig, ModelParameter
 from ..mtf_wrapper import (add_n, cast, constant_scalar, dropout, einsum, ones, reciprocal, reduce_sum, sigmoid, sign,
                            zeros_like, mod, floordiv, equal, argmax, softmax_cross_entropy_with_logits,
@@ -19,6 +22,7 @@ from ..utils_core import scoped
 from ..utils_mtf import concat, utils_slice, weighted_add
 
 ATTENTION_DIM = typing.NamedTuple("AttentionDim", (('index', int), ('dim', mtf.Dimension)))
+BLOCK_STREAM = typing.Union[mtf.Tensor, typing.Tuple[mtf.Tensor, mtf.Tensor, mtf.Tensor, mtf.Tensor]]
 
 tf1 = tf.compat.v1
 
@@ -90,41 +94,90 @@ def _input(params: ModelParameter,
     return src, tgt
 
 
+_REVERSIBLE = {'revnet': RevGradOp, 'momentum': MomentumOperation}
+
+
+def _checkpoint(params: ModelParameter, fn: typing.Callable, block_input: mtf.Tensor, recompute: bool = True
+                ) -> mtf.Tensor:
+    """
+    Planned blocks skip the scope of recompute_grad, so that every memory plan names its variables like "none" does and
+    checkpoints stay loadable across memory budgets.
+    """
+    if params.memory_reduction_strategy == 'auto':
+        return mtf.recompute_grad(fn, [block_input]) if recompute else fn(block_input)
+    if recompute:
+        return recompute_grad(fn, [block_input])
+    return scoped("recompute_grad", fn, block_input)
+
+
+def _decode_block(params: ModelParameter, block_config: BlockConfig, block_input: BLOCK_STREAM, index: int
+                  ) -> BLOCK_STREAM:
+    """
+    Forward pass of _block without any custom gradient operation, as those would hide the decoding states of the layers
+    inside. Everything gets the same names as in _block, so that both share their variables.
+    """
+    strategy = block_config.memory_reduction_strategy
+    if strategy in _REVERSIBLE and not isinstance(block_input, tuple):
+        block_input = (block_input, zeros_like(block_input), block_input, zeros_like(block_input))
+    if strategy not in _REVERSIBLE and isinstance(block_input, tuple):
+        block_input = block_input[0] + block_input[2]
+    if strategy == 'none':
+        return block_part_fn(params, block_config, block_input, str(index))
+    if strategy == 'checkpoint':
+        return _checkpoint(params, lambda x: block_part_fn(params, block_config, x, str(index)), block_input, False)
+    x1, x1_backwards, x2, x2_backwards = block_input
+    if strategy == 'revnet':
+        return x2, x2_backwards, x1 + block_part_fn(params, block_config, x2, str(index)), x1_backwards
+    v = x2 * params.momentumnet_alpha
+    v += block_part_fn(params, block_config, x1, str(index)) * (1 - params.momentumnet_alpha)
+    return x1 + v, x1_backwards, v, x2_backwards
+
+
+def _block(params: ModelParameter, block_config: BlockConfig, block_input: BLOCK_STREAM, index: int
+           ) -> BLOCK_STREAM:
+    if params.decode_state is not None:
+        return _decode_block(params, block_config, block_input, index)
+    strategy = block_config.memory_reduction_strategy
+    if strategy in _REVERSIBLE:
+        if not isinstance(block_input, tuple):
+            block_input = (block_input, zeros_like(block_input), block_input, zeros_like(block_input))
+        return tuple(_REVERSIBLE[strategy](params, block_config, *block_input, str(index)).outputs)
+    if isinstance(block_input, tuple):
+        block_input = block_input[0] + block_input[2]
+    if strategy == 'checkpoint':
+        return _checkpoint(params, lambda x: block_part_fn(params, block_config, x, str(index)), block_input)
+    if strategy == 'none':
+        return block_part_fn(params, block_config, block_input, str(index))
+    raise ValueError(f"Unknown memory_reduction_strategy {strategy}. "
+                     f"Use one of 'auto', 'none', 'checkpoint', 'revnet' or 'momentum'.")
+
+
 def _body(params: ModelParameter, src: mtf.Tensor) -> mtf.Tensor:
     base_args = BlockArgs(params, src, [''])
 
     if params.use_initial_position_embedding:
         for dim in (src.shape - params.feature_dims).dims[1:]:
-            src += embed(base_args(params.position_embedding), [dim] + params.feature_dims)
-
-    if params.memory_reduction_strategy == "revnet":
-        out = (src, zeros_like(src), src, zeros_like(src))
-
-        def _layer_builder(block_input: typing.Tuple[mtf.Tensor, mtf.Tensor, mtf.Tensor, mtf.Tensor],
-                           block_config: BlockConfig, index: int):
-            return RevGradOp(params, block_config, *block_input, str(index)).outputs
-    elif params.memory_reduction_strategy == 'checkpoint':
-        out = src
-
-        def _layer_builder(block_input: mtf.Tensor, block_config: BlockConfig, index: int):
-            return recompute_grad(lambda x: block_part_fn(params, block_config, x, str(index)),
-                                  [block_input])
-    elif params.memory_reduction_strategy == 'momentum':
-        out = (src, zeros_like(src), src, zeros_like(src))
-
-        def _layer_builder(block_input: typing.Tuple[mtf.Tensor, mtf.Tensor, mtf.Tensor, mtf.Tensor],
-                           block_config: BlockConfig, index: int):
-            return MomentumOperation(params, block_config, *block_input, str(index)).outputs
-    elif params.memory_reduction_strategy == 'none':
-        out = src
-
-        def _layer_builder(block_input: mtf.Tensor, block_config: BlockConfig, index: int):
-            return block_part_fn(params, block_config, block_input, str(index))
-    for i in range(params.depth):
-        for block_part in params.block_config:
-            out = _layer_builder(out, block_part, i)
-
-    if params.memory_reduction_strategy in ('revnet', 'momentum'):
+            dim = full_dim(params, dim)
+            src += select_position(params, embed(base_args(params.position_embedding), [dim] + params.feature_dims),
+                                   dim)
+
+    build_attention_masks(params, src.shape)
+
+    if params.decode_state is not None and params.decode_state.blocks is not None:
+        blocks = params.decode_state.blocks
+    elif params.memory_reduction_strategy == 'auto':
+        blocks = plan_memory_reduction(params, src)
+    else:
+        blocks = [params.block_config] * params.depth
+    if params.decode_state is not None:
+        params.decode_state.blocks = blocks
+
+    out = src
+    for i, block_configs in enumerate(blocks):
+        for block_config in block_configs:
+            out = _block(params, block_config, out, i)
+
+    if isinstance(out, tuple):
         out = out[0] + out[2]
     return out
 
@@ -135,7 +188,9 @@ def _output(params: ModelParameter, out: mtf.Tensor, spatial_ctx: mtf.Dimension
     token_out = frame_out = None
 
     if params.use_language:
-        token_out = utils_slice(out, 0, params.language_token_patch, spatial_ctx)
+        token_out = out
+        if not decoding(params, spatial_ctx):  # language-only, so spatial_ctx is the sequence
+            token_out = utils_slice(out, 0, params.language_token_patch, spatial_ctx)
         for config_idx, config in enumerate(params.output_block_config):
             token_out = block_part_fn(params, config, token_out, f'lang_out{config_idx}')
         new = [params.token_patch_dim, params.vocab_dim]
@@ -2,16 +2,19 @@ import math
 import typing
 
 import mesh_tensorflow as mtf
+import numpy as np
 import tensorflow as tf
 
 from .activation import activate
 from .backend import get_var, linear, orthogonal_var
 from .embedding import gather_embed
 from .normalization import norm
-from ..dataclass import BlockArgs
-from ..mtf_wrapper import (dropout as utils_dropout, sigmoid, exp, reduce_max, reduce_sum, einsum, reciprocal, reshape,
-                           multiply, reduce_mean, stop_gradient)
-from ..utils_mtf import linear_shapes, anonymize_shape, unbind
+from ..dataclass import BlockArgs, ModelParameter
+from ..mtf_wrapper import (dropout as utils_dropout, sigmoid, exp, reduce_max, reduce_sum, einsum, reshape,
+                           multiply, reduce_mean, stop_gradient, stack, unstack, add, argmax, cast, constant_scalar,
+                           cumsum, divide, one_hot, ones, top_k, reduce_logsumexp, add_n, floordiv, mod)
+from ..utils_core import random_name
+from ..utils_mtf import linear_shapes, anonymize, anonymize_dim, anonymize_shape, deduplicate
 
 ATTENTION_DIM = typing.NamedTuple("AttentionDim", (('index', int), ('dim', mtf.Dimension)))
 
@@ -34,24 +37,117 @@ def wrapped_linear(args: BlockArgs) -> mtf.Tensor:
     return linear(args, *linear_shapes(args))
 
 
-def mixture_of_experts(args: BlockArgs) -> mtf.Tensor:
+class AuxiliaryLoss(mtf.Operation):
+    """
+    Identity of x whose gradient also trains loss, as if loss was added to the model's loss. Unlike a loss in
+    the loss list, this also works inside memory reduced blocks, whose internal tensors can't be used outside of them.
+    loss gets the same gradient the optimizer seeds the model's loss with, so that it's scaled just like that one.
+    """
+
+    def __init__(self, params: ModelParameter, x: mtf.Tensor, loss: mtf.Tensor):
+        super().__init__([x, loss], name=random_name("auxiliary_loss"))
+        self.params = params
+        self._outputs = [mtf.Tensor(self, x.shape, x.dtype)]
+
+    def gradient(self, grad_ys):
+        loss = self.inputs[1]
+        if self.params.loss_gradient is None:  # e.g. mtf.gradients, which seeds every loss with one
+            return [grad_ys[0], ones(loss.mesh, [], loss.dtype)]
+        return [grad_ys[0], cast(self.params.loss_gradient, loss.dtype)]
+
+    def lower(self, lowering):
+        lowering.set_tensor_lowering(self.outputs[0], lowering.tensors[self.inputs[0]])
+
+
+def mixture_of_experts(args: BlockArgs, count: int = 1) -> typing.List[mtf.Tensor]:
+    """
+    count projections of a sparse mixture of experts with top-k routing, which all share one gate. The tokens of every
+    sample are split into groups of expert_group_size, and every token is dispatched to the expert_top_k experts with
+    the highest gate. Each expert takes at most its capacity of tokens per group, first choices before second ones,
+    tokens beyond that are dropped by this layer. For the expert computation, the experts dimension takes the place of
+    the batch dimension, so experts are split over the mesh like the batch and compute per token doesn't grow with
+    the number of experts.
+    """
+    params = args.params
     old, new = linear_shapes(args)
-    gate = linear(args, old, [args.params.expert_dim])
-    gate -= mtf.stop_gradient(reduce_max(gate, reduced_dim=args.params.expert_dim))
-    gate = exp(gate)
-    return einsum([reciprocal(reduce_sum(gate, reduced_dim=args.params.expert_dim)), args.tensor, gate,
-                   orthogonal_var(args, old + new + [args.params.expert_dim])],
-                  output_shape=args.tensor.shape - old + new)
+    batch = params.batch_dim
+    tokens = [dim for dim in args.tensor.shape.dims if dim not in old and dim != batch]
+    token_count = int(np.prod([dim.size for dim in tokens]))
+    token_dim = mtf.Dimension("expert_tokens", min(params.expert_group_size, token_count))
+    if token_count % token_dim.size:
+        raise ValueError(f"expert_group_size={params.expert_group_size} has to divide the {token_count} tokens of "
+                         f"every sample")
+    group = [batch, mtf.Dimension("expert_groups", token_count // token_dim.size)]
+    gate_dim = anonymize_dim(params.expert_dim)
+    choice_dim = mtf.Dimension("expert_choices", min(params.expert_top_k, params.experts))
+    capacity = math.ceil(params.expert_capacity_factor * choice_dim.size * token_dim.size / params.experts)
+    capacity_dim = mtf.Dimension("expert_capacity", capacity)
+
+    inp = reshape(einsum([args.tensor], output_shape=[batch] + tokens + old), group + [token_dim] + old)
+    # The gate keeps the experts dimension of its variable, only the copy every core multiplies with is replicated.
+    gate = anonymize(orthogonal_var(args, old + [params.expert_dim], old), params.expert_dim)
+    gate = cast(einsum([inp, gate], output_shape=group + [token_dim, gate_dim]), tf.float32)
+    gate = exp(gate - stop_gradient(reduce_max(gate, reduced_dim=gate_dim)))
+    gate = divide(gate, reduce_sum(gate, reduced_dim=gate_dim))
+
+    _, expert = top_k(gate, gate_dim, choice_dim)
+    expert = one_hot(expert, gate_dim, dtype=tf.float32)
+    weight = reduce_sum(multiply(gate, expert), reduced_dim=gate_dim)
+    if choice_dim.size > 1:
+        weight = divide(weight, reduce_sum(weight, reduced_dim=choice_dim))
+    position = add(cumsum(expert, token_dim, exclusive=True),
+                   cumsum(reduce_sum(expert, reduced_dim=token_dim), choice_dim, exclusive=True))
+    position = one_hot(cast(reduce_sum(multiply(position, expert), reduced_dim=gate_dim), tf.int32), capacity_dim,
+                       dtype=tf.float32)  # all zeros beyond the capacity
+    dispatch = einsum([expert, position], output_shape=group + [token_dim, gate_dim, capacity_dim])
+    combine = einsum([expert, position, weight], output_shape=group + [token_dim, gate_dim, capacity_dim])
+
+    expert_group = [anonymize_dim(batch), group[1]]
+    expert_inp = einsum([cast(dispatch, inp.dtype), inp], output_shape=group + [gate_dim, capacity_dim] + old)
+    expert_inp = reshape(expert_inp, expert_group + [params.expert_dim, capacity_dim] + old)
+    outputs = []
+    for _ in range(count):
+        out = einsum([expert_inp, orthogonal_var(args, old + new + [params.expert_dim])],
+                     output_shape=deduplicate(expert_group + [params.expert_dim, capacity_dim] + new))
+        features = (out.shape - expert_group - [params.expert_dim, capacity_dim]).dims
+        out = reshape(out, group + [gate_dim, capacity_dim] + features)
+        out = einsum([cast(combine, out.dtype), out], output_shape=group + [token_dim] + features)
+        outputs.append(einsum([reshape(out, [batch] + tokens + features)], output_shape=args.tensor.shape - old + new))
+
+    if params.expert_balance_loss:
+        # Fraction of first choices times mean gate of every expert, which is smallest if both are even
+        size = gate.size // params.experts
+        first = one_hot(argmax(gate, gate_dim), gate_dim, dtype=tf.float32)
+        balance = einsum([reduce_sum(first, output_shape=[gate_dim]), reduce_sum(gate, output_shape=[gate_dim]),
+                          constant_scalar(params, params.expert_balance_loss * params.experts / size ** 2, tf.float32)],
+                         output_shape=[])
+        outputs[0] = AuxiliaryLoss(params, outputs[0], balance).outputs[0]
+    return outputs
+
+
+def fused_linear(args: BlockArgs, count: int) -> typing.List[mtf.Tensor]:
+    """
+    count projections of the same input, computed by a single einsum over their stacked weights. Every projection
+    keeps its own variable, so that the weights are the same as those of count calls to wrapped_linear.
+    """
+    if count == 1:
+        return [wrapped_linear(args)]
+    old, new = linear_shapes(args)
+    dim = mtf.Dimension("projections", count)
+    weight = stack([orthogonal_var(args, old + new, old) for _ in range(count)], dim.name)
+    return unstack(einsum([args.tensor, weight], [dim] + deduplicate((args.tensor.shape - old).dims + new)), dim)
 
 
 def activated_linear(args: BlockArgs, prefix: str) -> mtf.Tensor:
     args = args([a[len(prefix):] for a in args if a.startswith(prefix)])
-    feed_forward_fn = mixture_of_experts if 'mixture_of_experts' in args else wrapped_linear
-    out = dropout(args(activate(args(feed_forward_fn(args)))))
+    count = 1 + ('glu' in args or 'glu_add' in args) + ('glu_add' in args)
+    feed_forward_fn = mixture_of_experts if 'mixture_of_experts' in args else fused_linear
+    projections = feed_forward_fn(args, count)
+    out = dropout(args(activate(args(projections[0]))))
     if 'glu' in args or 'glu_add' in args:
-        out = multiply(out, sigmoid(feed_forward_fn(args)))
+        out = multiply(out, sigmoid(projections[1]))
     if 'glu_add' in args:
-        out += activate(args(feed_forward_fn(args)))
+        out += activate(args(projections[2]))
     if 'norm' in args:
         out = norm(args(out))
     return out
@@ -79,23 +175,54 @@ def reduced_half_linear(args: BlockArgs):
     return group_linear(args(reduce_mean(args.tensor, reduced_dim=args.params.head_dim)))
 
 
+def _take(tensor: mtf.Tensor, position: mtf.Tensor, dim: mtf.Dimension) -> mtf.Tensor:
+    return reduce_sum(multiply(one_hot(position, dim, dtype=tensor.dtype), tensor), reduced_dim=dim)
+
+
+def _product_keys(params: ModelParameter, scores: mtf.Tensor, slot_dim: mtf.Dimension
+                  ) -> typing.Tuple[mtf.Tensor, mtf.Tensor]:
+    """
+    Exact top-k over the key_dim ** pkm_axes sums of one sub-key score per axis, without scoring every slot. The best
+    slots are built from the best slot_dim sub-keys of every axis, so merging one axis at a time and keeping the top
+    slot_dim partial sums after each merge never drops one of them.
+    :param scores: float32 sub-key scores with pkm_dim and key_dim
+    :param slot_dim: dimension of the selected slots
+    :return: softmax weight of the selected slots among all slots and their int32 value index
+    """
+    key_dim = params.key_dim
+    axis_dim = mtf.Dimension("pkm_axis_candidates", min(slot_dim.size, key_dim.size))
+    axes = unstack(scores, params.pkm_dim)
+    candidate_dim = slot_dim if len(axes) == 1 else mtf.Dimension("pkm_candidates", axis_dim.size)
+    score, idx = top_k(stop_gradient(axes[0]), key_dim, candidate_dim)
+    for i, axis in enumerate(axes[1:], 2):
+        axis_score, axis_idx = top_k(stop_gradient(axis), key_dim, axis_dim)
+        cartesian_dim = mtf.Dimension("pkm_cartesian", candidate_dim.size * axis_dim.size)
+        score = reshape(add(score, axis_score), score.shape - candidate_dim + [cartesian_dim])
+        previous_dim = candidate_dim
+        if i < len(axes):
+            candidate_dim = mtf.Dimension(f"pkm_candidates{i}", min(slot_dim.size, cartesian_dim.size))
+        else:
+            candidate_dim = slot_dim
+        score, position = top_k(score, cartesian_dim, candidate_dim)
+        idx = add(multiply(_take(idx, floordiv(position, axis_dim.size), previous_dim), key_dim.size),
+                  _take(axis_idx, mod(position, axis_dim.size), axis_dim))
+
+    # Selection has no gradient, the weights are scored again from the sub-keys of the selected slots.
+    score = add_n([_take(axis, mod(floordiv(idx, key_dim.size ** (len(axes) - i)), key_dim.size), key_dim)
+                   for i, axis in enumerate(axes, 1)])
+    # exp(s_0 + s_1) summed over all slots factorizes into the product of the sums per axis
+    normalizer = reduce_sum(reduce_logsumexp(scores, reduced_dim=key_dim), reduced_dim=params.pkm_dim)
+    return exp(score - normalizer), idx
+
+
 def product_key_memory(args: BlockArgs):
     args = args(activated_linear_in(args))
+    params = args.params
     old, new = linear_shapes(args)
-    features = [args.params.pkm_dim, args.params.key_dim]
-    assignment = linear(args, old, [args.params.head_dim] + features)
-    assignment = norm(args(assignment), features)
-    assignment -= stop_gradient(reduce_max(assignment,
-                                           output_shape=assignment.shape - [args.params.pkm_dim, args.params.key_dim]))
-    assignment = exp(assignment)
-    normalizer = reduce_sum(assignment, output_shape=assignment.shape - [args.params.key_dim])
-    normalizer = einsum(unbind(normalizer, args.params.pkm_dim), output_shape=normalizer.shape - args.params.pkm_dim)
-
-    val, idx = mtf.top_1(assignment, args.params.key_dim)
-    idx = mtf.einsum([mtf.cast(exp(math.log(args.params.features_per_head) *
-                                   mtf.range(normalizer.mesh, args.params.pkm_dim, dtype=normalizer.dtype)),
-                               tf.int32), idx], output_shape=idx.shape - args.params.pkm_dim)
-    val = mtf.reduce_sum(val, reduced_dim=args.params.pkm_dim) / normalizer
-    out = gather_embed(args(idx), [args.params.product_key_value_dim] + args.params.feature_dims,
-                       [args.params.head_dim])
-    return out * val
+    features = [params.pkm_dim, params.key_dim]
+    scores = linear(args, old, [params.head_dim] + features)
+    scores = cast(norm(args(scores), features), tf.float32)
+    slot_dim = mtf.Dimension("pkm_slots", min(params.pkm_top_k, params.product_key_value_vectors))
+    weight, idx = _product_keys(params, scores, slot_dim)
+    out = gather_embed(args(idx), [params.product_key_value_dim] + params.feature_dims, [params.head_dim])
+    return einsum([out, cast(weight, out.dtype)], output_shape=out.shape - slot_dim)
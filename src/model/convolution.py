@@ -3,9 +3,10 @@ import numpy as np
 import tensorflow as tf
 
 from .backend import OrthogonalInit, get_var
+from .decode import decoding, sequence_window
 from ..dataclass import BlockArgs
 from ..utils_core import random_name
-from ..utils_mtf import get_attention_dim
+from ..utils_mtf import get_attention_dim, is_masked, utils_slice
 
 tf1 = tf.compat.v1
 
@@ -53,14 +54,14 @@ class ConvolutionForward(mtf.Operation):
         elif space_dim_index == 0:
             self.kwargs['data_format'] = 'NHWC'
             self.weight_size.extend([kernel_size, 1])
-            self.input_size = [batch, sizes[1], int(np.prod(sizes[2:len(space_dims)])), features]
+            self.input_size = [batch, sizes[1], int(np.prod(sizes[2:1 + len(space_dims)])), features]
             self.conv = tf.nn.conv2d
             self.filter_backprop = tf1.nn.conv2d_backprop_filter
             self.input_backprop = tf.nn.conv2d_transpose
         elif space_dim_index == len(space_dims) - 1:
             self.kwargs['data_format'] = 'NHWC'
             self.weight_size.extend([1, kernel_size])
-            self.input_size = [batch, int(np.prod(sizes[1:len(space_dims) - 1])), sizes[len(space_dims)], features]
+            self.input_size = [batch, int(np.prod(sizes[1:len(space_dims)])), sizes[len(space_dims)], features]
             self.conv = tf.nn.conv2d
             self.filter_backprop = tf1.nn.conv2d_backprop_filter
             self.input_backprop = tf.nn.conv2d_transpose
@@ -68,17 +69,19 @@ class ConvolutionForward(mtf.Operation):
             self.kwargs['data_format'] = 'NDHWC'
             self.weight_size.extend([1, kernel_size, 1])
             self.input_size = [batch, int(np.prod(sizes[1:dim_index])), sizes[dim_index],
-                               int(np.prod(sizes[dim_index + 1:len(space_dims)])), features]
+                               int(np.prod(sizes[dim_index + 1:1 + len(space_dims)])), features]
             self.conv = tf.nn.conv3d
             self.filter_backprop = tf1.nn.conv3d_backprop_filter_v2
             self.input_backprop = tf.nn.conv3d_transpose
         self.kwargs['padding'] = 'SAME'
-        if masked:
-            self.kwargs['padding'] = [[w - 1, 0] for w in self.weight_size[2:]]
+        self.padding = None
+        if masked:  # causal, only the kernel_size - 1 previous positions are visible
+            self.kwargs['padding'] = 'VALID'
+            self.padding = [[0, 0]] + [[w - 1, 0] for w in self.weight_size[2:]] + [[0, 0]]
+        self.filter_size = self.weight_size[2:] + self.weight_size[:2]
 
         fan_in = [mtf.Dimension(chr(i + ord('a')), w) for i, w in enumerate(self.weight_size[1:]) if w != 1]
-        mtf_weight_size = params.feature_dims
-        mtf_weight_size.extend(fan_in)
+        mtf_weight_size = params.feature_dims + fan_in
         weight = OrthogonalInit(params, mtf_weight_size, args.is_last, fan_in)
         super().__init__([x, get_var(args, mtf_weight_size, weight)], name=random_name("conv_forward"))
         self._outputs = [mtf.Tensor(self, x.shape, x.dtype)]
@@ -92,7 +95,9 @@ class ConvolutionForward(mtf.Operation):
 
         def slicewise_fn(x, w):
             x = tf.reshape(x, self.input_size)
-            w = tf.reshape(w, self.weight_size)
+            if self.padding is not None:
+                x = tf.pad(x, self.padding)
+            w = tf.reshape(w, self.filter_size)
             out = self.conv(x, w, **self.kwargs)
             return tf.reshape(out, self.sizes)
 
@@ -130,4 +135,8 @@ def convolution(args: BlockArgs):
     convolution_size = 16
     if len(args) > 0 and args[-1].isdigit():
         convolution_size = int(args[-1])
-    return ConvolutionForward(args, dim, convolution_size, ).outputs[0]
+    args = args(sequence_window(args.params, args.tensor, dim, convolution_size - 1))
+    out = ConvolutionForward(args, get_attention_dim(args).dim, convolution_size, is_masked(args)).outputs[0]
+    if decoding(args.params, dim):  # only the newest positions of the window are new
+        return utils_slice(out, convolution_size - 1, convolution_size - 1 + dim.size, dim)
+    return out
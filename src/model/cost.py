@@ -0,0 +1,130 @@
+"""
+Analytical FLOP and memory-traffic estimates for Mesh TensorFlow graphs.
+All numbers are for the full (unsliced) tensors, so they describe the whole mesh and not a single core.
+"""
+import collections
+import re
+import typing
+
+import mesh_tensorflow as mtf
+import numpy as np
+
+from .convolution import ConvolutionFilterBackward, ConvolutionForward
+from .embedding import Gather, ScatterAdd
+from .spatial import BlockwiseSoftmax, BlockwiseSoftmaxBackward
+
+_DATA_MOVEMENT = (mtf.Variable, mtf.ReadVariable, mtf.ImportOperation, mtf.ImportLaidOutTensorOperation,
+                  mtf.Constant, mtf.Assign, mtf.Depend, mtf.StopGradient, mtf.ReshapeOperation,
+                  mtf.BroadcastOperation, mtf.SliceOperation, mtf.PadOperation, mtf.ConcatOperation,
+                  mtf.ShiftOperation, mtf.RangeOperation, mtf.OneHotOperation, Gather)
+_BODY_SCOPE = re.compile(r'body\d+v')
+_RECOMPUTE_SCOPE = re.compile(r'recompute_grad\d+v')
+
+
+class OperationCost(typing.NamedTuple):
+    flops: float = 0
+    activation_bytes: float = 0  # bytes of all tensors produced by the operation
+    memory_traffic: float = 0  # bytes read and written, assuming no fusion
+
+    def __add__(self, other: 'OperationCost') -> 'OperationCost':
+        return OperationCost(*(a + b for a, b in zip(self, other)))
+
+    def __mul__(self, factor: float) -> 'OperationCost':
+        return OperationCost(*(a * factor for a in self))
+
+
+def _bytes(tensors: typing.Iterable[mtf.Tensor]) -> int:
+    return sum(t.size * t.dtype.size for t in tensors)
+
+
+def _einsum_flops(op: mtf.EinsumOperation) -> float:
+    dims = {d.name: d.size for t in op.inputs for d in t.shape.dims}
+    size = np.prod(list(dims.values()), dtype=np.float64)
+    if len(op.inputs) == 1:
+        return size if op.outputs[0].shape.size != size else 0
+    reduced = any(name not in op.outputs[0].shape.dimension_names for name in dims)
+    return (2 if reduced else 1) * (len(op.inputs) - 1) * size
+
+
+def _attention_features(op: BlockwiseSoftmax) -> typing.Tuple[int, int]:
+    """
+    Features contracted by the query-key product (0 without queries) and features of the values, per logit.
+    """
+    def _features(name: str) -> int:
+        shape = op.shape(name)
+        return (shape - op.logit_shape).size if name in op.names else 0
+
+    return _features('qry'), _features('val')
+
+
+def operation_flops(op: mtf.Operation) -> float:
+    if isinstance(op, _DATA_MOVEMENT) or not op.inputs:
+        return 0
+    if isinstance(op, mtf.EinsumOperation):
+        return _einsum_flops(op)
+    if isinstance(op, ConvolutionForward):
+        return 2. * op.inputs[0].size * np.prod(op.weight_size[1:])
+    if isinstance(op, ConvolutionFilterBackward):
+        return 4. * op.inputs[0].size * np.prod(op.conv.weight_size[1:])
+    if isinstance(op, BlockwiseSoftmax):  # logits and weighted sum of the values
+        qry, val = _attention_features(op)
+        return 2. * op.logits * (qry + val)
+    if isinstance(op, BlockwiseSoftmaxBackward):  # logits again, then gradients of values, weights, queries and keys
+        qry, val = _attention_features(op.forward)
+        return 2. * op.forward.logits * (3 * qry + 2 * val)
+    if isinstance(op, ScatterAdd):
+        return float(op.grad.size)
+    if isinstance(op, mtf.ReduceOperation):
+        return float(op.inputs[0].size)
+    # point-wise operations (norms, activations, optimizer math, custom elementwise ops)
+    return float(max(t.size for t in op.outputs + op.inputs))
+
+
+def operation_cost(op: mtf.Operation) -> OperationCost:
+    if isinstance(op, mtf.Variable):
+        return OperationCost()
+    outputs = _bytes(op.outputs)
+    if isinstance(op, Gather):  # reads only the gathered rows of the table
+        return OperationCost(0, outputs, 2 * outputs + _bytes(op.inputs[:1]))
+    return OperationCost(operation_flops(op), outputs, outputs + _bytes(op.inputs))
+
+
+def layer_name(op: mtf.Operation) -> str:
+    """
+    Groups an operation by the block configuration and layer type it was created in, e.g. "block1/attention".
+    Operations outside the body are grouped by their top-level scope (input, output, loss, update, ...).
+    Recomputed blocks and their gradients are grouped with the layer they recompute.
+    """
+    scope = [s for s in op.name.split('/')[:-1] if s.endswith('v') and not _RECOMPUTE_SCOPE.fullmatch(s)]
+    body = [i for i, s in enumerate(scope) if _BODY_SCOPE.fullmatch(s)]
+    if body and len(scope) > body[0] + 2:
+        block, layer = scope[body[0] + 1:body[0] + 3]
+        return f"block{block.split('_')[-1][:-1]}/{layer.rstrip('0123456789v').rstrip('_')}"
+    for name in scope[1:] + scope[:1]:
+        name = name.rstrip('0123456789v').rstrip('_')
+        if name:
+            return name
+    return 'other'
+
+
+def _while_loop_body(op: mtf.Operation) -> typing.List[mtf.Operation]:
+    return getattr(op, '_body_ops', []) + getattr(op, '_cond_ops', [])
+
+
+def graph_cost(operations: typing.Iterable[mtf.Operation], loop_iterations: int = 1
+               ) -> typing.Dict[str, OperationCost]:
+    """
+    Sum the cost of all operations per layer.
+    :param operations: mtf operations, usually graph.operations
+    :param loop_iterations: number of iterations each while loop is expected to run for
+    :return: cost per layer_name
+    """
+    costs = collections.defaultdict(OperationCost)
+    for op in operations:
+        body = _while_loop_body(op)
+        if body:
+            for name, cost in graph_cost(body, loop_iterations).items():
+                costs[name] += cost * loop_iterations
+            continue
+        costs[layer_name(op)] += operation_cost(op)
+    return dict(costs)
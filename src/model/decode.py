@@ -0,0 +1,210 @@
+"""
+Incremental decoding for autoregressive sampling. Instead of running the model over the full sequence for every
+sampled token, a prefill pass stores the keys and values of all attention layers and the last inputs of all
+convolutions. Every following step feeds only a single position (or the few positions a draft model proposed)
+through the model and updates those states.
+"""
+import typing
+
+import mesh_tensorflow as mtf
+
+from ..dataclass import BlockConfig, ModelParameter
+from ..mtf_wrapper import add, add_n, cast, einsum, equal, mtf_range, multiply, one_hot, reduce_sum, reshape
+from ..utils_mtf import anonymize, anonymize_dim, concat, replace_dim, utils_slice, weighted_add
+
+# Layers that never mix information across positions, so they run on a single position as they are.
+POSITION_WISE = ('feed_forward', 'norm', 'rezero', 'activation', 'dropout', 'group_linear', 'reduced_half_linear',
+                 'product_key_memory')
+
+
+class DecodeState:
+    def __init__(self, position: mtf.Tensor, sequence_dim: mtf.Dimension,
+                 states: typing.Optional[typing.List[mtf.Tensor]] = None,
+                 blocks: typing.Optional[typing.List[typing.List[BlockConfig]]] = None, steps: int = 1):
+        self.position = position  # int32 scalar, position of the first token that is fed into the model
+        self.sequence_dim = sequence_dim  # full sequence, a step only sees a sequence_dim of size steps
+        self.inputs = states  # states of the previous step, None while prefilling
+        self.outputs: typing.List[mtf.Tensor] = []  # states for the next step, in the order layers are built
+        self.blocks = blocks  # memory reduction plan of the prefill, reused so that every step computes the same
+        self.steps = steps  # positions fed at once, e.g. all tokens of a draft model to verify them
+        self.windows: typing.Dict[int, mtf.Tensor] = {}  # index in outputs: convolution window with all new positions
+        self.masks = {}
+
+    @property
+    def prefill(self) -> bool:
+        return self.inputs is None
+
+    @property
+    def step_dim(self) -> mtf.Dimension:
+        return mtf.Dimension(self.sequence_dim.name, self.steps)
+
+    def positions(self) -> mtf.Tensor:
+        return add(mtf_range(self.position.mesh, self.step_dim, self.position.dtype), self.position)
+
+    def tokens(self, token_x: mtf.Tensor) -> mtf.Tensor:
+        """
+        The tokens of all positions this step feeds, cut out of token_x spanning the full sequence.
+        """
+        select = one_hot(self.positions(), anonymize_dim(self.sequence_dim), dtype=token_x.dtype)
+        return reduce_sum(multiply(anonymize(token_x, self.sequence_dim), select),
+                          output_shape=replace_dim(token_x.shape, self.step_dim, self.sequence_dim))
+
+    def read(self) -> mtf.Tensor:
+        return self.inputs[len(self.outputs)]
+
+    def rewind(self, steps: mtf.Tensor) -> typing.List[mtf.Tensor]:
+        """
+        States as if only the first steps positions were fed, e.g. after speculative sampling rejected the others.
+        Attention keys after the current position are overwritten before they are attended to, so only convolution
+        windows have to move back.
+        """
+        outputs = list(self.outputs)
+        for index, window in self.windows.items():
+            size = outputs[index].shape.get_dim_by_name(self.sequence_dim.name).size
+            outputs[index] = _window(window, self.sequence_dim.name, size, steps)
+        return outputs
+
+
+def select_step(steps: typing.List[DecodeState], count: mtf.Tensor) -> typing.List[mtf.Tensor]:
+    """
+    States after the first count of several consecutive steps, the counterpart of DecodeState.rewind for steps that
+    were fed one after another.
+    """
+    outputs = list(steps[-1].outputs)
+    for index in steps[-1].windows:
+        outputs[index] = add_n([multiply(step.outputs[index], cast(equal(count, i + 1), step.outputs[index].dtype))
+                                for i, step in enumerate(steps)])
+    return outputs
+
+
+def _window(tensor: mtf.Tensor, name: str, size: int, start: mtf.Tensor) -> mtf.Tensor:
+    """
+    The size positions of tensor along the dimension called name, starting at the scalar start.
+    """
+    dim = tensor.shape.get_dim_by_name(name)
+    window_dim = mtf.Dimension(name, size)
+    positions = add(mtf_range(tensor.mesh, window_dim, start.dtype), start)
+    select = cast(equal(mtf_range(tensor.mesh, anonymize_dim(dim), start.dtype), positions), tensor.dtype)
+    return einsum([anonymize(tensor, dim), select], output_shape=replace_dim(tensor.shape, window_dim, dim))
+
+
+def _layers(configs: typing.List[BlockConfig]) -> typing.Iterable[typing.Tuple[str, typing.List[str]]]:
+    for config in configs:
+        for layer in config.layer:
+            name, *extras = layer.split('-')
+            if name == 'split_path':
+                yield from _layers([BlockConfig({'layer': path.split(',')}, '')
+                                    for path in '-'.join(extras).split(';')[1:]])
+                continue
+            yield name, extras
+
+
+def decodable(params: ModelParameter) -> bool:
+    """
+    Whether every layer of the model supports incremental decoding. Anything else has to run the full model per token.
+    """
+    if params.use_video:
+        return False
+    causal = 0 in params.masked_attention_dimensions
+    for name, extras in _layers(params.input_block_config + params.block_config + params.output_block_config):
+        # Tokens compete for the capacity of experts, so a mixture of experts isn't position-wise
+        if name in POSITION_WISE and not any(extra.endswith('mixture_of_experts') for extra in extras):
+            continue
+        if name == 'attention' and (causal or 'biased_attention_map' not in extras):
+            continue
+        if name == 'convolution' and causal:
+            continue
+        return False
+    return True
+
+
+def prefix_cached(params: ModelParameter) -> bool:
+    """
+    Whether serving keeps the decode states of earlier prompts, see prefix_cache.PrefixCache.
+    """
+    return (params.prefix_cache_bytes > 0 and params.use_decode_cache and params.use_autoregressive_sampling
+            and params.draft_params is None and decodable(params))
+
+
+def resumable_before_prefill(params: ModelParameter) -> bool:
+    """
+    Whether decode states prefilled at one position also resume sampling at any earlier position. Attention keys and
+    values after the current position are overwritten before they are attended to, but convolutions only keep the
+    positions right before the one they were prefilled at.
+    """
+    return all(name != 'convolution'
+               for name, _ in _layers(params.input_block_config + params.block_config + params.output_block_config))
+
+
+def decoding(params: ModelParameter, dim: mtf.Dimension) -> bool:
+    """
+    Whether the current layer runs a single decoding step along dim.
+    """
+    state: typing.Optional[DecodeState] = params.decode_state
+    return state is not None and not state.prefill and dim.name == state.sequence_dim.name
+
+
+def full_dim(params: ModelParameter, dim: mtf.Dimension) -> mtf.Dimension:
+    return params.decode_state.sequence_dim if decoding(params, dim) else dim
+
+
+def select_position(params: ModelParameter, tensor: mtf.Tensor, dim: mtf.Dimension) -> mtf.Tensor:
+    """
+    Pick the current position out of a tensor spanning the full sequence, e.g. a position embedding.
+    """
+    if not decoding(params, dim):
+        return tensor
+    state: DecodeState = params.decode_state
+    # tensor might hold the anonymized dim already (keys of an attention map), so the steps get a name of their own
+    steps = mtf.Dimension(f'{dim.name}_steps', state.steps)
+    positions = add(mtf_range(params.mesh, steps, state.position.dtype), state.position)
+    tensor = einsum([tensor, one_hot(positions, dim, dtype=tensor.dtype)],
+                    output_shape=replace_dim(tensor.shape, steps, dim))
+    return reshape(tensor, replace_dim(tensor.shape, state.step_dim, steps))
+
+
+def position_mask(params: ModelParameter, comparison: typing.Callable) -> mtf.Tensor:
+    """
+    comparison(current position, key position) for all keys of the sequence, the decoding version of compare_range.
+    """
+    state: DecodeState = params.decode_state
+    if comparison not in state.masks:
+        keys = mtf_range(params.mesh, anonymize_dim(state.sequence_dim), state.position.dtype)
+        state.masks[comparison] = cast(comparison(state.positions(), keys), params.variable_dtype.activation_dtype)
+    return state.masks[comparison]
+
+
+def cache_sequence(params: ModelParameter, tensor: mtf.Tensor, dim: mtf.Dimension) -> mtf.Tensor:
+    """
+    Anonymize dim of tensor, as keys and values of attention need it. While decoding, the new positions are written
+    into the keys (or values) of all positions the previous steps left behind instead.
+    """
+    state: typing.Optional[DecodeState] = params.decode_state
+    if state is None or dim.name != state.sequence_dim.name:
+        return anonymize(tensor, dim)
+    if state.prefill:
+        tensor = anonymize(tensor, dim)
+    else:
+        cache = state.read()
+        mask = one_hot(state.positions(), anonymize_dim(state.sequence_dim), dtype=cache.dtype)
+        tensor = weighted_add(einsum([tensor, mask], output_shape=cache.shape), cache,
+                              reduce_sum(mask, reduced_dim=state.step_dim))
+    state.outputs.append(tensor)
+    return tensor
+
+
+def sequence_window(params: ModelParameter, tensor: mtf.Tensor, dim: mtf.Dimension, size: int) -> mtf.Tensor:
+    """
+    Prepend the size positions before the first new one to tensor while decoding, so that a causal convolution with a
+    kernel of size + 1 sees everything it needs. Only those positions are kept between steps.
+    """
+    state: typing.Optional[DecodeState] = params.decode_state
+    if state is None or dim.name != state.sequence_dim.name or not size:
+        return tensor
+    if state.prefill:
+        state.outputs.append(_window(tensor, dim.name, size, state.position - size))
+        return tensor
+    tensor = concat([state.read(), tensor], dim)
+    state.windows[len(state.outputs)] = tensor
+    state.outputs.append(utils_slice(tensor, state.steps, size + state.steps, dim))
+    return tensor
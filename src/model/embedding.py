@@ -10,7 +10,7 @@ from .. import tf_wrapper as tfw
 from ..dataclass import BlockArgs, ModelParameter
 from ..mtf_wrapper import einsum, reshape, multiply, zeros_like
 from ..utils_core import random_name, scoped
-from ..utils_mtf import DIM_LIST, SHAPE, linear_shapes, shape_size
+from ..utils_mtf import DIM_LIST, SHAPE, anonymize, linear_shapes, shape_size
 
 
 def _multi_dim_range_tf(params: ModelParameter, dims: DIM_LIST) -> mtf.Tensor:
@@ -88,6 +88,54 @@ def scatter_add(out: mtf.Tensor, indices: mtf.Tensor, gradient: mtf.Tensor, sque
     return ScatterAdd(out, indices, gradient, squeeze_dims).outputs[0]
 
 
+class SparseGradient(ScatterAdd):
+    """
+    Gradient of a Gather. Used as a tensor, it is the dense ScatterAdd into zeros, but the optimizer can instead update
+    only the gathered rows of the table using SparseRows.
+    """
+
+
+class SparseRows(mtf.Operation):
+    """
+    Unique rows of a SparseGradient with the summed gradient of every row. The row dimension has one entry per index,
+    rows that aren't needed point at row 0 and are zero in the mask.
+    """
+
+    def __init__(self, gradient: SparseGradient, row_dim: mtf.Dimension):
+        _, indices, grad = gradient.inputs
+        super().__init__([indices, grad], indices.mesh, random_name("sparse_rows"))
+        index_dims = [dim for dim in gradient.squeeze_dims if dim in indices.shape.dims]
+        self._outputs = [mtf.Tensor(self, mtf.Shape([row_dim] + index_dims), tf.int32),
+                         mtf.Tensor(self, mtf.Shape([row_dim] + gradient.outputs[0].shape.dims[1:]), grad.dtype),
+                         mtf.Tensor(self, mtf.Shape([row_dim] + index_dims), tf.float32)]
+
+    def has_gradient(self):
+        return False
+
+    def lower(self, lowering: mtf.Lowering):
+        mesh_impl: mtf.simd_mesh_impl.SimdMeshImpl = lowering.mesh_impl(self)
+        shapes = [mesh_impl.slice_shape(out.shape) for out in self.outputs]
+
+        def slicewise_fn(indices: tf.Tensor, gradient: tf.Tensor) -> typing.Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+            # Squeezed dimensions have size 1 in every slice, so only the indices of this slice are left.
+            indices = tf.reshape(indices, [-1])
+            count = indices.shape[0]
+            order = tf.argsort(indices)
+            indices = tf.gather(indices, order)
+            first = tf.concat([tf.ones([1], tf.int32), tf.cast(tf.not_equal(indices[1:], indices[:-1]), tf.int32)], 0)
+            segments = tf.cumsum(first) - 1
+            mask = tf.range(count) <= segments[-1]
+            rows = tf.where(mask, tf.math.unsorted_segment_max(indices, segments, count), 0)
+            gradient = tf.gather(tf.reshape(gradient, [count, -1]), order)
+            values = tf.math.unsorted_segment_sum(gradient, segments, count)
+            return (tf.reshape(rows, shapes[0]), tf.reshape(values, shapes[1]),
+                    tf.reshape(tf.cast(mask, tf.float32), shapes[2]))
+
+        outputs = mesh_impl.slicewise(slicewise_fn, *[lowering.tensors[inp] for inp in self.inputs])
+        for out, laid_out in zip(self.outputs, outputs):
+            lowering.set_tensor_lowering(out, laid_out)
+
+
 class Gather(mtf.Operation):
     def __init__(self, args: BlockArgs, embedding: mtf.Tensor, squeeze_dims: typing.Optional[SHAPE]):
         super().__init__([args.tensor, embedding], args.params.mesh, name=random_name("gather"))
@@ -103,12 +151,14 @@ class Gather(mtf.Operation):
         out_shape = args.tensor.shape - squeeze_dims + embedding.shape.dims[1:]
         self.args = args
         self.unsqueezed_dims = [out_shape.dims.index(dim) for dim in squeeze_dims if dim in out_shape.dims]
-        self._outputs = [mtf.Tensor(self, out_shape,
-                                    args.params.variable_dtype.activation_dtype)]
+        self._outputs = [mtf.Tensor(self, out_shape, embedding.dtype)]
 
     def gradient(self, grad_ys: typing.List[mtf.Tensor]) -> typing.Tuple[None, mtf.Tensor]:
         indices, embedding = self.inputs
-        return None, scatter_add(zeros_like(embedding), indices, grad_ys[0], self.squeeze_dims)
+        # Every copy of the table needs the rows gathered on all devices, not just its own slice of the tokens.
+        tokens = [dim for dim in indices.shape.dims if dim not in embedding.shape.dims]
+        return None, SparseGradient(zeros_like(embedding), anonymize(indices, tokens), anonymize(grad_ys[0], tokens),
+                                    self.squeeze_dims).outputs[0]
 
     def lower(self, lowering: mtf.Lowering):
         mesh_impl: mtf.simd_mesh_impl.SimdMeshImpl = lowering.mesh_impl(self)
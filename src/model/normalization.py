@@ -6,11 +6,14 @@ import tensorflow as tf
 from scipy.special import erfinv
 
 from .backend import normal_var, SHAPE
+from .. import tf_wrapper as tfw
 from ..dataclass import BlockArgs
-from ..mtf_wrapper import einsum, reduce_mean, rsqrt_eps, square
+from ..mtf_wrapper import einsum, reduce_mean, reduce_sum, rsqrt_eps, square
+from ..utils_core import random_name
 from ..utils_mtf import linear_shapes
 
 tf1 = tf.compat.v1
+LAID_OUT = typing.Any  # every MeshImpl has its own LaidOutTensor class
 
 
 def uniformly_sampled_gaussian(num_rand, dtype):
@@ -19,11 +22,164 @@ def uniformly_sampled_gaussian(num_rand, dtype):
     return tf.constant(rand, dtype=dtype)
 
 
+def _broadcast_slice(tensor: tf.Tensor, shape: mtf.Shape, target_shape: mtf.Shape) -> tf.Tensor:
+    """
+    Transpose and expand the slice of a tensor of shape, so that it broadcasts against slices of target_shape.
+    """
+    tensor = tfw.transpose(tensor, [shape.dims.index(dim) for dim in target_shape.dims if dim in shape.dims])
+    for axis, dim in enumerate(target_shape.dims):
+        if dim not in shape.dims:
+            tensor = tfw.expand_dims(tensor, axis)
+    return tensor
+
+
+def _sums(mesh_impl: mtf.MeshImpl, x: mtf.Tensor, reduced_shape: mtf.Shape, fn: typing.Callable, *tensors: LAID_OUT
+          ) -> LAID_OUT:
+    """
+    Sums over reduced_shape of the float32 tensors shaped like x that fn computes from slices of the laid out
+    tensors, stacked along a new first axis. Every core sums its own slices before a single allreduce adds those of
+    the cores that hold other parts of reduced_shape. fn's outputs never exist outside of the sums.
+    """
+    layout = mesh_impl.tensor_layout(x).tensor_axis_to_mesh_axis
+    axes = [x.shape.dims.index(dim) for dim in reduced_shape.dims]
+
+    def slicewise_fn(*slices):
+        return tfw.stack([tfw.reduce_sum(tensor, axes, keepdims=True) for tensor in fn(*slices)], 0)
+
+    sums = mesh_impl.slicewise(slicewise_fn, *tensors)
+    mesh_axes = [layout[axis] for axis in axes if layout[axis] is not None]
+    return mesh_impl.allreduce(sums, mesh_axes, "SUM") if mesh_axes else sums
+
+
+class NormForward(mtf.Operation):
+    """
+    Normalization over reduced_shape followed by an optional scale and shift. The variance is the mean of squares of
+    x minus its mean, which needs one more pass over x than the mean of squares minus the squared mean, but doesn't
+    cancel out for inputs far away from zero.
+    """
+
+    def __init__(self, x: mtf.Tensor, reduced_shape: mtf.Shape, scale: typing.Optional[mtf.Tensor],
+                 shift: typing.Optional[mtf.Tensor], epsilon: float):
+        super().__init__([x] + [t for t in (scale, shift) if t is not None], name=random_name("norm_forward"))
+        self.reduced_shape = reduced_shape
+        self.scale = scale
+        self.shift = shift
+        self.epsilon = epsilon
+        self._outputs = [mtf.Tensor(self, x.shape, x.dtype)]
+
+    def gradient(self, grad_ys):
+        dy = grad_ys[0]
+        grads = list(NormBackward(self, dy).outputs)
+        if self.shift is not None:
+            grads.append(reduce_sum(dy, output_shape=self.shift.shape))
+        return grads
+
+    def moments(self, mesh_impl: mtf.MeshImpl, x: LAID_OUT) -> LAID_OUT:
+        """
+        Float32 mean and reciprocal standard deviation of x, stacked along a new first axis.
+        """
+        size = float(self.reduced_shape.size)
+        x_mtf = self.inputs[0]
+        mean = mesh_impl.slicewise(lambda sums: sums[0] / size,
+                                   _sums(mesh_impl, x_mtf, self.reduced_shape,
+                                         lambda x: [tfw.cast(x, tf.float32)], x))
+        variance = _sums(mesh_impl, x_mtf, self.reduced_shape,
+                         lambda x, mean: [tfw.square(tfw.cast(x, tf.float32) - mean)], x, mean)
+
+        def slicewise_fn(mean, variance):
+            return tfw.stack([mean, tfw.rsqrt(variance[0] / size + self.epsilon)], 0)
+
+        return mesh_impl.slicewise(slicewise_fn, mean, variance)
+
+    def normalize(self, x_slice: tf.Tensor, moments: tf.Tensor) -> tf.Tensor:
+        return (tfw.cast(x_slice, tf.float32) - moments[0]) * moments[1]
+
+    def lower(self, lowering):
+        mesh_impl = lowering.mesh_impl(self)
+        x = self.inputs[0]
+        weights = [t for t in (self.scale, self.shift) if t is not None]
+
+        def slicewise_fn(x_slice, moments, *weight_slices):
+            out = self.normalize(x_slice, moments)
+            for weight, weight_slice in zip(weights, weight_slices):
+                weight_slice = _broadcast_slice(tfw.cast(weight_slice, tf.float32), weight.shape, x.shape)
+                out = out * weight_slice if weight is self.scale else out + weight_slice
+            return tfw.cast(out, x.dtype)
+
+        y = mesh_impl.slicewise(slicewise_fn, lowering.tensors[x], self.moments(mesh_impl, lowering.tensors[x]),
+                                *[lowering.tensors[weight] for weight in weights])
+        lowering.set_tensor_lowering(self.outputs[0], y)
+
+
+class NormBackward(mtf.Operation):
+    """
+    dx = (g - mean(g) - normalized * mean(g * normalized)) / std with g = dy * scale, computed from one more pass of
+    sums, and the gradient of scale if there is one. normalized is recomputed from x wherever it's needed instead of
+    being kept around.
+    """
+
+    def __init__(self, forward: NormForward, dy: mtf.Tensor):
+        x = forward.inputs[0]
+        scale = [forward.scale] * (forward.scale is not None)
+        super().__init__([x, dy] + scale, name=random_name("norm_backward"))
+        self.forward = forward
+        self._outputs = [mtf.Tensor(self, x.shape, x.dtype)] + [mtf.Tensor(self, s.shape, s.dtype) for s in scale]
+
+    def lower(self, lowering):
+        mesh_impl = lowering.mesh_impl(self)
+        x, dy, *scale = self.inputs
+        size = float(self.forward.reduced_shape.size)
+        inputs = [lowering.tensors[t] for t in (x, dy)]
+        moments = self.forward.moments(mesh_impl, inputs[0])
+        scale_slices = [lowering.tensors[t] for t in scale]
+
+        def gradient_fn(x_slice, dy_slice, moments, *scale_slice):
+            grad = tfw.cast(dy_slice, tf.float32)
+            if scale_slice:
+                grad = grad * _broadcast_slice(tfw.cast(scale_slice[0], tf.float32), scale[0].shape, x.shape)
+            return self.forward.normalize(x_slice, moments), grad
+
+        def sums_fn(*slices):
+            normalized, grad = gradient_fn(*slices)
+            return [grad, normalized * grad]
+
+        sums = _sums(mesh_impl, x, self.forward.reduced_shape, sums_fn, *inputs, moments, *scale_slices)
+
+        def dx_fn(x_slice, dy_slice, moments, sums, *scale_slice):
+            normalized, grad = gradient_fn(x_slice, dy_slice, moments, *scale_slice)
+            dx = (grad - sums[0] / size - normalized * (sums[1] / size)) * moments[1]
+            return tfw.cast(dx, x.dtype)
+
+        lowering.set_tensor_lowering(self.outputs[0], mesh_impl.slicewise(dx_fn, *inputs, moments, sums,
+                                                                          *scale_slices))
+        if not scale:
+            return
+
+        # Gradient of scale, summed over every dimension of x scale doesn't have
+        layout = mesh_impl.tensor_layout(x).tensor_axis_to_mesh_axis
+        axes = [axis for axis, dim in enumerate(x.shape.dims) if dim not in scale[0].shape.dims]
+        kept = [dim for dim in x.shape.dims if dim in scale[0].shape.dims]
+
+        def scale_fn(x_slice, dy_slice, moments):
+            grad = tfw.reduce_sum(tfw.cast(dy_slice, tf.float32) * self.forward.normalize(x_slice, moments), axes)
+            return tfw.cast(tfw.transpose(grad, [kept.index(dim) for dim in scale[0].shape.dims]), scale[0].dtype)
+
+        grad = mesh_impl.slicewise(scale_fn, *inputs, moments)
+        mesh_axes = [layout[axis] for axis in axes if layout[axis] is not None]
+        lowering.set_tensor_lowering(self.outputs[1], mesh_impl.allreduce(grad, mesh_axes, "SUM")
+                                     if mesh_axes else grad)
+
+
 def norm(args: BlockArgs, feature_shape: typing.Optional[SHAPE] = None) -> mtf.Tensor:
     block_input = args.tensor
     feature_shape = mtf.Shape(linear_shapes(args).old if feature_shape is None else feature_shape)
     normalized_shape = block_input.shape - (feature_shape - [args.params.head_dim] * ('group' in args))
 
+    if args.params.fused_norm:
+        scale = normal_var(args, feature_shape, mean=1) if 'scale' in args else None
+        shift = normal_var(args, feature_shape, mean=0) if 'shift' in args else None
+        return NormForward(block_input, block_input.shape - normalized_shape, scale, shift, 1e-5).outputs[0]
+
     block_input -= reduce_mean(block_input, output_shape=normalized_shape)
     scale = [rsqrt_eps(reduce_mean(square(block_input), output_shape=normalized_shape), 1e-5), block_input]
     if 'scale' in args:
@@ -0,0 +1,116 @@
+"""
+Picks a memory_reduction_strategy per block so that the activations kept for the backward pass fit into
+params.memory_budget_per_core while recomputing as little of the forward pass as possible.
+Only strategies that compute the same function are planned, so the loss doesn't depend on the budget.
+"""
+import typing
+
+import mesh_tensorflow as mtf
+
+from .cost import operation_flops
+from .frontend import block_part_fn
+from ..dataclass import BlockConfig, ModelParameter
+from ..mtf_wrapper import zeros
+from ..utils_core import color_print
+from ..utils_mtf import scratch_graph
+
+# Ordered from most to least stored memory. Revnet and momentum are not planned, as their two streams change the
+# function a block computes.
+STRATEGY_ORDER = ("none", "checkpoint")
+
+
+class BlockCost(typing.NamedTuple):
+    activation_bytes: float  # per core, kept alive until the backward pass when nothing is recomputed
+    input_bytes: float  # per core, kept alive when the block is recomputed from its input
+    flops: float  # forward pass, paid again by checkpoint
+
+
+def _slice_bytes(params: ModelParameter, tensor: mtf.Tensor) -> float:
+    size = tensor.size if params.mesh_impl is None else params.mesh_impl.slice_size(tensor.shape)
+    return size * tensor.dtype.size
+
+
+def stored_bytes(cost: BlockCost, strategy: str) -> float:
+    if strategy == "none":
+        return cost.activation_bytes
+    if strategy == "checkpoint":
+        return cost.input_bytes
+    return 0
+
+
+def recomputed_flops(cost: BlockCost, strategy: str) -> float:
+    return 0 if strategy == "none" else cost.flops
+
+
+def block_cost(params: ModelParameter, block_config: BlockConfig, src: mtf.Tensor) -> BlockCost:
+    """
+    Build one block in a scratch graph and measure it.
+    :param params: ModelParameter
+    :param block_config: block to measure
+    :param src: input of the block in the real graph, only its shape and dtype are used
+    :return: memory and compute estimates of a single block
+    """
+    block_config = BlockConfig(block_config, "")
+    block_config.memory_reduction_strategy = "none"
+    with scratch_graph(params) as mesh:
+        inp = zeros(mesh, src.shape, src.dtype)
+        start = len(mesh.graph.operations)
+        block_part_fn(params, block_config, inp, '0')
+        operations = [op for op in mesh.graph.operations[start:] if not isinstance(op, mtf.Variable)]
+        return BlockCost(sum(_slice_bytes(params, t) for op in operations for t in op.outputs),
+                         _slice_bytes(params, inp),
+                         sum(operation_flops(op) for op in operations))
+
+
+def plan_memory_reduction(params: ModelParameter, src: mtf.Tensor) -> typing.List[typing.List[BlockConfig]]:
+    """
+    Greedily move blocks to a cheaper (in memory) strategy, always taking the step that frees the most bytes per
+    recomputed FLOP, until the whole body fits into params.memory_budget_per_core.
+    :param params: ModelParameter
+    :param src: input of the body
+    :return: block configs per depth, with memory_reduction_strategy filled in
+    """
+    unknown = [s for s in params.memory_planner_strategies if s not in STRATEGY_ORDER]
+    if unknown:
+        raise ValueError(f"memory_planner_strategies can only contain {STRATEGY_ORDER}, got {unknown}. "
+                         f"Reversible strategies change the model and have to be set as memory_reduction_strategy.")
+    strategies = [s for s in STRATEGY_ORDER if s in params.memory_planner_strategies]
+    if not strategies:
+        raise ValueError(f"memory_planner_strategies has to contain at least one of {STRATEGY_ORDER}")
+    costs = [block_cost(params, config, src) for config in params.block_config]
+    plan = [[0] * len(costs) for _ in range(params.depth)]
+
+    def _total_memory():
+        return sum(stored_bytes(costs[c], strategies[level[c]]) for level in plan for c in range(len(costs)))
+
+    memory = _total_memory()
+    while memory > params.memory_budget_per_core:
+        candidates = []
+        for c, cost in enumerate(costs):
+            for current in sorted({level[c] for level in plan if level[c] + 1 < len(strategies)}):
+                depth = next(d for d, level in enumerate(plan) if level[c] == current)
+                saved = stored_bytes(cost, strategies[current]) - stored_bytes(cost, strategies[current + 1])
+                extra = recomputed_flops(cost, strategies[current + 1]) - recomputed_flops(cost, strategies[current])
+                candidates.append((saved / max(extra, 1), -depth, c))
+        if not candidates:
+            color_print(params, f"WARNING: Activations need {memory / 2 ** 30:.2f}GiB per core even with "
+                                f"{strategies[-1]} everywhere, which exceeds the budget of "
+                                f"{params.memory_budget_per_core / 2 ** 30:.2f}GiB.")
+            break
+        _, depth, c = max(candidates)
+        plan[-depth][c] += 1
+        memory = _total_memory()
+
+    blocks = []
+    for level in plan:
+        blocks.append([])
+        for config, lvl in zip(params.block_config, level):
+            config = BlockConfig(config, "")
+            config.memory_reduction_strategy = strategies[lvl]
+            blocks[-1].append(config)
+
+    recompute = sum(recomputed_flops(costs[c], strategies[level[c]]) for level in plan for c in range(len(costs)))
+    counts = {s: sum(strategies[lvl] == s for level in plan for lvl in level) for s in strategies}
+    color_print(params, f"Memory plan: {counts}, {memory / 2 ** 30:.2f}GiB stored activations per core, "
+                        f"{recompute:.3e} recomputed FLOPs")
+    return blocks
@@ -1,24 +1,370 @@
+import re
 import typing
 
 import mesh_tensorflow as mtf
 import tensorflow as tf
 
 from .basic import activated_linear_in, activated_linear_out
+from .decode import cache_sequence, decoding, full_dim, position_mask, select_position
 from .embedding import embed
-from ..dataclass import BlockArgs
-from ..mtf_wrapper import einsum, greater_equal, multiply, less, exp, reduce_max, reduce_sum
-from ..utils_mtf import (anonymize, anonymize_dim, compare_range, get_attention_dim, is_masked, linear_shapes)
+from .. import tf_wrapper as tfw
+from ..dataclass import BlockArgs, ModelParameter
+from ..mtf_wrapper import einsum, greater_equal, multiply, less, exp, reduce_max, reduce_sum, mtf_slice
+from ..utils_core import random_name
+from ..utils_mtf import (anonymize_dim, compare_range, concat, get_attention_dim, is_masked,
+                         linear_shapes, range_comparison, replace_dim)
 
 ATTENTION_DIM = typing.NamedTuple("AttentionDim", (('index', int), ('dim', mtf.Dimension)))
 
 tf1 = tf.compat.v1
 
 
-def _masked_map(args: BlockArgs):
+_MAPS = ('biased_softmax', 'biased_attention_map', 'scale_attention_map')
+
+
+def _causal_mask(params: ModelParameter, dim: mtf.Dimension, comparison: typing.Callable) -> mtf.Tensor:
+    if decoding(params, dim):
+        return position_mask(params, comparison)
+    return compare_range(params, dim, anonymize_dim(dim), comparison)
+
+
+def _masked_map(args: BlockArgs, bias: mtf.Tensor):
     dim = get_attention_dim(args).dim
+    return bias, _causal_mask(args.params, dim, greater_equal) if is_masked(args) else 1
+
+
+def _block_size(args: BlockArgs) -> int:
+    for extra in args.name_extras:
+        if extra.startswith('blockwise:'):
+            return int(extra[len('blockwise:'):])
+    return 0
+
+
+def build_attention_masks(params: ModelParameter, shape: mtf.Shape):
+    """
+    Build the masks every attention layer of params.block_config asks for up front. Masks that are first built inside
+    a reversible or recomputed block are private to that block, so without this each block would build its own.
+    :param params: ModelParameter
+    :param shape: shape of the input of the body
+    """
+    attention_dims = (shape - params.feature_dims - params.intermediate)[1:]
+    for layer in (layer for config in params.block_config for layer in config.layer if 'attention' in layer):
+        extras = re.split('[-;]', layer)
+        block_size = max([int(extra[len('blockwise:'):]) for extra in extras if extra.startswith('blockwise:')] or [0])
+        softmax = 'dot_product' in extras or 'biased_softmax' in extras
+        for idx, dim in enumerate(attention_dims):
+            tiled = 0 < block_size < dim.size  # BlockwiseSoftmax masks its tiles itself
+            maps = 'biased_attention_map' in extras if tiled else any(name in extras for name in _MAPS)
+            comparisons = [less] * (softmax and not tiled)
+            comparisons += [greater_equal] * (maps and idx in params.masked_attention_dimensions)
+            sizes = {block_size, dim.size % block_size} - {0} if tiled else {dim.size}
+            for size in sizes:
+                for comparison in comparisons:
+                    range_comparison(params, mtf.Dimension(dim.name, size), anonymize_dim(dim, size), comparison)
+
+
+def _key_block(tensor: mtf.Tensor, tmp: mtf.Dimension, block_dim: mtf.Dimension, start: int) -> mtf.Tensor:
+    if tmp.name not in tensor.shape.dimension_names:
+        return tensor
+    return mtf_slice(tensor, start, block_dim.size, tmp.name)
+
+
+def _tile(tensor: tf.Tensor, shape: mtf.Shape, name: str, start: int, end: int) -> tf.Tensor:
+    if name not in shape.dimension_names:
+        return tensor
+    begin = [0] * shape.ndims
+    size = [-1] * shape.ndims
+    begin[shape.dimension_names.index(name)] = start
+    size[shape.dimension_names.index(name)] = end - start
+    return tfw.slice(tensor, begin, size)
+
+
+def _align(tensor: tf.Tensor, shape: mtf.Shape, target_shape: mtf.Shape) -> tf.Tensor:
+    """
+    Transpose and expand the slice of a tensor of shape, so that it broadcasts against slices of target_shape.
+    Dimensions are matched by name, as tiles are smaller than the dimensions they are cut from.
+    """
+    names = shape.dimension_names
+    tensor = tfw.transpose(tensor, [names.index(name) for name in target_shape.dimension_names if name in names])
+    for axis, name in enumerate(target_shape.dimension_names):
+        if name not in names:
+            tensor = tfw.expand_dims(tensor, axis)
+    return tensor
+
+
+def _tile_einsum(output_shape: mtf.Shape, *inputs: typing.Tuple[tf.Tensor, mtf.Shape]) -> tf.Tensor:
+    letters = {}
+    for name in [name for _, shape in inputs for name in shape.dimension_names] + output_shape.dimension_names:
+        letters.setdefault(name, chr(ord('a') + len(letters)))
+    equation = ','.join(''.join(letters[name] for name in shape.dimension_names) for _, shape in inputs)
+    return tfw.einsum(f"{equation}->{''.join(letters[name] for name in output_shape.dimension_names)}",
+                      *[tensor for tensor, _ in inputs])
+
+
+class BlockwiseSoftmax(mtf.Operation):
+    """
+    Causal softmax attention over tiles of block_size queries and block_size keys with a running (online) softmax.
+    Tiles are built one after another and only the output and the log-sum-exp of every query are kept, so that neither
+    this nor BlockwiseSoftmaxBackward holds more than one tile of logits at a time. Reversible and checkpointed blocks
+    recompute this single operation rather than one operation per tile.
+    tensors holds val and optionally qry and key, the bias of biased_softmax and the scale of scale_attention_map.
+    """
+
+    def __init__(self, dim: mtf.Dimension, logit_shape: mtf.Shape, shape: mtf.Shape, block_size: int,
+                 tensors: typing.Dict[str, mtf.Tensor]):
+        super().__init__(list(tensors.values()), name=random_name("blockwise_softmax"))
+        self.names = list(tensors)
+        self.dim = dim
+        self.tmp = anonymize_dim(dim)
+        self.logit_shape = logit_shape
+        self.query_tiles = [(start, min(start + block_size, dim.size)) for start in range(0, dim.size, block_size)]
+        # logits computed by the forward pass, including the masked ones of tiles on the diagonal
+        self.logits = logit_shape.size // dim.size ** 2 * sum((end - start) * (key_end - key_start)
+                                                              for start, end in self.query_tiles
+                                                              for key_start, key_end in self.key_tiles(end))
+        self._outputs = [mtf.Tensor(self, shape, tensors['val'].dtype),
+                         mtf.Tensor(self, logit_shape - [self.tmp], tf.float32)]
+
+    def key_tiles(self, query_end: int) -> typing.List[typing.Tuple[int, int]]:
+        return [(start, end) for start, end in self.query_tiles if start < query_end]
+
+    def shape(self, name: str) -> mtf.Shape:
+        return self.inputs[self.names.index(name)].shape
+
+    def map_tile(self, slices: typing.Dict[str, tf.Tensor], name: str, query: typing.Tuple[int, int],
+                 key: typing.Tuple[int, int]) -> tf.Tensor:
+        tensor = _tile(_tile(slices[name], self.shape(name), self.dim.name, *query), self.shape(name), self.tmp.name,
+                       *key)
+        return _align(tfw.cast(tensor, tf.float32), self.shape(name), self.logit_shape)
+
+    def tile_logits(self, slices: typing.Dict[str, tf.Tensor], logit_slice: typing.List[int],
+                    query: typing.Tuple[int, int], key: typing.Tuple[int, int]) -> tf.Tensor:
+        """
+        Float32 logits of one tile, with the keys after the last query of the tile masked out.
+        """
+        logit = None
+        if 'qry' in slices:
+            qry = _tile(slices['qry'], self.shape('qry'), self.dim.name, *query)
+            key_slice = _tile(slices['key'], self.shape('key'), self.tmp.name, *key)
+            logit = tfw.cast(_tile_einsum(self.logit_shape, (qry, self.shape('qry')), (key_slice, self.shape('key'))),
+                             tf.float32)
+        if 'bias' in slices:
+            bias = self.map_tile(slices, 'bias', query, key)
+            if logit is None:
+                sizes = {self.dim.name: query[1] - query[0], self.tmp.name: key[1] - key[0]}
+                logit = tfw.broadcast_to(bias, [sizes.get(name, size) for name, size in
+                                                zip(self.logit_shape.dimension_names, logit_slice)])
+            else:
+                logit += bias
+        if key[1] - 1 > query[0]:
+            mask = tfw.cast(tfw.greater(tfw.tf_range(*key, 1)[None, :], tfw.tf_range(*query, 1)[:, None]), tf.float32)
+            logit += _align(mask * -2e38, mtf.Shape([self.dim, self.tmp]), self.logit_shape)
+        return logit
+
+    def check_layout(self, mesh_impl: mtf.MeshImpl):
+        contracted = [dim for name in ('qry', 'key') if name in self.names for dim in self.shape(name).dims
+                      if dim not in self.logit_shape.dims]
+        for dim in [self.dim, self.tmp] + contracted:
+            if mesh_impl.tensor_dimension_to_mesh_axis(dim) is not None:
+                raise ValueError(f"Blockwise attention needs all of {dim.name} on every core.")
+
+    def gradient(self, grad_ys):
+        return BlockwiseSoftmaxBackward(self, grad_ys[0]).outputs
+
+    def lower(self, lowering):
+        mesh_impl = lowering.mesh_impl(self)
+        self.check_layout(mesh_impl)
+        out_shape = self.outputs[0].shape
+        logit_slice = mesh_impl.slice_shape(self.logit_shape)
+        tmp_axis = self.logit_shape.dimension_names.index(self.tmp.name)
+        val_shape = self.shape('val')
+
+        def slicewise_fn(*slices):
+            slices = dict(zip(self.names, slices))
+            outputs = []
+            stats = []
+            dependency = []
+            for query in self.query_tiles:
+                acc = total = maximum = None
+                for key in self.key_tiles(query[1]):
+                    with tf.control_dependencies(dependency):  # one tile after another
+                        logit = self.tile_logits(slices, logit_slice, query, key)
+                        new_max = tfw.reduce_max(logit, [tmp_axis], True)
+                        if maximum is not None:
+                            new_max = tfw.maximum(new_max, maximum)
+                        weight = tfw.exp(logit - new_max)
+                        block_total = tfw.reduce_sum(weight, [tmp_axis], True)
+                        if 'scale' in slices:
+                            weight *= self.map_tile(slices, 'scale', query, key)
+                        val = _tile(slices['val'], val_shape, self.tmp.name, *key)
+                        block_acc = tfw.cast(_tile_einsum(out_shape, (tfw.cast(weight, val.dtype), self.logit_shape),
+                                                          (val, val_shape)), tf.float32)
+                        if maximum is not None:
+                            correction = tfw.exp(maximum - new_max)
+                            block_total += total * correction
+                            block_acc += _tile_einsum(out_shape, (acc, out_shape), (correction, self.logit_shape))
+                    acc, total, maximum = block_acc, block_total, new_max
+                    dependency = [acc]
+                outputs.append(_tile_einsum(out_shape, (acc, out_shape), (1 / total, self.logit_shape)))
+                stats.append(tfw.squeeze(maximum + tfw.log(total), [tmp_axis]))
+            return (tfw.cast(tfw.concat(outputs, out_shape.dimension_names.index(self.dim.name)),
+                             self.outputs[0].dtype),
+                    tfw.concat(stats, self.outputs[1].shape.dimension_names.index(self.dim.name)))
+
+        out, stat = mesh_impl.slicewise(slicewise_fn, *[lowering.tensors[t] for t in self.inputs])
+        lowering.set_tensor_lowering(self.outputs[0], out)
+        lowering.set_tensor_lowering(self.outputs[1], stat)
+
+
+class BlockwiseSoftmaxBackward(mtf.Operation):
+    """
+    Gradients of BlockwiseSoftmax, recomputing its logits tile by tile from the saved log-sum-exp. With p the softmax,
+    out = sum(p * scale * val) and g = dy * val summed over the features, the logits get p * (scale * g - dy * out).
+    """
+
+    def __init__(self, forward: BlockwiseSoftmax, dy: mtf.Tensor):
+        super().__init__(forward.inputs + forward.outputs + [dy], name=random_name("blockwise_softmax_backward"))
+        self.forward = forward
+        self._outputs = [mtf.Tensor(self, t.shape, t.dtype) for t in forward.inputs]
+
+    def lower(self, lowering):
+        mesh_impl = lowering.mesh_impl(self)
+        forward = self.forward
+        forward.check_layout(mesh_impl)
+        names = forward.names
+        shapes = {name: t.shape for name, t in zip(names, self.inputs)}
+        out_shape, stat_shape = self.inputs[len(names)].shape, self.inputs[len(names) + 1].shape
+        logit_shape = forward.logit_shape
+        logit_slice = mesh_impl.slice_shape(logit_shape)
+        tmp_axis = logit_shape.dimension_names.index(forward.tmp.name)
+        dim, tmp = forward.dim.name, forward.tmp.name
+
+        def slicewise_fn(*slices):
+            inputs = dict(zip(names, slices))
+            out, stat, dy = slices[len(names):]
+            delta = tfw.expand_dims(_tile_einsum(stat_shape, (tfw.cast(dy, tf.float32), out_shape),
+                                                 (tfw.cast(out, tf.float32), out_shape)), tmp_axis)
+            stat = tfw.expand_dims(stat, tmp_axis)
+            grads = {name: {} for name in names}
+
+            def _accumulate(name: str, query: typing.Tuple[int, int], key: typing.Tuple[int, int],
+                            *tensors: typing.Tuple[tf.Tensor, mtf.Shape]) -> tf.Tensor:
+                index = (query if dim in shapes[name].dimension_names else None,
+                         key if tmp in shapes[name].dimension_names else None)
+                grad = tfw.cast(_tile_einsum(shapes[name], *tensors), tf.float32)
+                grads[name][index] = grad + grads[name][index] if index in grads[name] else grad
+                return grads[name][index]
+
+            dependency = []
+            for query in forward.query_tiles:
+                dy_tile = _tile(dy, out_shape, dim, *query)
+                qry = _tile(inputs['qry'], shapes['qry'], dim, *query) if 'qry' in inputs else None
+                for key in forward.key_tiles(query[1]):
+                    with tf.control_dependencies(dependency):  # one tile after another
+                        logit = forward.tile_logits(inputs, logit_slice, query, key)
+                        weight = tfw.exp(logit - _tile(stat, logit_shape, dim, *query))
+                        val = _tile(inputs['val'], shapes['val'], tmp, *key)
+                        grad = tfw.cast(_tile_einsum(logit_shape, (dy_tile, out_shape), (val, shapes['val'])),
+                                        tf.float32)
+                        val_weight = weight
+                        if 'scale' in inputs:
+                            _accumulate('scale', query, key, (weight * grad, logit_shape))
+                            scale = forward.map_tile(inputs, 'scale', query, key)
+                            grad *= scale
+                            val_weight *= scale
+                        grad = weight * (grad - _tile(delta, logit_shape, dim, *query))
+                        tiles = [_accumulate('val', query, key, (tfw.cast(val_weight, val.dtype), logit_shape),
+                                             (dy_tile, out_shape))]
+                        if 'bias' in inputs:
+                            tiles.append(_accumulate('bias', query, key, (grad, logit_shape)))
+                        if qry is not None:
+                            key_slice = _tile(inputs['key'], shapes['key'], tmp, *key)
+                            low_precision = tfw.cast(grad, qry.dtype)
+                            tiles.append(_accumulate('qry', query, key, (low_precision, logit_shape),
+                                                     (key_slice, shapes['key'])))
+                            tiles.append(_accumulate('key', query, key, (low_precision, logit_shape),
+                                                     (qry, shapes['qry'])))
+                    dependency = tiles
+
+            outputs = []
+            for name, tensor in zip(names, slices):
+                shape = shapes[name]
+                rows = forward.query_tiles if dim in shape.dimension_names else [None]
+                columns = forward.query_tiles if tmp in shape.dimension_names else [None]
+                tiles = []
+                for query in rows:
+                    row = []
+                    for key in columns:
+                        if (query, key) in grads[name]:
+                            row.append(grads[name][query, key])
+                            continue
+                        sizes = {dim: query[1] - query[0], tmp: key[1] - key[0]}  # above the diagonal
+                        row.append(tfw.zeros([sizes.get(n, size) for n, size in
+                                              zip(shape.dimension_names, tensor.shape.as_list())], tf.float32))
+                    tiles.append(tfw.concat(row, shape.dimension_names.index(tmp)) if len(row) > 1 else row[0])
+                grad = tfw.concat(tiles, shape.dimension_names.index(dim)) if len(tiles) > 1 else tiles[0]
+                outputs.append(tfw.cast(grad, tensor.dtype))
+            return tuple(outputs)
+
+        grads = mesh_impl.slicewise(slicewise_fn, *[lowering.tensors[t] for t in self.inputs])
+        for grad, tensor, output in zip(grads, self.inputs, self.outputs):
+            reduced = {mesh_impl.tensor_dimension_to_mesh_axis(d) for d in logit_shape.dims + out_shape.dims
+                       if d not in tensor.shape.dims} - {None}
+            if reduced:  # e.g. the batch for the bias, as every core holds only a part of it
+                grad = mesh_impl.allreduce(grad, sorted(reduced), "SUM")
+            lowering.set_tensor_lowering(output, grad)
+
+
+def _blockwise_map(args: BlockArgs, dim: mtf.Dimension, val: mtf.Tensor, maps: typing.Dict[str, mtf.Tensor],
+                   block_size: int) -> mtf.Tensor:
+    """
+    biased_attention_map (times scale_attention_map) applied tile by tile, skipping tiles above the diagonal of masked
+    dimensions. The map doesn't depend on the batch, so no tile is larger than the map itself.
+    """
+    params = args.params
     tmp = anonymize_dim(dim)
-    bias = embed(args, [args.params.head_dim, dim, tmp])
-    return bias, compare_range(args.params, dim, tmp, greater_equal) if is_masked(args) else 1
+    masked = is_masked(args)
+    outputs = []
+    for query_start in range(0, dim.size, block_size):
+        query_dim = mtf.Dimension(dim.name, min(block_size, dim.size - query_start))
+        shape = replace_dim(args.tensor.shape, query_dim, dim)
+        query_maps = [mtf_slice(maps[name], query_start, query_dim.size, dim.name)
+                      for name in ('biased_attention_map', 'scale_attention_map') if name in maps]
+        out = 0
+        for start in range(0, query_start + query_dim.size if masked else tmp.size, block_size):
+            block_dim = anonymize_dim(dim, min(block_size, tmp.size - start))
+            weight = [_key_block(m, tmp, block_dim, start) for m in query_maps]
+            if masked and start + block_dim.size - 1 > query_start:
+                weight.append(compare_range(params, query_dim, block_dim, greater_equal, query_start, start))
+            weight = weight[0] if len(weight) == 1 else einsum(weight, output_shape=weight[0].shape)
+            out += einsum([weight, _key_block(val, tmp, block_dim, start)], shape)
+        outputs.append(out)
+    return concat(outputs, dim)
+
+
+def _blockwise_attention(args: BlockArgs, dim: mtf.Dimension, logit_shape: mtf.Shape, qry: mtf.Tensor,
+                         key: mtf.Tensor, val: mtf.Tensor, maps: typing.Dict[str, mtf.Tensor],
+                         block_size: int) -> mtf.Tensor:
+    """
+    Attention over tiles of block_size queries and block_size keys, so that at most [..., block_size, block_size]
+    logits exist at a time instead of [..., dim, dim]. The softmax is a single BlockwiseSoftmax, which stores only
+    activations linear in the sequence length for the backward pass, on its own as well as inside reversible or
+    checkpointed blocks.
+    The softmax is causal, so tiles above the diagonal are never built. The same holds for the attention maps when the
+    dimension is masked. Only tiles on the diagonal need a mask at all.
+    """
+    out = 0
+    if 'dot_product' in args or 'biased_softmax' in maps:
+        tensors = {'qry': qry, 'key': key} if 'dot_product' in args else {}
+        tensors['val'] = val
+        if 'biased_softmax' in maps:
+            tensors['bias'] = maps['biased_softmax']
+        if 'scale_attention_map' in maps:
+            tensors['scale'] = maps['scale_attention_map']
+        out = BlockwiseSoftmax(dim, logit_shape, args.tensor.shape, block_size, tensors).outputs[0]
+    if 'biased_attention_map' in maps:
+        out += _blockwise_map(args, dim, val, maps, block_size)
+    return out
 
 
 def attention(args: BlockArgs):
@@ -26,38 +372,50 @@ def attention(args: BlockArgs):
     if "dot_product" in args or "input_as_value" not in args:
         base = args(activated_linear_in(args))
 
-    dim = get_attention_dim(args).dim
+    dim = full_dim(args.params, get_attention_dim(args).dim)
     tmp = anonymize_dim(dim)
     shape = args.tensor.shape
+    logit_shape = shape - (mtf.Shape(linear_shapes(args).old) - [args.params.head_dim]) + tmp
 
-    logit = 0
+    qry = 0
     val = 0
     key = 0
     if 'dot_product' in args:
         if 'embedded' in args or 'context' in args:
             key = activated_linear_out(base)
         if 'embedded' in args or 'positional' in args:
-            key += embed(args, [dim] + args.params.feature_dims)
+            key += select_position(args.params, embed(args, [dim] + args.params.feature_dims), dim)
         qry = activated_linear_out(base)
         qry *= dim.size ** -0.5
-        logit_shape = shape - (mtf.Shape(linear_shapes(args).old) - [args.params.head_dim]) + tmp
-        logit = einsum([qry, anonymize(key, dim)], output_shape=logit_shape)
+        key = cache_sequence(args.params, key, dim)
         if "shared_key_value" in args:
             val = key
-    if 'biased_softmax' in args:
-        logit += multiply(*_masked_map(args))
+    maps = {name: select_position(args.params, embed(args, [args.params.head_dim, dim, tmp]), dim)
+            for name in _MAPS if name in args}
+    if val == 0:
+        val = cache_sequence(args.params, args.tensor if "input_as_value" in args else activated_linear_out(base),
+                             dim)
+    if 'dot_product' not in args and not maps:
+        raise UserWarning(f"WARNING: There is no spatial mixing happening with the following attention parameters: "
+                          f"{args.name_extras}.")
+
+    block_size = _block_size(args)
+    blockwise = 'dot_product' in args or 'biased_softmax' in maps or 'biased_attention_map' in maps
+    if 0 < block_size < tmp.size and blockwise and not decoding(args.params, dim):  # a single query needs no tiles
+        return _blockwise_attention(args, dim, logit_shape, qry, key, val, maps, block_size)
+
+    logit = 0
+    if 'dot_product' in args:
+        logit = einsum([qry, key], output_shape=logit_shape)
+    if 'biased_softmax' in maps:
+        logit += multiply(*_masked_map(args, maps['biased_softmax']))
     if logit != 0:
-        logit += (compare_range(args.params, dim, tmp, less) * 1e38) * -2
+        logit += (_causal_mask(args.params, dim, less) * 1e38) * -2
         logit -= mtf.stop_gradient(reduce_max(logit, reduced_dim=tmp))
         logit = exp(logit)
         logit /= reduce_sum(logit, reduced_dim=tmp)
-    if 'biased_attention_map' in args:
-        logit += multiply(*_masked_map(args))
-    if 'scale_attention_map' in args:
-        logit *= multiply(*_masked_map(args))
-    if val == 0:
-        val = anonymize(args.tensor if "input_as_value" in args else activated_linear_out(base), dim)
-    if not logit:
-        raise UserWarning(f"WARNING: There is no spatial mixing happening with the following attention parameters: "
-                          f"{args.name_extras}.")
+    if 'biased_attention_map' in maps:
+        logit += multiply(*_masked_map(args, maps['biased_attention_map']))
+    if 'scale_attention_map' in maps:
+        logit *= multiply(*_masked_map(args, maps['scale_attention_map']))
     return einsum([logit, val], shape)
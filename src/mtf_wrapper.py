@@ -39,6 +39,27 @@ def reduce_max(tensor: mtf.Tensor, output_shape: OPT_SHAPE = None, reduced_dim:
     return scoped("reduce_max", mtf.reduce_max, tensor, None, output_shape, reduced_dim)
 
 
+def reduce_min(tensor: mtf.Tensor, output_shape: OPT_SHAPE = None, reduced_dim: OPT_DIM = None) -> mtf.Tensor:
+    return scoped("reduce_min", mtf.reduce_min, tensor, None, output_shape, reduced_dim)
+
+
+def top_k(tensor: mtf.Tensor, reduced_dim: mtf.Dimension, k_dim: mtf.Dimension
+          ) -> typing.Tuple[mtf.Tensor, mtf.Tensor]:
+    return scoped("top_k", mtf.top_k, tensor, reduced_dim, k_dim)
+
+
+def stack(xs: TENSORS, dim_name: str, axis: int = 0) -> mtf.Tensor:
+    return scoped("stack", mtf.stack, xs, dim_name, axis)
+
+
+def unstack(tensor: mtf.Tensor, dim: mtf.Dimension) -> typing.List[mtf.Tensor]:
+    return scoped("unstack", mtf.unstack, tensor, dim)
+
+
+def cumsum(tensor: mtf.Tensor, dim: mtf.Dimension, exclusive: bool = False) -> mtf.Tensor:
+    return scoped("cumsum", mtf.cumsum, tensor, dim, exclusive)
+
+
 def reduce_logsumexp(tensor: mtf.Tensor, reduced_dim: OPT_DIM = None) -> mtf.Tensor:
     return scoped("reduce_logsumexp", mtf.reduce_logsumexp, tensor, reduced_dim)
 
@@ -184,7 +205,7 @@ def negative(tensor: mtf.Tensor):
     return scoped("negative", lambda x: -x, tensor)
 
 
-def floordiv(x1: mtf.Tensor, x2: mtf.Tensor) -> mtf.Tensor:
+def floordiv(x1: mtf.Tensor, x2: typing.Union[mtf.Tensor, int]) -> mtf.Tensor:
     return scoped("floordiv", lambda x, y: x // y, x1, x2)
 
 
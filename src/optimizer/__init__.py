@@ -13,8 +13,9 @@ from .context import OptimizerCtx
 from .context import OptimizerCtx
 from .gradients import MULTI_LOSS_GRADIENTS
 from .learning_rate import get_learning_rate
-from .optimizers import OPTIMIZERS
+from .optimizers import OPTIMIZERS, SPARSE_OPTIMIZERS, gather_rows, scatter_rows
 from ..dataclass import ModelParameter
+from ..model.embedding import SparseGradient, SparseRows
 from ..mtf_wrapper import (cast, constant_float, constant_scalar, einsum, equal, greater_equal, mod, reduce_sum, assign,
                            add, multiply, scoped, identity, zeros_like, negative, optimizer_scalar, reciprocal,
                            reduce_mean, broadcast, assign_sub, assign_add)
@@ -30,10 +31,14 @@ def gradient_accumulation(ctx: OptimizerCtx):
 
 def update(ctx: OptimizerCtx):
     params = ctx.params
-    update_ops = ctx.update_ops
     learning_rate = ctx.learning_rate
 
     var = ctx.var
+    gradient = ctx.sparse_gradients.get(var)
+    if (params.sparse_embedding_updates and gradient is not None and ctx.grad_buffer is None
+            and all(opt.split(':')[0] in SPARSE_OPTIMIZERS for opt in params.optimizer.split('-'))):
+        return sparse_update(ctx, gradient)
+
     if ctx.grad_buffer is not None:
         ctx.grad = reduce_mean(broadcast(identity(ctx.grad_buffer.value), [params.batch_dim] + ctx.grad.shape.dims),
                                params.batch_dim)
@@ -46,6 +51,40 @@ def update(ctx: OptimizerCtx):
     if 'rezero' in var.name:
         ctx.grad *= params.rezero_lr_multiplier
 
+    if weight_decayed(params, var):
+        ctx.grad += einsum([cast(var.value, params.optimizer_calculation_dtype), learning_rate,
+                            optimizer_scalar(params, params.weight_decay)], output_shape=var.shape)
+
+    ctx.update_ops.append(assign_sub(ctx.var, ctx.grad))
+
+
+def sparse_update(ctx: OptimizerCtx, gradient: SparseGradient):
+    """
+    Lazy version of update for gradients of a Gather. Only the gathered rows of the variable and its optimizer states
+    are read and written, rows without gradient keep their optimizer states until they are gathered again.
+    """
+    params = ctx.params
+    var = ctx.var
+    _, indices, _ = gradient.inputs
+    row_dim = mtf.Dimension("sparse_rows", (indices.shape - gradient.squeeze_dims).size)
+    ctx.sparse_gradient = gradient
+    ctx.sparse_rows, grad, ctx.sparse_mask = SparseRows(gradient, row_dim).outputs
+    ctx.grad = cast(grad, params.optimizer_calculation_dtype)
+
+    for opt in params.optimizer.split('-'):
+        opt, *args = opt.split(':')
+        ctx.grad = scoped(opt, SPARSE_OPTIMIZERS[opt], ctx, *args)
+
+    if weight_decayed(params, var):
+        ctx.grad += einsum([gather_rows(ctx, var.value), ctx.learning_rate,
+                            optimizer_scalar(params, params.weight_decay)], output_shape=ctx.grad.shape)
+
+    ctx.update_ops.append(scatter_rows(ctx, var.outputs[0], negative(ctx.grad)))
+
+
+def weight_decayed(params: ModelParameter, var: mtf.Variable) -> bool:
+    if params.weight_decay <= 0:
+        return False
     features_used = feature_dims_used(params, var)
     large_tensor = features_used and len(var.shape.dims) > len(params.feature_dims)
     large_tensor |= not features_used and len(var.shape.dims) >= 2  # not norm or rezero + scalable catch-all
@@ -55,12 +94,7 @@ def update(ctx: OptimizerCtx):
     large_tensor &= "embed" not in var.name  # not input/output embedding, position embedding, attention map bias
     large_tensor &= "input" not in var.name or "lang_in" in var.name or "vid_in" in var.name  # not input
     large_tensor &= "output" not in var.name or "lang_out" in var.name or "vid_out" in var.name  # not output
-
-    if large_tensor and params.weight_decay > 0:
-        ctx.grad += einsum([cast(var.value, params.optimizer_calculation_dtype), learning_rate,
-                            optimizer_scalar(params, params.weight_decay)], output_shape=var.shape)
-
-    update_ops.append(assign_sub(ctx.var, ctx.grad))
+    return large_tensor
 
 
 def get_optimizer(loss_list: typing.List[mtf.Tensor], params: ModelParameter, manual_step: mtf.Tensor, fn: str
@@ -125,7 +159,7 @@ def get_optimizer(loss_list: typing.List[mtf.Tensor], params: ModelParameter, ma
         operations = loss.graph.operations
         xs = [x.outputs[0] for x in params.mesh.graph.trainable_variables]
         tensor_to_var = dict(zip(xs, params.mesh.graph.trainable_variables))
-        loss_grad = constant_scalar(params, 1.0)
+        params.loss_gradient = loss_grad = constant_scalar(params, 1.0)
         downstream = set(xs)
 
         for op in operations:
@@ -161,12 +195,15 @@ def get_optimizer(loss_list: typing.List[mtf.Tensor], params: ModelParameter, ma
                     else:
                         tensor_to_gradient[inp] = [0, 1, grad, inner_op]
 
+    params.loss_gradient = None
     ctx = OptimizerCtx(op, grad_outputs, downstream, tensor_to_gradient, tensor_to_var, params,
                        loss_idx, update_ops, {}, loss_list, first_grad,
                        loss_1__loss_1, loss_1__loss_2, loss_2__loss_2, mstep, step, neg_step, dtype,
                        beta1, beta2, learning_rate, step_count)
     ctx.variable_to_gradient = {var: cast(tensor_to_gradient[tensor][2], params.optimizer_calculation_dtype)
                                 for tensor, var in tensor_to_var.items()}
+    ctx.sparse_gradients = {var: tensor_to_gradient[tensor][2].operation for tensor, var in tensor_to_var.items()
+                            if isinstance(tensor_to_gradient[tensor][2].operation, SparseGradient)}
     for tensor, var in tensor_to_var.items():
         update(ctx(tensor, var, ctx.variable_to_gradient[var]))
     if params.combine_assignments:
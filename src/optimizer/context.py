@@ -47,6 +47,11 @@ class OptimizerCtx:
 
         self.global_norm_reciprocal: typing.Optional[mtf.Tensor] = None
 
+        self.sparse_gradients: typing.Dict[mtf.Variable, mtf.Operation] = {}
+        self.sparse_gradient: typing.Optional[mtf.Operation] = None
+        self.sparse_rows: typing.Optional[mtf.Tensor] = None
+        self.sparse_mask: typing.Optional[mtf.Tensor] = None
+
     def __call__(self, tensor: mtf.Tensor, var: mtf.Variable, grad: mtf.Tensor):
         self.var = var
         self.tensor = tensor
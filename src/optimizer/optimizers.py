@@ -2,6 +2,8 @@ import mesh_tensorflow as mtf
 
 from .backend import variable
 from .context import OptimizerCtx
+from ..dataclass import BlockArgs
+from ..model.embedding import Gather, scatter_add
 from ..mtf_wrapper import (cast, optimizer_scalar, einsum, minimum,
                            reduce_mean, reduce_sum, assign, add, multiply, maximum, reciprocal, square,
                            reduce_max, rsqrt, sqrt, add_n, negative, pow as mtf_pow)
@@ -33,6 +35,31 @@ def adam(ctx: OptimizerCtx) -> mtf.Tensor:
                    debias_momentum(ctx, ctx.beta1)], output_shape=grad.shape)
 
 
+def gather_rows(ctx: OptimizerCtx, tensor: mtf.Tensor) -> mtf.Tensor:
+    gather = Gather(BlockArgs(ctx.params, ctx.sparse_rows, ['']), tensor, ctx.sparse_gradient.squeeze_dims)
+    return cast(gather.outputs[0], ctx.params.optimizer_calculation_dtype)
+
+
+def scatter_rows(ctx: OptimizerCtx, tensor: mtf.Tensor, delta: mtf.Tensor) -> mtf.Assign:
+    delta = multiply(delta, ctx.sparse_mask)
+    return assign(tensor, scatter_add(tensor, ctx.sparse_rows, delta, ctx.sparse_gradient.squeeze_dims))
+
+
+def sparse_adam(ctx: OptimizerCtx) -> mtf.Tensor:
+    exp_avg_p2_ptr = variable(ctx.params, ctx.var, 'exp_avg_p2', ctx.var.shape)
+    exp_avg_p1_ptr = variable(ctx.params, ctx.var, 'exp_avg_p1', ctx.var.shape)
+    exp_avg_p2_rows = gather_rows(ctx, exp_avg_p2_ptr)
+    exp_avg_p1_rows = gather_rows(ctx, exp_avg_p1_ptr)
+
+    exp_avg_p2 = weighted_add(exp_avg_p2_rows, square(ctx.grad), ctx.beta2)
+    grad = weighted_add(exp_avg_p1_rows, ctx.grad, ctx.beta1)
+
+    ctx.update_ops.append(scatter_rows(ctx, exp_avg_p2_ptr, exp_avg_p2 - exp_avg_p2_rows))
+    ctx.update_ops.append(scatter_rows(ctx, exp_avg_p1_ptr, grad - exp_avg_p1_rows))
+    return einsum([opt_rsqrt(debias(ctx, exp_avg_p2, ctx.beta2)), grad,
+                   debias_momentum(ctx, ctx.beta1)], output_shape=grad.shape)
+
+
 def novograd(ctx: OptimizerCtx) -> mtf.Tensor:
     if ctx.var.shape.ndims == 0:
         return adam(ctx)
@@ -133,6 +160,13 @@ OPTIMIZERS = {"adam": adam,
               }
 
 
+# Optimizers that work on the gathered rows of a SparseGradient, see sparse_update.
+SPARSE_OPTIMIZERS = {"adam": sparse_adam,
+                     "value_clip": value_gradient_clipping,
+                     "learning_rate": multiply_learning_rate
+                     }
+
+
 def graft(ctx: OptimizerCtx, optimizer: str, *params: str) -> mtf.Tensor:
     return einsum([ctx.grad, rsqrt(reduce_sum(square(ctx.grad))),
                    sqrt(reduce_sum(square(OPTIMIZERS[optimizer](ctx, *params))))],
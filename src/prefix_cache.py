@@ -0,0 +1,94 @@
+"""
+Host-side cache of the decode states of earlier prompts. Serving traffic often shares long prompt prefixes, and a
+prompt that starts with a cached prefix resumes sampling from the stored states instead of prefilling again.
+"""
+import collections
+import typing
+
+import numpy as np
+
+
+class PrefixCache:
+    def __init__(self, budget: int, shorter_prefixes: bool, max_replay: int):
+        self.budget = budget  # bytes
+        self.shorter_prefixes = shorter_prefixes  # states also resume prompts that share only part of the prefix
+        self.max_replay = max_replay  # prompt tokens sampling may step through after resuming
+        self.entries = collections.OrderedDict()  # (position, hash of prefix) -> (prefix, states), least recent first
+        self.size = 0
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+
+    def __repr__(self) -> str:
+        return (f"prefix cache: {self.hits}/{self.lookups} hits ({self.hits / max(self.lookups, 1):.1%}), "
+                f"{self.reused_tokens}/{self.prompt_tokens} prompt tokens reused, "
+                f"{len(self.entries)} entries in {self.size / 2 ** 20:.1f}MiB")
+
+    def _resume_position(self, prefix: np.ndarray, position: int, tokens: np.ndarray, initial_pos: int) -> int:
+        """
+        Position a prompt can resume at from states that were prefilled at position after prefix, 0 if none.
+        """
+        if not self.shorter_prefixes:
+            return position if position <= initial_pos and np.array_equal(tokens[:position - 1], prefix) else 0
+        length = min(position, initial_pos) - 1
+        mismatch = np.flatnonzero(tokens[:length] != prefix[:length])
+        shared = int(mismatch[0]) if mismatch.size else length
+        return shared + 1 if shared else 0
+
+    def lookup(self, tokens: typing.List[np.ndarray], initial_pos: typing.List[int]
+               ) -> typing.Tuple[int, typing.Optional[typing.List[typing.List[np.ndarray]]]]:
+        """
+        All prompts of a batch start at the same position, so either every prompt resumes at one position or none.
+        :param tokens: flat tokens of every prompt
+        :param initial_pos: position of the first sampled token of every prompt
+        :return: position to resume at and the states of every prompt, or 0 and None
+        """
+        self.lookups += len(tokens)
+        self.prompt_tokens += sum(initial_pos) - len(initial_pos)
+        resumable = [{} for _ in tokens]  # position -> key of an entry every prompt can resume at
+        for key, (prefix, _) in self.entries.items():
+            for row, (row_tokens, row_pos) in enumerate(zip(tokens, initial_pos)):
+                position = self._resume_position(prefix, key[0], row_tokens, row_pos)
+                if position:
+                    resumable[row][position] = key
+        if not all(resumable):
+            return 0, None
+
+        if self.shorter_prefixes:  # every prompt can resume at any position before its best one
+            position = min(max(row) for row in resumable)
+            keys = [row[max(row)] for row in resumable]
+        else:
+            positions = set.intersection(*[set(row) for row in resumable])
+            if not positions:
+                return 0, None
+            position = max(positions)
+            keys = [row[position] for row in resumable]
+        if min(initial_pos) - position > self.max_replay:
+            return 0, None
+
+        for key in keys:
+            self.entries.move_to_end(key)
+        self.hits += len(tokens)
+        self.reused_tokens += (position - 1) * len(tokens)
+        return position, [self.entries[key][1] for key in keys]
+
+    def store(self, tokens: np.ndarray, position: int, states: typing.List[np.ndarray]):
+        """
+        Keep the states one prompt was prefilled with at position, evicting the least recently used entries.
+        """
+        if position <= 1:
+            return
+        prefix = tokens[:position - 1].copy()
+        key = (position, hash(prefix.tobytes()))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        size = prefix.nbytes + sum(state.nbytes for state in states)
+        if size > self.budget:
+            return
+        self.entries[key] = (prefix, [state.copy() for state in states])
+        self.size += size
+        while self.size > self.budget:
+            prefix, states = self.entries.popitem(last=False)[1]
+            self.size -= prefix.nbytes + sum(state.nbytes for state in states)
@@ -1,9 +1,17 @@
+import asyncio
+import functools
+import json
 import multiprocessing
+import threading
 import typing
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import uvicorn
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 from transformers import GPT2TokenizerFast
 
 from .dataclass import ModelParameter
@@ -38,6 +46,18 @@ class RestAPI:
         self._interface = InterfaceWrapper(params)
         self._params = params
         self._tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
+        # Everything that blocks runs in these pools, so that the event loop keeps accepting requests.
+        self._requests = ThreadPoolExecutor(params.web_max_concurrent_requests)
+        self._tokenizer_pool = ThreadPoolExecutor(params.web_tokenizer_threads)
+        self._request_slots = threading.BoundedSemaphore(params.web_max_concurrent_requests)
+
+    async def _run(self, pool: ThreadPoolExecutor, fn: typing.Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(fn, *args))
+
+    def _acquire_request_slot(self):
+        if not self._request_slots.acquire(blocking=False):
+            raise HTTPException(status_code=429, detail=f"Too many requests. This worker handles up to "
+                                                        f"{self._params.web_max_concurrent_requests} at once.")
 
     async def check_tokens(self, tokens: typing.List[int], error: bool = True) -> SanitizedTokens:
         if tokens and max(tokens) > self._params.vocab_size:
@@ -53,23 +73,48 @@ class RestAPI:
         return SanitizedTokens(tokens=tokens)
 
     async def encode(self, prompt: str) -> Tokens:
-        out = list(prompt.encode()) if self._params.vocab_size == 256 else self._tokenizer.encode(prompt)
-        return Tokens(tokens=out)
+        if self._params.vocab_size == 256:
+            return Tokens(tokens=list(prompt.encode()))
+        return Tokens(tokens=await self._run(self._tokenizer_pool, self._tokenizer.encode, prompt))
 
     async def decode(self, prompt: typing.List[int]) -> Completion:
-        out = ''.join(chr(c) for c in prompt) if self._params.vocab_size == 256 else self._tokenizer.encode(prompt)
-        return Completion(completion=out)
+        if self._params.vocab_size == 256:
+            return Completion(completion=''.join(chr(c) for c in prompt))
+        return Completion(completion=await self._run(self._tokenizer_pool, self._tokenizer.decode, prompt))
 
     async def token_completion(self, params: CompletionInput) -> TokenCompletion:
         tokens = (await self.encode(params.prompt)).tokens
         tokens = (await self.check_tokens(tokens, params.error)).tokens
-        out = self._interface.complete(tokens, params.temperature, len(tokens) + params.max_tokens)
-        out = out.tolist()[:params.max_tokens]
-        return TokenCompletion(token_completion=out)
+        self._acquire_request_slot()
+        try:
+            out = await self._run(self._requests, self._interface.complete, tokens, params.temperature,
+                                  params.max_tokens)
+        finally:
+            self._request_slots.release()
+        return TokenCompletion(token_completion=out.tolist())
 
     async def completion(self, params: CompletionInput) -> Completion:
         return await self.decode((await self.token_completion(params)).token_completion)
 
+    async def stream_token_completion(self, params: CompletionInput) -> StreamingResponse:
+        """
+        Server-sent events with one TokenCompletion per TPU call, so the first tokens arrive before the response is
+        done.
+        """
+        tokens = (await self.encode(params.prompt)).tokens
+        tokens = (await self.check_tokens(tokens, params.error)).tokens
+        self._acquire_request_slot()
+
+        def _events():  # iterated in starlette's thread pool, so waiting for the TPU doesn't block the event loop
+            for chunk in self._interface.stream(tokens, params.temperature, params.max_tokens):
+                yield f"data: {json.dumps({'token_completion': chunk.tolist()})}\n\n"
+
+        events = _events()
+        # A generator that never started doesn't run its finally, e.g. if the client disconnected before the first
+        # chunk. The slot is released once, after the response or when the generator is collected, whichever is first.
+        release = weakref.finalize(events, self._request_slots.release)
+        return StreamingResponse(events, media_type="text/event-stream", background=BackgroundTask(release))
+
 
 def get_api_input_and_output_fn(params: ModelParameter):
     rest_api = RestAPI(params)
@@ -79,7 +124,8 @@ def get_api_input_and_output_fn(params: ModelParameter):
         if key.startswith('_') or key.endswith('_'):
             continue
         fn = getattr(rest_api, key)
-        fast_api.post('/' + key, response_model=typing.get_type_hints(fn)["return"])(fn)
+        response_model = typing.get_type_hints(fn)["return"]
+        fast_api.post('/' + key, response_model=None if response_model is StreamingResponse else response_model)(fn)
 
     run = multiprocessing.Process(target=uvicorn.run, daemon=True, args=(fast_api,),
                                   kwargs={'host': '0.0.0.0', 'port': 62220, 'log_level': 'info',
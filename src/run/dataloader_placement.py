@@ -1,7 +1,9 @@
 import collections
 import json
+import typing
 
 import jsonpickle
+import mesh_tensorflow as mtf
 import numpy as np
 import tensorflow as tf
 from tensorflow.python.framework import ops
@@ -9,6 +11,7 @@ from tensorflow.python.tpu import tpu_feed
 
 from .. import tf_wrapper as tfw
 from ..dataclass import ModelParameter
+from ..utils_mtf import slice_for_cores
 
 tf1 = tf.compat.v1
 Dataset = tf1.data.Dataset
@@ -185,8 +188,11 @@ def place_dataloader(params: ModelParameter, input_fn):
                 sub_batch_pnums = all_sub_batch_pnums[input_i]
                 mtf_input_shape = params.input_pipeline_shape[input_i]
 
-                # Initialize the cache for each input_i
-                _slice_dict = collections.defaultdict(list)
+                # Initialize the cache for each input_i. Cores that hold the same slice (replicated dimensions)
+                # share one slice op instead of cutting the same window out of the host tensor again.
+                _slice_dict = {}
+                s_shape = params.mesh_impl.slice_shape(mtf_input_shape)
+                s_shape[0] = s_shape[0] * macro_batching_multi
 
                 for idx, pnum in enumerate(sub_batch_pnums):
 
@@ -195,14 +201,11 @@ def place_dataloader(params: ModelParameter, input_fn):
                         # Always slice from 0 in the first dimension (batch dimension), since
                         # input_tensor a sub-batch tensor.
                         s_begin[0] = 0
-                    if tuple(s_begin) in _slice_dict:
-                        input_slice = _slice_dict[tuple(s_begin)]
-                    else:
-                        s_shape = params.mesh_impl.slice_shape(mtf_input_shape)
-                        s_shape[0] = s_shape[0] * macro_batching_multi
-                        input_slice = tfw.slice(input_tensor, s_begin, s_shape)
+                    s_begin = tuple(s_begin)
+                    if s_begin not in _slice_dict:
+                        _slice_dict[s_begin] = tfw.slice(input_tensor, list(s_begin), s_shape)
 
-                    all_laidout_tensors[pnum][input_i] = input_slice
+                    all_laidout_tensors[pnum][input_i] = _slice_dict[s_begin]
 
     # Make sure that there are no Nones in all_laidout_tensors.
     for laidout_tensors in all_laidout_tensors:
@@ -231,7 +234,7 @@ def place_dataloader(params: ModelParameter, input_fn):
     return input_initializers, enqueue_ops, infeed_queue
 
 
-def infeed_from_session(params: ModelParameter):
+def infeed_from_session(params: ModelParameter, decode_state_shapes: typing.List[mtf.Shape] = ()):
     num_cores = params.mesh_impl.device_assignment.num_replicas
     d_assignment = params.mesh_impl.device_assignment
     ordered_ordinals = []
@@ -252,11 +255,24 @@ def infeed_from_session(params: ModelParameter):
         return ordered_hosts[pnum]
 
     prompt = tf1.placeholder(dtype=tf.int32, shape=[t.size for t in params.token_dim_shape])
-    iter_pos = tf1.placeholder(dtype=tf.int32, shape=[1])
-    samp_temp = tf1.placeholder(dtype=tf.float32, shape=[1])
-    end_iter = tf1.placeholder(dtype=tf.int32, shape=[1])
-
-    all_laidout_tensors = [[prompt, prompt, iter_pos, samp_temp, end_iter] for _ in range(params.num_cores)]
+    iter_pos = tf1.placeholder(dtype=tf.int32, shape=[params.train_batch_size])
+    samp_temp = tf1.placeholder(dtype=tf.float32, shape=[params.train_batch_size])
+    end_iter = tf1.placeholder(dtype=tf.int32, shape=[params.train_batch_size])
+    place_holders = [prompt, iter_pos, samp_temp, end_iter]
+    shapes = [params.token_dim_shape] + [mtf.Shape([params.batch_dim])] * 3
+    if decode_state_shapes:
+        # Decode states of a prefix cache hit. Without a hit, nothing is fed and the model prefills.
+        place_holders.append(tf1.placeholder_with_default(tf.constant(0, tf.int32), []))
+        place_holders.extend(tf1.placeholder_with_default(tf.zeros(shape.to_integer_list, tf.float32),
+                                                          shape.to_integer_list)
+                             for shape in decode_state_shapes)
+        shapes.append(mtf.Shape([]))
+        shapes.extend(decode_state_shapes)
+
+    # Every core gets only its own slice, just like place_dataloader does for training.
+    with ops.device(_placement_function_impl(0)):
+        core_slices = [slice_for_cores(params.mesh_impl, tensor, shape) for tensor, shape in zip(place_holders, shapes)]
+    all_laidout_tensors = [list(tensors) for tensors in zip(*core_slices)]
 
     laidout_tensors0 = all_laidout_tensors[0]
     infeed_queue = tpu_feed.InfeedQueue(
@@ -267,5 +283,4 @@ def infeed_from_session(params: ModelParameter):
                                                     tpu_ordinal_function=_tpu_ordinal_function_impl,
                                                     placement_function=_placement_function_impl)
 
-    place_holders = [prompt, iter_pos, samp_temp, end_iter]
     return enqueue_ops, infeed_queue, place_holders
@@ -1,21 +1,271 @@
+import typing
+
 import mesh_tensorflow as mtf
 import tensorflow as tf
 
-from ..dataclass import ModelParameter
+from ..dataclass import BlockConfig, ModelParameter
 from ..model import build
+from ..model.decode import DecodeState, decodable, select_step
 from ..mtf_wrapper import (constant_scalar, log, argmax, reshape, one_hot, equal, less_equal, mtf_range, greater,
-                           reduce_sum, cast, shift, ones, zeros, constant, random_uniform, greater_equal, logical_not,
-                           anonymize, add, negative, multiply)
-from ..utils_mtf import concat, pad, utils_slice, to_fp32, weighted_add
+                           reduce_sum, cast, ones, zeros, constant, random_uniform, greater_equal, logical_not,
+                           anonymize, add, negative, multiply, broadcast, add_n, minimum, reduce_min, less, top_k,
+                           reduce_max, exp, divide, einsum, maximum)
+from ..utils_core import preserve_names
+from ..utils_mtf import concat, pad, scratch_graph, squeeze, utils_slice, to_fp32, weighted_add
 
 tf1 = tf.compat.v1
 Dataset = tf1.data.Dataset
 
 
+def _keep(logits: mtf.Tensor, keep: mtf.Tensor) -> mtf.Tensor:
+    return add(logits, multiply(cast(logical_not(keep), tf.float32), -1e9))
+
+
+def _filter_logits(params: ModelParameter, logits: mtf.Tensor) -> mtf.Tensor:
+    """
+    Top-k and nucleus (top-p) filtering. Instead of sorting the vocabulary, top-p bisects the smallest probability
+    that is still sampled, which only needs elementwise operations and sums over the vocabulary.
+    """
+    if params.sampling_top_k and params.sampling_top_k < params.vocab_size:
+        k_dim = mtf.Dimension("top_k", params.sampling_top_k)
+        values, _ = top_k(logits, params.vocab_dim, k_dim)
+        logits = _keep(logits, greater_equal(logits, reduce_min(values, reduced_dim=k_dim)))
+    if params.sampling_top_p < 1:
+        probabilities = exp(add(logits, negative(reduce_max(logits, reduced_dim=params.vocab_dim))))
+        probabilities = divide(probabilities, reduce_sum(probabilities, reduced_dim=params.vocab_dim))
+        low = zeros(params.mesh, probabilities.shape - params.vocab_dim, tf.float32)  # keeps at least top_p
+        high = reduce_max(probabilities, reduced_dim=params.vocab_dim)
+        for _ in range(24):
+            middle = multiply(add(low, high), 0.5)
+            mass = reduce_sum(multiply(probabilities, cast(greater_equal(probabilities, middle), tf.float32)),
+                              reduced_dim=params.vocab_dim)
+            enough = cast(greater_equal(mass, params.sampling_top_p), tf.float32)
+            low = add(multiply(middle, enough), multiply(low, add(1, negative(enough))))
+            high = add(multiply(high, enough), multiply(middle, add(1, negative(enough))))
+        logits = _keep(logits, greater_equal(probabilities, low))
+    return logits
+
+
+def _gumbel(params: ModelParameter, shape: mtf.Shape) -> mtf.Tensor:
+    return negative(log(negative(log(random_uniform(params, shape, maxval=1, minval=1e-9, dtype=tf.float32)))))
+
+
+def _sample_filtered(params: ModelParameter, logits: mtf.Tensor, sampling_temperature: mtf.Tensor) -> mtf.Tensor:
+    return argmax(add(logits, multiply(_gumbel(params, logits.shape), sampling_temperature)), params.vocab_dim)
+
+
+def _sample(params: ModelParameter, token_out: mtf.Tensor, sampling_temperature: mtf.Tensor) -> mtf.Tensor:
+    return _sample_filtered(params, _filter_logits(params, cast(token_out, dtype=tf.float32)), sampling_temperature)
+
+
+def _distribution(params: ModelParameter, logits: mtf.Tensor, sampling_temperature: mtf.Tensor) -> mtf.Tensor:
+    """
+    Probabilities _sample_filtered draws from, which is the argmax for a temperature of 0.
+    """
+    greedy = cast(equal(sampling_temperature, 0), tf.float32)
+    highest = one_hot(argmax(logits, params.vocab_dim), params.vocab_dim, dtype=tf.float32)
+    logits = divide(logits, maximum(sampling_temperature, 1e-6))
+    probabilities = exp(add(logits, negative(reduce_max(logits, reduced_dim=params.vocab_dim))))
+    probabilities = divide(probabilities, reduce_sum(probabilities, reduced_dim=params.vocab_dim))
+    return weighted_add(highest, probabilities, greedy)
+
+
+def _select(params: ModelParameter, logits: mtf.Tensor, position: mtf.Tensor) -> mtf.Tensor:
+    return einsum([logits, one_hot(position, params.sequence_dim, dtype=logits.dtype)],
+                  output_shape=logits.shape - params.sequence_dim)
+
+
+def _language_model(params: ModelParameter, token: mtf.Tensor, token_y: mtf.Tensor) -> mtf.Tensor:
+    one = ones(params.mesh, [], tf.float32)
+    return build(params, one, one, one, token, token_y, one, one, one)[-1]
+
+
+def _write(params: ModelParameter, token_out: mtf.Tensor, token_x: mtf.Tensor, position: mtf.Tensor,
+           initial_pos: mtf.Tensor, done: mtf.Tensor, end: mtf.Tensor, stop_tokens: typing.List[int],
+           write: typing.Optional[mtf.Tensor] = None) -> typing.Tuple[mtf.Tensor, mtf.Tensor]:
+    """
+    Put token_out at position and mark the samples it stops as done. Finished samples are filled with padding,
+    samples with a longer prompt keep their prompt. Nothing is written if write is 0.
+    """
+    token_out = add(multiply(token_out, add(1, negative(done))), multiply(done, params.padding_token))
+    active = cast(greater_equal(position, initial_pos), tf.int32)
+    if write is not None:
+        active = multiply(active, write)
+    token_x = weighted_add(broadcast(token_out, token_x.shape), token_x,
+                           multiply(one_hot(position, params.sequence_dim, dtype=tf.int32), active))
+
+    stop = add_n([cast(equal(token_out, token), tf.int32) for token in stop_tokens])
+    stop = add(reduce_sum(stop, output_shape=done.shape), cast(greater_equal(add(position, 1), end), tf.int32))
+    return token_x, minimum(add(done, multiply(active, stop)), 1)
+
+
+def _step(params: ModelParameter, token_x: mtf.Tensor, position: mtf.Tensor, steps: int,
+          states: typing.List[mtf.Tensor], blocks: typing.List[typing.List[BlockConfig]]
+          ) -> typing.Tuple[mtf.Tensor, DecodeState]:
+    """
+    Feed the tokens at position, ..., position + steps - 1 through the model, continuing from the states of the step
+    before. Returns their logits along a sequence_dim of size steps and the DecodeState holding the new states.
+    """
+    params.decode_state = state = DecodeState(position, params.sequence_dim, list(states), blocks, steps)
+    token = state.tokens(token_x)
+    logits = _language_model(params, token, token)
+    params.decode_state = None
+    return logits, state
+
+
+def _draft_step(draft: ModelParameter, token_x: mtf.Tensor, position: mtf.Tensor,
+                states: typing.Optional[typing.List[mtf.Tensor]], blocks: typing.List[typing.List[BlockConfig]]
+                ) -> typing.Tuple[mtf.Tensor, typing.Optional[DecodeState]]:
+    """
+    Logits of the draft model for the token after position. Without states, the draft runs over the full sequence.
+    """
+    cached_masks = draft.cached_masks.copy()
+    with preserve_names(), tf1.variable_scope("draft"):  # same names as in the draft's own checkpoint
+        if states is None:
+            logits, state = _select(draft, _language_model(draft, token_x, token_x), position), None
+        else:
+            logits, state = _step(draft, token_x, position, 1, states, blocks)
+            logits = squeeze(logits, state.step_dim)
+    draft.cached_masks = cached_masks
+    return cast(logits, tf.float32), state
+
+
+def _speculate(params: ModelParameter, position: mtf.Tensor, token_x: mtf.Tensor, initial_pos: mtf.Tensor,
+               sampling_temperature: mtf.Tensor, done: mtf.Tensor, end: mtf.Tensor, stop_tokens: typing.List[int],
+               states: typing.Optional[typing.List[mtf.Tensor]] = None,
+               draft_states: typing.Optional[typing.List[mtf.Tensor]] = None,
+               blocks: typing.Optional[typing.List[typing.List[BlockConfig]]] = None,
+               draft_blocks: typing.Optional[typing.List[typing.List[BlockConfig]]] = None
+               ) -> typing.Tuple[mtf.Tensor, mtf.Tensor, mtf.Tensor, typing.List[mtf.Tensor], typing.List[mtf.Tensor]]:
+    """
+    The draft model proposes draft_tokens tokens one after another, a single forward pass of the model scores all of
+    them. A proposal x is accepted with probability min(1, p(x) / q(x)) for the model's distribution p and the
+    draft's q, the first rejected one is replaced by a sample of max(0, p - q) and a sample of p follows if all of
+    them are accepted. This way, every token is distributed exactly as if the model sampled it on its own. As all
+    samples share one position, every sample advances by the fewest tokens any unfinished sample accepted.
+    With decode states, both models only feed the new positions and the states are rewound to the accepted ones.
+    """
+    draft = params.draft_params
+    decode = states is not None
+    sample_shape = token_x.shape - params.sequence_dim
+    proposal_x = token_x
+    proposals = []
+    draft_distributions = []
+    draft_steps = []
+    # With decode states, the draft also feeds its last proposal, in case all of them are accepted.
+    for i in range(params.draft_tokens + decode):
+        logits, state = _draft_step(draft, proposal_x, add(position, i - 1), draft_states, draft_blocks)
+        if decode:
+            draft_states = state.outputs
+            draft_steps.append(state)
+        if i == params.draft_tokens:
+            break
+        logits = _filter_logits(params, logits)
+        proposals.append(_sample_filtered(params, logits, sampling_temperature))
+        draft_distributions.append(_distribution(params, logits, sampling_temperature))
+        active = cast(greater_equal(add(position, i), initial_pos), tf.int32)
+        proposal_x = weighted_add(broadcast(proposals[-1], token_x.shape), proposal_x,
+                                  multiply(one_hot(add(position, i), params.sequence_dim, dtype=tf.int32), active))
+
+    if decode:  # the token before position and all proposals at once
+        logits, state = _step(params, proposal_x, add(position, -1), params.draft_tokens + 1, states, blocks)
+        logits = cast(logits, tf.float32)
+        step_logits = [squeeze(utils_slice(logits, i, i + 1, state.step_dim), state.step_dim)
+                       for i in range(params.draft_tokens + 1)]
+    else:
+        logits = cast(_language_model(params, proposal_x, proposal_x), tf.float32)
+        step_logits = [_select(params, logits, add(position, i - 1)) for i in range(params.draft_tokens + 1)]
+    sampled = cast(greater(sampling_temperature, 0), tf.float32)
+    accepted = ones(params.mesh, sample_shape, tf.int32)  # whether all proposals so far were accepted
+    accepted_count = []
+    tokens = []
+    for i, (proposal, draft_distribution) in enumerate(zip(proposals, draft_distributions)):
+        distribution = _distribution(params, _filter_logits(params, step_logits[i]), sampling_temperature)
+        proposal_hot = one_hot(proposal, params.vocab_dim, dtype=tf.float32)
+        p = reduce_sum(multiply(distribution, proposal_hot), reduced_dim=params.vocab_dim)
+        q = reduce_sum(multiply(draft_distribution, proposal_hot), reduced_dim=params.vocab_dim)
+        accept = cast(less(multiply(random_uniform(params, sample_shape, maxval=1, dtype=tf.float32), q), p), tf.int32)
+        # Prompts and finished samples don't need any of the model's tokens.
+        accept = maximum(accept, maximum(cast(less(add(position, i), initial_pos), tf.int32), done))
+
+        residual = maximum(add(distribution, negative(draft_distribution)), 0)
+        residual = argmax(add(log(add(residual, 1e-30)), multiply(_gumbel(params, residual.shape), sampled)),
+                          params.vocab_dim)
+        tokens.append(add(multiply(proposal, accept), multiply(residual, add(1, negative(accept)))))
+        accepted = multiply(accepted, accept)
+        accepted_count.append(accepted)
+    tokens.append(_sample_filtered(params, _filter_logits(params, step_logits[-1]), sampling_temperature))
+
+    steps = add(reduce_min(add_n(accepted_count), output_shape=[]), 1)
+    for i, token in enumerate(tokens):
+        token_x, done = _write(params, token, token_x, add(position, i), initial_pos, done, end, stop_tokens,
+                               cast(greater(steps, i), tf.int32))
+    if decode:
+        # The next round feeds the token before the new position, so the model keeps the first steps positions it
+        # fed and the draft the states of its steps-th step.
+        states = state.rewind(steps)
+        draft_states = select_step(draft_steps, steps)
+    return add(position, steps), token_x, done, states, draft_states
+
+
+def _prefill(params: ModelParameter, initial_pos: mtf.Tensor, token_x: mtf.Tensor, token_y: mtf.Tensor
+             ) -> DecodeState:
+    """
+    Run the model over the full prompt once, which leaves the states every following step continues from in the
+    returned DecodeState. Names are restored afterwards, so that the steps share all variables with this pass.
+    """
+    params.decode_state = state = DecodeState(add(initial_pos, -1), params.sequence_dim)
+    with preserve_names():
+        _language_model(params, token_x, token_y)
+    params.decode_state = None
+    return state
+
+
+def _cached_prefill(params: ModelParameter, position: mtf.Tensor, token_x: mtf.Tensor, token_y: mtf.Tensor,
+                    decode_position: mtf.Tensor, decode_states: typing.List[mtf.Tensor]
+                    ) -> typing.Tuple[typing.List[typing.List[BlockConfig]], typing.List[mtf.Tensor]]:
+    """
+    Prefill at position unless decode_position is positive, in which case decode_states already hold the states.
+    Mesh TensorFlow has no conditional, so the prefill is a loop that runs at most once.
+    """
+    prefills = []
+
+    def body_fn(iteration, *states):
+        cached_masks = params.cached_masks.copy()
+        prefills.append(_prefill(params, position, token_x, token_y))
+        params.cached_masks = cached_masks
+        return (add(iteration, 1), *prefills[-1].outputs)
+
+    def cond_fn(iteration, *states):
+        return less(iteration, cast(less_equal(decode_position, 0), tf.int32))
+
+    states = mtf.while_loop(cond_fn=cond_fn, body_fn=body_fn,
+                            inputs=[zeros(params.mesh, [], tf.int32), *decode_states])[1:]
+    return prefills[0].blocks, states
+
+
+def decode_state_shapes(params: ModelParameter) -> typing.List[typing.Tuple[mtf.Shape, tf.DType]]:
+    """
+    Shapes and dtypes of the states autoregressive_model takes as decode_states and returns.
+    """
+    with scratch_graph(params) as mesh:
+        tokens = zeros(mesh, params.token_dim_shape, tf.int32)
+        state = _prefill(params, constant_scalar(params, 1, dtype=tf.int32), tokens, tokens)
+        return [(tensor.shape, tensor.dtype) for tensor in state.outputs]
+
+
 def autoregressive_model(params: ModelParameter,
                          frame_input=None, token_x_input=None, token_y_input=None,
                          frame_mask_src=None, frame_mask_tag=None, token_mask=None,
-                         initial_pos=None, sampling_temperature=None, end_iterations=None):
+                         initial_pos=None, sampling_temperature=None, end_iterations=None,
+                         decode_position=None, decode_states=None):
+    """
+    Sample tokens or frames one position after another. For text, decode_states of an earlier prefill can replace
+    the prefill if decode_position, the position they were prefilled for, is positive. They stay valid as long as
+    the tokens before decode_position - 1 are the same. The states the loop started from are returned with the
+    samples, so that they can be passed in again.
+    """
+    states_out = []
     if params.use_video:
         # todo: fix token shift for video (Jan).
         tkn_per_frame = mtf.Dimension("language_token_per_frame",
@@ -72,29 +322,51 @@ def autoregressive_model(params: ModelParameter,
                              token_x_input, token_y_input, frame_input, frame_mask_src, frame_mask_tag,
                              token_mask]
 
+        def cond_fn(position, *states):
+            is_done = greater_equal(position, end_iterations)
+            is_done = reduce_sum(is_done)
+
+            return logical_not(is_done)
+
     else:  # -> params.use_language
-        def body_fn(position, token_x, token_y, sampling_temperature, *states):
-            _, _, _, _, _, _, token_out = build(params,
-                                                ones(params.mesh, [], tf.float32),
-                                                ones(params.mesh, [], tf.float32),
-                                                ones(params.mesh, [], tf.float32),
-                                                token_x,
-                                                token_y,
-                                                ones(params.mesh, [], tf.float32),
-                                                ones(params.mesh, [], tf.float32),
-                                                ones(params.mesh, [], tf.float32))
-
-            one_hot_mask = one_hot(position, output_dim=params.sequence_dim, dtype=tf.int32)
-            token_out = add(cast(token_out, dtype=tf.float32),
-                            multiply(log(negative(log(random_uniform(params, token_out.shape,
-                                                                     maxval=1, minval=1e-9, dtype=tf.float32)))),
-                                     negative(sampling_temperature)))
-            token_out = argmax(token_out, params.vocab_dim)
-
-            token_out = shift(token_out, offset=1, dim=params.sequence_dim, wrap=False)
-
-            return (add(position, 1), weighted_add(token_out, token_x, one_hot_mask),
-                    token_y, cast(sampling_temperature, dtype=tf.float32))
+        speculative = params.draft_params is not None
+        decode = (params.use_decode_cache and decodable(params)
+                  and (not speculative or decodable(params.draft_params)))
+        if speculative:  # the draft model shares the model's mesh
+            params.draft_params.mesh = params.mesh
+            params.draft_params.mesh_impl = params.mesh_impl
+        stop_tokens = sorted({params.padding_token, *params.stop_tokens})
+        blocks = None
+        draft_blocks = None
+        draft_states = []
+
+        def body_fn(position, token_x, token_y, sampling_temperature, done, *states):
+            cached_masks = params.cached_masks.copy()  # masks built inside the loop can't be used outside of it
+            if speculative:
+                model_states = list(states[:len(states) - len(draft_states)]) if decode else None
+                drafted = list(states[len(model_states):]) if decode else None
+                next_position, token_x, done, model_states, drafted = _speculate(
+                    params, position, token_x, initial_pos, sampling_temperature, done, end, stop_tokens,
+                    model_states, drafted, blocks, draft_blocks)
+                params.cached_masks = cached_masks
+                states = (model_states + drafted) if decode else states
+                return (next_position, token_x, token_y, cast(sampling_temperature, dtype=tf.float32), done, *states)
+            previous = add(position, -1)
+            if decode:
+                # Feed only the last token, the states hold everything the model computed for the ones before it.
+                token_out, state = _step(params, token_x, previous, 1, states, blocks)
+                token_out = squeeze(_sample(params, token_out, sampling_temperature), state.step_dim)
+                states = state.outputs
+            else:
+                # Only the logits of the last position are sampled.
+                token_out = _language_model(params, token_x, token_y)
+                token_out = _sample(params, _select(params, token_out, previous), sampling_temperature)
+            params.cached_masks = cached_masks
+            token_x, done = _write(params, token_out, token_x, position, initial_pos, done, end, stop_tokens)
+            return (add(position, 1), token_x, token_y, cast(sampling_temperature, dtype=tf.float32), done, *states)
+
+        def cond_fn(position, token_x, token_y, sampling_temperature, done, *states):
+            return greater(reduce_sum(add(1, negative(done)), output_shape=[]), 0)
 
         if initial_pos is None:
             initial_pos = constant(params, value=params.initial_autoregressive_position, dtype=tf.int32)
@@ -113,42 +385,64 @@ def autoregressive_model(params: ModelParameter,
         if end_iterations is None:
             end_iterations = constant(params, value=params.sequence_length, dtype=tf.int32)
 
-        while_loop_inputs = [initial_pos, token_x_input, token_y_input, sampling_temperature]
-
-    def cond_fn(position, *states):
-        is_done = greater_equal(position, end_iterations)
-        is_done = reduce_sum(is_done)
-
-        return logical_not(is_done)
+        # initial_pos, sampling_temperature and end_iterations are scalars or hold one value per sample (batch_dim).
+        # The loop starts at the shortest prompt and stops as soon as every sample is done.
+        end = minimum(end_iterations, params.sequence_length)
+        done = broadcast(cast(greater_equal(initial_pos, end), tf.int32), [params.batch_dim])
+        position = reduce_min(initial_pos, output_shape=[])
+        if decode and decode_states is not None:
+            # With cached states, the loop starts where they were prefilled and steps through the rest of the prompt.
+            cached = cast(greater(decode_position, 0), tf.int32)
+            position = add(multiply(position, add(1, negative(cached))), multiply(decode_position, cached))
+            blocks, states_out = _cached_prefill(params, position, token_x_input, token_y_input, decode_position,
+                                                 decode_states)
+        elif decode:
+            prefill = _prefill(params, position, token_x_input, token_y_input)
+            blocks, states_out = prefill.blocks, prefill.outputs
+        if decode and speculative:
+            with preserve_names(), tf1.variable_scope("draft"):
+                prefill = _prefill(params.draft_params, position, token_x_input, token_x_input)
+            draft_blocks, draft_states = prefill.blocks, prefill.outputs
+        while_loop_inputs = [position, token_x_input, token_y_input, sampling_temperature, done, *states_out,
+                             *draft_states]
 
     loop_out = mtf.while_loop(cond_fn=cond_fn, body_fn=body_fn, inputs=while_loop_inputs)
 
     token_out = None
     frame_out = None
-    if params.use_language:
+    if params.use_language and not params.use_video:
+        # Positions the loop stopped before are padding as well, unless they are part of the prompt.
+        positions = mtf_range(params.mesh, params.sequence_dim, dtype=tf.int32)
+        unused = multiply(cast(greater_equal(positions, loop_out[0]), tf.int32),
+                          cast(greater_equal(positions, initial_pos), tf.int32))
+        token_out = add(multiply(loop_out[1], add(1, negative(unused))), multiply(unused, params.padding_token))
+    elif params.use_language:
         token_out = loop_out[1]
     if params.use_video:
         frame_out = loop_out[3]
 
-    return token_out, frame_out
+    return token_out, frame_out, states_out
 
 
 def get_infrence_model(params: ModelParameter):
     def infrence_model(frame_input, cat_mask_src, cat_mask_tag, token_x_input, token_y_input, frame_mask_src,
                        frame_mask_tag,
-                       token_mask, initial_pos, sampling_temperature, end_iterations):
-
+                       token_mask, initial_pos, sampling_temperature, end_iterations, decode_position=None,
+                       decode_states=None):
+        states = []
         if params.use_autoregressive_sampling:
-            token_out, frame_out = autoregressive_model(params,
-                                                        frame_input,
-                                                        token_x_input,
-                                                        token_y_input,
-                                                        frame_mask_src,
-                                                        frame_mask_tag,
-                                                        token_mask,
-                                                        initial_pos,
-                                                        sampling_temperature,
-                                                        end_iterations)
+            token_out, frame_out, states = autoregressive_model(params,
+                                                                frame_input,
+                                                                token_x_input,
+                                                                token_y_input,
+                                                                frame_mask_src,
+                                                                frame_mask_tag,
+                                                                token_mask,
+                                                                initial_pos,
+                                                                sampling_temperature,
+                                                                end_iterations,
+                                                                decode_position,
+                                                                decode_states)
         else:
             _, _, _, _, _, frame_out, token_out = build(params,
                                                         frame_input,
@@ -165,6 +459,6 @@ def get_infrence_model(params: ModelParameter):
         if params.use_video:
             frame_out = anonymize(frame_out)
 
-        return token_out, frame_out
+        return token_out, frame_out, states
 
     return infrence_model
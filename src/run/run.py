@@ -11,29 +11,43 @@ from tensorflow.python.tpu.ops import tpu_ops
 from tensorflow.python.training import checkpoint_management
 
 from .dataloader_placement import place_dataloader, infeed_from_session
-from .inference import get_infrence_model
+from .inference import decode_state_shapes, get_infrence_model
 from .train import get_train_model
-from .utils_run import CheckpointLoaderHook, add_summary, add_histogram, _import_tensor, analyze_model, rep_batch
+from .utils_run import (CheckpointLoaderHook, add_summary, add_histogram, _import_tensor, analyze_model, rep_batch,
+                        model_flops_utilization)
 from .. import tf_wrapper as tfw
 from ..dataclass import ModelParameter
-from ..mtf_wrapper import reduce_sum
+from ..model.decode import prefix_cached
+from ..mtf_wrapper import cast, einsum
 from ..utils_core import color_print
+from ..utils_mtf import utils_slice
 from ..optimizer.backend import import_mtf
 
 tf1 = tf.compat.v1
 Dataset = tf1.data.Dataset
 
 
+def _batch_first(params: ModelParameter, shape: mtf.Shape) -> mtf.Shape:
+    return mtf.Shape([params.batch_dim] + (shape - params.batch_dim).dims)
+
+
 def computation_func(params: ModelParameter, input_fn: typing.Callable,
                      session_config, cluster_resolver, callback_fns, query_input_fns=None):
     # TODO(Lucas): move tf dataset to iterator/queue
     # TODO(Lucas): clean up code + optimize
-    host_id_to_tf_device = "/job:worker/task:{:d}/device:CPU:0"
     hooks = []
     output_shapes = []
+    output_dtypes = []
+    step_flops = []
     tf.config.optimizer.set_experimental_options(params.tensorflow_optimization_settings)
+    # Decode states go through the host in batch-major order, so that the prefix cache can split them per prompt.
+    state_shapes = []
+    if query_input_fns is not None and prefix_cached(params):
+        state_shapes = decode_state_shapes(params)
 
     def _model_fn(*args):
+        if not params.train:  # samples are the same on every replica, only the first one sends them to the host
+            replica, *args = args
         manual_global_step = tf1.get_variable("manual_global_step", [], tf.int64, initializer=tf.zeros_initializer(),
                                               trainable=False,
                                               aggregation=variables.VariableAggregation.ONLY_FIRST_REPLICA)
@@ -52,12 +66,15 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
         cat_mask_tag = None
         token_x_input = None
         token_y_input = None
+        token_tgt = None
         frame_mask_src = None
         frame_mask_tag = None
         token_mask = None
         initial_pos = None
         sampling_temperature = None
         end_iterations = None
+        decode_position = None
+        decode_states = None
 
         start_time = time.time()
         color_print(params, "Building Mesh-TensorFlow graph...")
@@ -72,19 +89,36 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
                 token_x_input = _import_tensor(params, args[5], rep_batch(params, params.token_dim_shape), "tkn_src")
                 token_y_input = _import_tensor(params, args[6], rep_batch(params, params.token_dim_shape), "tkn_tgt")
                 token_mask = _import_tensor(params, args[7], rep_batch(params, params.token_dim_shape), "txt_msk")
+                token_tgt = args[6]
+
+        elif not query_input_fns is None:  # params.use_language
+            # The prompt is only used as model input, so it is infed once and reused as (ignored) target.
+            token_x_input = _import_tensor(params, args[0], params.token_dim_shape, "tkn_src")
+            token_y_input = token_x_input
+            token_tgt = args[0]
+
+            # Every prompt of the batch has its own start, temperature and end.
+            initial_pos = _import_tensor(params, args[1], mtf.Shape([params.batch_dim]), "initial_pos")
+            sampling_temperature = _import_tensor(params, args[2], mtf.Shape([params.batch_dim]), "temperature")
+            end_iterations = _import_tensor(params, args[3], mtf.Shape([params.batch_dim]), "end_iterations")
+
+            if state_shapes:
+                decode_position = _import_tensor(params, args[4], mtf.Shape([]), "decode_position")
+                decode_states = [cast(einsum([_import_tensor(params, arg, _batch_first(params, shape),
+                                                             f"decode_state_{i}")], output_shape=shape), dtype)
+                                 for i, (arg, (shape, dtype)) in enumerate(zip(args[5:], state_shapes))]
+
+        elif params.shift_tokens_on_device:
+            token_input = _import_tensor(params, args[0], rep_batch(params, params.token_input_shape), "tkn")
+            context_dimension = token_input.shape[1]
+            token_x_input = utils_slice(token_input, 0, params.sequence_dim.size, context_dimension)
+            token_y_input = utils_slice(token_input, params.output_offset, context_dimension.size, context_dimension)
+            token_tgt = args[0][:, params.output_offset:]
 
-        else:  # params.use_language
+        else:
             token_x_input = _import_tensor(params, args[0], rep_batch(params, params.token_dim_shape), "tkn_src")
             token_y_input = _import_tensor(params, args[1], rep_batch(params, params.token_dim_shape), "tkn_tgt")
-
-            if not query_input_fns is None:
-                initial_pos_dim = mtf.Dimension("_initial_pos_dim", 1)
-                initial_pos = _import_tensor(params, args[2], mtf.Shape([initial_pos_dim]), "initial_pos")
-                initial_pos = reduce_sum(initial_pos, output_shape=[])
-                sampling_temperature = _import_tensor(params, args[3], mtf.Shape([initial_pos_dim]), "temperature")
-                sampling_temperature = reduce_sum(sampling_temperature, output_shape=[])
-                end_iterations = _import_tensor(params, args[4], mtf.Shape([initial_pos_dim]), "end_iterations")
-                end_iterations = reduce_sum(end_iterations, output_shape=[])
+            token_tgt = args[1]
 
         if params.train:
             frame_out, token_out, learning_rate, loss, video_loss, \
@@ -100,19 +134,21 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
                                                                                              manual_global_step,
                                                                                              "manual_global_step"))
         else:
-            token_out, frame_out = get_infrence_model(params)(frame_input,
-                                                              cat_mask_src,
-                                                              cat_mask_tag,
-                                                              token_x_input,
-                                                              token_y_input,
-                                                              frame_mask_src,
-                                                              frame_mask_tag,
-                                                              token_mask,
-                                                              initial_pos,
-                                                              sampling_temperature,
-                                                              end_iterations)
-
-        analyze_model(params, time_to_build=(time.time() - start_time), graph=graph)
+            token_out, frame_out, decode_states = get_infrence_model(params)(frame_input,
+                                                                             cat_mask_src,
+                                                                             cat_mask_tag,
+                                                                             token_x_input,
+                                                                             token_y_input,
+                                                                             frame_mask_src,
+                                                                             frame_mask_tag,
+                                                                             token_mask,
+                                                                             initial_pos,
+                                                                             sampling_temperature,
+                                                                             end_iterations,
+                                                                             decode_position,
+                                                                             decode_states)
+
+        step_flops.append(analyze_model(params, time_to_build=(time.time() - start_time), graph=graph))
         color_print(params, "Lowering graph to TensorFlow...")
         start_time = time.time()
         lowering = mtf.Lowering(graph, {params.mesh: params.mesh_impl}, autostack=True)
@@ -181,27 +217,53 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
 
             if params.use_language:
                 predictions['token_out'] = lowering.export_to_tf_tensor(token_out)
-                predictions['token_tgt'] = args[1 + int(params.use_video) * 5]
+                if query_input_fns is None:  # queried prompts are known on the host already
+                    predictions['token_tgt'] = token_tgt
 
             for key in params.debug_outfeed:
                 predictions[key] = lowering.export_to_tf_tensor(params.debug_outfeed[key])
 
-            predictions = [val if val.dtype == tf.float32 else tf.cast(val, tf.float32) for val in
-                           predictions.values()]
+            if state_shapes:  # the prefix cache reads them from the end of the outputs
+                for i, state in enumerate(decode_states):
+                    state = einsum([state], output_shape=_batch_first(params, state.shape))
+                    predictions[f'decode_state_{i}'] = lowering.export_to_tf_tensor(state)
+
+            # Sampled token ids stay int32, everything else is sent as float32.
+            predictions = [val if val.dtype in (tf.float32, tf.int32)
+                           else tf.cast(val, tf.int32 if val.dtype.is_integer else tf.float32)
+                           for val in predictions.values()]
             output_shapes.extend([pred.shape for pred in predictions])
+            output_dtypes.extend([pred.dtype for pred in predictions])
+            if params.draft_params is not None:
+                # The draft model is restored from its own checkpoint, without the "draft/" scope it was built in.
+                with mtf.utils.outside_all_rewrites():
+                    model_variables = [var for var in tf1.global_variables() if not var.op.name.startswith("draft/")]
+                    draft_variables = {var.op.name[len("draft/"):]: var for var in tf1.global_variables()
+                                       if var.op.name.startswith("draft/")}
+                    tf1.add_to_collection(tf1.GraphKeys.SAVERS, tf1.train.Saver(model_variables, sharded=True))
+                    hooks.append(CheckpointLoaderHook(params.draft_params.model_path,
+                                                      tf1.train.Saver(draft_variables, sharded=True)))
             hooks.append(mtf.MtfRestoreHook(lowering))
 
-            return tpu_ops.outfeed_enqueue_tuple(predictions)
+            def _outfeed():
+                with tf.control_dependencies([tpu_ops.outfeed_enqueue_tuple(predictions)]):
+                    return tfw.constant(0, tf.int32)
+
+            return tf.cond(tfw.equal(replica, 0), _outfeed, lambda: tfw.constant(0, tf.int32))
 
     if query_input_fns is None:
         input_initializers, enqueue_ops, infeed_queue = place_dataloader(params, input_fn)
     else:
-        enqueue_ops, infeed_queue, (prompt, iter_pos, samp_temp, end_iter) = infeed_from_session(params)
+        enqueue_ops, infeed_queue, place_holders = infeed_from_session(
+            params, [_batch_first(params, shape) for shape, _ in state_shapes])
 
     color_print(params, "Building split TensorFlow computation...")
     start_time = time.time()
+    replica_inputs = [[]] * params.num_cores
+    if not params.train:
+        replica_inputs = [[tf.constant(replica, tf.int32)] for replica in range(params.num_cores)]
     compilation_state, computation = tpu.split_compile_and_replicate(_model_fn,
-                                                                     [[]] * params.num_cores,
+                                                                     replica_inputs,
                                                                      infeed_queue,
                                                                      params.d_assignment,
                                                                      None,
@@ -244,10 +306,14 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
             current_step = current_step * params.grad_accumulation
             for i in range(current_step, params.train_steps * params.grad_accumulation, params.macro_batching):
 
+                now = time.time()
                 sess.run(computation)
                 if params.debug_train_step or i < first_print_threshold:
+                    elapsed = time.time() - now
                     color_print(params, f"Current global step: {i // params.grad_accumulation}"
-                                        f"   accumulation step: {i % params.grad_accumulation}")
+                                        f"   accumulation step: {i % params.grad_accumulation}"
+                                        f"   step time: {elapsed:.3f}s"
+                                        f"   MFU: {model_flops_utilization(params, sum(step_flops), elapsed):.1%}")
 
                 sess.run(enqueue_ops)
                 if params.debug_train_step:
@@ -258,19 +324,13 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
                     color_print(params, f"Flushing summary...")
 
     else:  # train == 'sample'
-        outfeed_dequeue_ops = []
-        for host_id in range(params.num_hosts):
-            with ops.device(host_id_to_tf_device.format(host_id)):
-                for device_ordinal in range(params.num_cores_per_host):
-                    outfeed_dequeue_op = tpu_ops.outfeed_dequeue_tuple(dtypes=[tf.float32] * len(output_shapes),
-                                                                       shapes=output_shapes,
-                                                                       device_ordinal=device_ordinal)
-                    # We don't need output other than from core 0.
-                    outfeed_dequeue_ops.append([tf.reduce_mean(x) for x in outfeed_dequeue_op]
-                                               if outfeed_dequeue_ops else outfeed_dequeue_op)
+        # Only the first replica enqueues its outputs.
+        with ops.device(params.d_assignment.host_device(replica=0)):
+            outfeed_dequeue_ops = [tpu_ops.outfeed_dequeue_tuple(dtypes=output_dtypes, shapes=output_shapes,
+                                                                 device_ordinal=params.d_assignment.tpu_ordinal(0))]
         with tf1.train.MonitoredSession(session_creator=tf1.train.ChiefSessionCreator(master=cluster_resolver.master(),
                                                                                       config=session_config),
-                                        hooks=[ckpt_loader_hook, hooks[0]]) as sess:
+                                        hooks=[ckpt_loader_hook] + hooks) as sess:
 
             color_print(params, f"Connected after {time.time() - start_time:.1f}s")
             color_print(params, 'Compiling computation...')
@@ -288,12 +348,8 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
                 if query_input_fns is None:
                     feed_dict = None
                 else:
-                    _prompt, _iter_pos, _samp_temp, _end_iter = query_input_fns()
-                    feed_dict = {prompt: _prompt,
-                                 iter_pos: _iter_pos,
-                                 samp_temp: _samp_temp,
-                                 end_iter: _end_iter
-                                 }
+                    # Prompts without a prefix cache hit leave out the decode states, which then default to zero.
+                    feed_dict = dict(zip(place_holders, query_input_fns()))
 
                 sess.run(enqueue_ops, feed_dict=feed_dict)
 
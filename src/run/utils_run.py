@@ -8,6 +8,7 @@ from tensorflow.python.tpu import tpu
 
 from .. import tf_wrapper as tfw
 from ..dataclass import ModelParameter
+from ..model.cost import OperationCost, graph_cost
 from ..mtf_wrapper import import_laid_out_tensor
 from ..utils_core import color_print
 
@@ -18,11 +19,12 @@ Dataset = tf1.data.Dataset
 class CheckpointLoaderHook(tf.estimator.SessionRunHook):
     """Load checkpoint right after the session started."""
 
-    def __init__(self, checkpoint_dir):
+    def __init__(self, checkpoint_dir, saver=None):
         self.checkpoint_dir = checkpoint_dir
+        self.saver = saver  # the first saver of the graph if None
 
     def after_create_session(self, session, coord):
-        saver_collection = tf1.get_collection(tf1.GraphKeys.SAVERS)
+        saver_collection = [self.saver] if self.saver is not None else tf1.get_collection(tf1.GraphKeys.SAVERS)
         if saver_collection:
             check_point = tf.train.latest_checkpoint(self.checkpoint_dir)
             if check_point:
@@ -59,6 +61,8 @@ def add_histogram(tf_loss, value, global_step):
 
 
 def _import_tensor(params: ModelParameter, tensor, shape, name):
+    if tensor.dtype in (tf.uint8, tf.uint16):  # compressed infeed, see inputs.infeed_dtype
+        tensor = tfw.cast(tensor, tf.int32)
     return import_laid_out_tensor(params, params.mesh_impl.LaidOutTensor([tensor]), shape, name)
 
 
@@ -99,12 +103,30 @@ def analyze_model(params: ModelParameter, time_to_build: float, graph: mtf.Graph
         color_print(params, dim_name)
     print('')
 
+    costs = graph_cost(graph.operations, params.macro_batching if params.train else 1)
+    total = sum(costs.values(), OperationCost())
+    cost_mapping = [(name, f'{cost.flops:.3e}', f'{cost.flops / max(total.flops, 1):.1%}',
+                     f'{cost.activation_bytes / 2 ** 20:,.1f}')
+                    for name, cost in sorted(costs.items(), key=lambda x: -x[1].flops)]
+    cost_mapping.append(('Total', f'{total.flops:.3e}', '100.0%', f'{total.activation_bytes / 2 ** 20:,.1f}'))
+    widths = [max(len(item[i]) for item in cost_mapping) for i in range(4)]
+    color_print(params, "Compute per step:")
+    for name, flops, share, activation in cost_mapping:
+        color_print(params, f'{name:<{widths[0]}s}  FLOPs: {flops:>{widths[1]}s} ({share:>{widths[2]}s})  '
+                            f'activations: {activation:>{widths[3]}s} MiB')
+    color_print(params, f'Memory traffic without fusion: {total.memory_traffic / 2 ** 30:,.1f} GiB')
+    print('')
+
     model_size = {'model_variables': int(param_count - embed_param_count),
                   'embedding_variables': int(embed_param_count),
                   'body_variables': int(body_param_count),
                   'untrainable_variables': int(var_count - param_count),
                   'total_trainable_variables': int(param_count),
-                  'total_variables': int(var_count)
+                  'total_variables': int(var_count),
+                  'step_flops': float(total.flops),
+                  'activation_bytes': float(total.activation_bytes),
+                  'memory_traffic': float(total.memory_traffic),
+                  'layer_flops': {name: float(cost.flops) for name, cost in costs.items()}
                   }
 
     if params.train:
@@ -112,6 +134,12 @@ def analyze_model(params: ModelParameter, time_to_build: float, graph: mtf.Graph
         with tf.io.gfile.GFile(f"{params.model_path}/model_size.info", 'w') as f:
             f.write(size_dump)
 
+    return total.flops
+
+
+def model_flops_utilization(params: ModelParameter, step_flops: float, step_time: float) -> float:
+    return step_flops / step_time / (params.peak_flops_per_core * params.num_cores)
+
 
 def rep_batch(params: ModelParameter, shape: [mtf.Shape, typing.List[mtf.Dimension]]):
     if params.macro_batching > 1 and params.train:
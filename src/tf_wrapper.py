@@ -138,3 +138,47 @@ def tf_range(start: int, end: int, step: int):
 
 def cast(tensor: tf.cast, dtype: tf.DType):
     return scoped("reshape", tf.cast, tensor, dtype)
+
+
+def rsqrt(tensor: tf.Tensor) -> tf.Tensor:
+    return scoped("rsqrt", tf.math.rsqrt, tensor)
+
+
+def reduce_sum(tensor: tf.Tensor, axis: typing.List[int], keepdims: bool = False) -> tf.Tensor:
+    return scoped("reduce_sum", tf.reduce_sum, tensor, axis, keepdims)
+
+
+def transpose(tensor: tf.Tensor, perm: typing.List[int]) -> tf.Tensor:
+    return scoped("transpose", tf.transpose, tensor, perm)
+
+
+def expand_dims(tensor: tf.Tensor, axis: int) -> tf.Tensor:
+    return scoped("expand_dims", tf.expand_dims, tensor, axis)
+
+
+def stack(tensors: typing.List[tf.Tensor], axis: int) -> tf.Tensor:
+    return scoped("stack", tf.stack, tensors, axis)
+
+
+def reduce_max(tensor: tf.Tensor, axis: typing.List[int], keepdims: bool = False) -> tf.Tensor:
+    return scoped("reduce_max", tf.reduce_max, tensor, axis, keepdims)
+
+
+def log(tensor: tf.Tensor) -> tf.Tensor:
+    return scoped("log", tf.math.log, tensor)
+
+
+def concat(tensors: typing.List[tf.Tensor], axis: int) -> tf.Tensor:
+    return scoped("concat", tf.concat, tensors, axis)
+
+
+def broadcast_to(tensor: tf.Tensor, shape: typing.List[int]) -> tf.Tensor:
+    return scoped("broadcast_to", tf.broadcast_to, tensor, shape)
+
+
+def squeeze(tensor: tf.Tensor, axis: typing.List[int]) -> tf.Tensor:
+    return scoped("squeeze", tf.squeeze, tensor, axis)
+
+
+def zeros(shape: typing.List[int], dtype: tf.DType) -> tf.Tensor:
+    return scoped("zeros", tf.zeros, shape, dtype)
@@ -1,6 +1,7 @@
 """
 Generic utility functions that are called frequently across modules.
 """
+import contextlib
 import functools
 import typing
 from datetime import datetime, timezone
@@ -65,3 +66,17 @@ def random_name(prefix="") -> str:
         _NAME_INDICES[prefix] = -1
     _NAME_INDICES[prefix] += 1
     return f'{prefix}{_NAME_INDICES[prefix]}'
+
+
+@contextlib.contextmanager
+def preserve_names():
+    """
+    Restore the counters used by random_name on exit, so that everything named afterwards gets the same names it would
+    have gotten if the code inside the context never ran.
+    """
+    indices = _NAME_INDICES.copy()
+    try:
+        yield
+    finally:
+        _NAME_INDICES.clear()
+        _NAME_INDICES.update(indices)
@@ -1,3 +1,4 @@
+import contextlib
 import typing
 
 import mesh_tensorflow as mtf
@@ -5,10 +6,11 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops.init_ops import Initializer
 
+from . import tf_wrapper as tfw
 from .dataclass import BlockArgs, ModelParameter
 from .mtf_wrapper import cast, mtf_range, reshape, concat as mtf_concat, pad as mtf_pad, mtf_slice, add, multiply, \
     negative
-from .utils_core import default, random_name
+from .utils_core import default, preserve_names, random_name
 
 tf1 = tf.compat.v1
 
@@ -403,11 +405,31 @@ def missing_dims(self: ALL_SHAPES, other: ALL_SHAPES):
     return (mtf.Shape(dims_from_shape(other)) - mtf.Shape(dims_from_shape(self))).dims
 
 
-def compare_range(params: ModelParameter, dim0: mtf.Dimension, dim1: mtf.Dimension, comparison: typing.Callable):
-    with tf1.variable_scope(f"compare{dim0.name}_{dim1.name}"):
-        return cast(comparison(mtf_range(params.mesh, dim0, tf.int32),
-                               mtf_range(params.mesh, dim1, tf.int32)),
-                    params.variable_dtype.activation_dtype)
+def range_comparison(params: ModelParameter, dim0: mtf.Dimension, dim1: mtf.Dimension, comparison: typing.Callable,
+                     offset: int = 0) -> mtf.Tensor:
+    """
+    Boolean comparison of the positions along two dimensions, with the positions of dim1 shifted by offset.
+    Every distinct comparison is built once per graph and shared by all callers.
+    """
+    key = (params.mesh, dim0, dim1, comparison, offset)
+    cache = params.cached_masks
+    if key not in cache or not cache[key].usable:  # masks built inside of a custom gradient can't be shared
+        with tf1.variable_scope(f"compare{dim0.name}_{dim1.name}"):
+            range1 = mtf_range(params.mesh, dim1, tf.int32)
+            if offset:
+                range1 += offset
+            cache[key] = comparison(mtf_range(params.mesh, dim0, tf.int32), range1)
+    return cache[key]
+
+
+def compare_range(params: ModelParameter, dim0: mtf.Dimension, dim1: mtf.Dimension, comparison: typing.Callable,
+                  offset0: int = 0, offset1: int = 0):
+    """
+    Compare the positions along two dimensions, e.g. less(query_position, key_position) for a causal mask.
+    The offsets shift the positions of each dimension, which allows building the mask of a tile of a larger matrix.
+    """
+    return cast(range_comparison(params, dim0, dim1, comparison, offset1 - offset0),
+                params.variable_dtype.activation_dtype)
 
 
 def get_attention_dim(args: BlockArgs) -> ATTENTION_DIM:
@@ -431,6 +453,55 @@ def get_fan_in(params: ModelParameter, shape: ALL_SHAPES) -> DIM_LIST:
     return shape[:1]
 
 
+def slice_for_cores(mesh_impl: mtf.MeshImpl, tensor: tf.Tensor, shape: mtf.Shape) -> typing.List[tf.Tensor]:
+    """
+    Cut the slice every core holds of a tensor laid out as shape, e.g. to infeed each core only its part of the batch.
+    Cores that hold the same slice (replicated dimensions) share one slice op.
+    :param mesh_impl: MeshImpl the tensor is imported into
+    :param tensor: full tensor on the host
+    :param shape: mtf shape of the tensor
+    :return: one slice per processor number
+    """
+    size = mesh_impl.slice_shape(shape)
+    slices = {}
+    for pnum in range(mesh_impl.size):
+        begin = tuple(mesh_impl.slice_begin(shape, pnum))
+        if begin not in slices:
+            slices[begin] = tfw.slice(tensor, list(begin), size) if shape.ndims else tensor
+    return [slices[tuple(mesh_impl.slice_begin(shape, pnum))] for pnum in range(mesh_impl.size)]
+
+
+@contextlib.contextmanager
+def scratch_graph(params: ModelParameter):
+    """
+    Swap params.mesh for a mesh in a throwaway TensorFlow and Mesh TensorFlow graph, e.g. to inspect what a part of the
+    model would build. Names and the per-graph state kept in params are restored on exit, so building the real graph
+    afterwards yields the same graph as before.
+    :param params: ModelParameter whose mesh should be swapped
+    :return: the temporary mtf.Mesh
+    """
+    mesh = params.mesh
+    attention_idx = params.attention_idx
+    cached_parameters = params.cached_parameters
+    cached_masks = params.cached_masks
+    decode_state = params.decode_state
+    scope = tf1.get_variable_scope().name
+    with preserve_names(), tf.Graph().as_default():
+        params.mesh = mtf.Mesh(mtf.Graph(), "scratch_mesh")
+        params.cached_parameters = {}
+        params.cached_masks = {}
+        params.decode_state = None
+        try:
+            with tf1.variable_scope(scope) if scope else contextlib.nullcontext():
+                yield params.mesh
+        finally:
+            params.mesh = mesh
+            params.attention_idx = attention_idx
+            params.cached_parameters = cached_parameters
+            params.cached_masks = cached_masks
+            params.decode_state = decode_state
+
+
 # The majority of this Function was copied from:
 # 'https://github.com/tensorflow/mesh/blob/8931eb9025f833b09d8425404ebd5801acbb0cac/mesh_tensorflow/ops.py#L5956-L6104'
 # Copyright 2021 The Mesh TensorFlow Authors.
@@ -7,6 +7,7 @@ import tensorflow as tf
 
 from backend import OperationTest, RELU_STD
 from src.model import basic
+from src.utils_core import preserve_names
 
 tf1 = tf.compat.v1
 
@@ -55,3 +56,42 @@ def square_matmul_std_test(test: typing.Type, calculation_dtype: str, storage_dt
     test(calculation_dtype=calculation_dtype, storage_dtype=storage_dtype, slice_dtype=slice_dtype,
          features_per_head=embd_per_head, heads=heads, batch_size=1, sequence_length=1, group_linear_factor=heads,
          scale_by_depth=scale_by_depth, train_steps=train_steps)()
+
+
+class FusedLinear(OperationTest):
+    def __init__(self, count: int, extras: typing.List[str], **kwargs):
+        super(FusedLinear, self).__init__(**kwargs)
+        self.count = count
+        self.extras = extras
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.args.params
+        params.mesh = mesh
+        params.graph = graph
+        inp = mtf.random_normal(mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims,
+                                dtype=params.variable_dtype.activation_dtype)
+
+        # Both versions get identical names, so they share all variables.
+        with preserve_names():
+            fused = basic.fused_linear(self.args(inp)(self.extras), self.count)
+        separate = [basic.wrapped_linear(self.args(inp)(self.extras)) for _ in range(self.count)]
+        grads = [mtf.gradients([mtf.reduce_sum(mtf.add_n([mtf.square(out) * (i + 1) for i, out in enumerate(outs)]))],
+                               [inp] + [var.outputs[0] for var in graph.trainable_variables])
+                 for outs in (fused, separate)]
+        return fused + separate + grads[0] + grads[1], len(graph.trainable_variables)
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        assert args == self.count
+        outputs = sess.run(outputs)
+        outputs, grads = outputs[:2 * self.count], outputs[2 * self.count:]
+        for fused, separate in zip(outputs[:self.count] + grads[:args + 1], outputs[self.count:] + grads[args + 1:]):
+            assert fused.shape == separate.shape
+            assert np.allclose(fused, separate, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("count", [1, 2, 3])
+@pytest.mark.parametrize("extras", [[], ['group']])
+def fused_linear_test(count: int, extras: typing.List[str]):
+    FusedLinear(count, extras, calculation_dtype="float32", storage_dtype="float32", slice_dtype="float32",
+                features_per_head=16, heads=2, train_batch_size=2, sequence_length=4)()
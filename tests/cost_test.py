@@ -0,0 +1,63 @@
+import mesh_tensorflow as mtf
+import pytest
+import tensorflow as tf
+
+from src.dataclass import ModelParameter
+from src.model import _body
+from src.model.cost import OperationCost, graph_cost, layer_name, operation_cost
+
+tf1 = tf.compat.v1
+
+
+@pytest.mark.parametrize("batch", [1, 16])
+@pytest.mark.parametrize("features", [64, 256])
+def matmul_cost_test(batch: int, features: int):
+    with tf.Graph().as_default():
+        graph = mtf.Graph()
+        mesh = mtf.Mesh(graph, "MESH")
+        batch_dim = mtf.Dimension("batch", batch)
+        old = mtf.Dimension("old", features)
+        new = mtf.Dimension("new", 2 * features)
+        inp = mtf.zeros(mesh, [batch_dim, old])
+        weight = mtf.zeros(mesh, [old, new])
+        with tf1.variable_scope("gpt0v"), tf1.variable_scope("body0v"), tf1.variable_scope("0_1v"), \
+             tf1.variable_scope("feed_forward_3v"):
+            out = mtf.einsum([inp, weight], output_shape=[batch_dim, new])
+
+        cost = operation_cost(out.operation)
+        assert cost.flops == 2 * batch * features * 2 * features
+        assert cost.activation_bytes == batch * 2 * features * 4
+
+        costs = graph_cost(graph.operations)
+        assert costs["block1/feed_forward"].flops == cost.flops
+        assert sum(costs.values(), OperationCost()).flops == cost.flops
+
+
+@pytest.mark.parametrize("strategy", ["none", "checkpoint"])
+def attention_gradient_cost_test(strategy: str):
+    with tf.Graph().as_default():
+        params = ModelParameter({'features': 32, 'sequence_length': 16, 'train_batch_size': 2, 'depth': 1,
+                                 'memory_reduction_strategy': strategy, 'use_video': False, 'use_language': True,
+                                 'block_config': [{'layer': ['norm-group-shift-scale',
+                                                             'attention-dot_product-context']}]})
+        graph = params.graph = mtf.Graph()
+        params.mesh = mtf.Mesh(graph, "MESH")
+        src = mtf.random_normal(params.mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims)
+        with tf1.variable_scope("gpt0v"), tf1.variable_scope("body0v"):
+            loss = mtf.reduce_sum(mtf.square(_body(params, src)))
+        forward = graph_cost(graph.operations)
+        # The block index counts up across tests, recomputed blocks have to be grouped the same way
+        block = {name.split('/')[0] for name in forward if name.startswith('block')}
+        assert len(block) == 1
+        attention = f"{block.pop()}/attention"
+        matmul = sum(operation_cost(op).flops for op in graph.operations
+                     if isinstance(op, mtf.EinsumOperation) and layer_name(op) == attention)
+        assert matmul > forward[attention].flops / 2
+
+        mtf.gradients([loss], [src] + [var.outputs[0] for var in graph.trainable_variables])
+        costs = graph_cost(graph.operations)
+
+        # Every matmul needs two more in the backward pass, and a recomputed block runs its forward pass twice
+        assert set(costs) == set(forward)
+        recomputed = 2 if strategy == "checkpoint" else 1
+        assert costs[attention].flops >= recomputed * forward[attention].flops + 2 * matmul
@@ -0,0 +1,376 @@
+import typing
+
+import mesh_tensorflow as mtf
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from backend import BaseTest
+from src.dataclass import ModelParameter
+from src.model.cost import operation_flops
+from src.model.decode import decodable, select_step
+from src.run.inference import _filter_logits, _language_model, _prefill, _step, autoregressive_model
+from src.utils_core import preserve_names
+from src.utils_mtf import slice_for_cores
+
+tf1 = tf.compat.v1
+
+
+class Decode(BaseTest):
+    def __init__(self, config: typing.Dict[str, typing.Any], initial_pos: typing.Optional[typing.List[int]] = None,
+                 end_iterations: typing.Optional[typing.List[int]] = None, **kwargs):
+        super(Decode, self).__init__(**kwargs)
+        self.params = ModelParameter(config)
+        self.initial_pos = initial_pos
+        self.end_iterations = end_iterations
+
+    def _per_sample(self, values: typing.Optional[typing.List[int]]) -> typing.Optional[mtf.Tensor]:
+        if values is None:
+            return None
+        return mtf.import_tf_tensor(self.params.mesh, tf.constant(values, tf.int32), [self.params.batch_dim])
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.params
+        params.mesh = mesh
+        params.graph = graph
+        params.mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(self.mesh_shape, self.layout_rules, self.devices)
+        token_x = mtf.import_tf_tensor(mesh, tf.random.uniform(params.token_dim_shape.to_integer_list, 0,
+                                                               params.vocab_size, dtype=tf.int32),
+                                       params.token_dim_shape)
+
+        outputs = [token_x]
+        for use_decode_cache in (False, True):
+            params.use_decode_cache = use_decode_cache
+            with preserve_names():  # both loops share all variables
+                outputs.append(autoregressive_model(params, token_x_input=token_x, token_y_input=token_x,
+                                                    initial_pos=self._per_sample(self.initial_pos),
+                                                    end_iterations=self._per_sample(self.end_iterations))[0])
+        return outputs, None
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        prompt, full, cached = sess.run(outputs)
+        assert np.array_equal(full, cached)
+        if self.initial_pos is None:
+            return
+        for sample, prompt_sample, start, end in zip(cached, prompt, self.initial_pos, self.end_iterations):
+            if self.params.stop_tokens:  # every token stops, so each sample gets exactly one new token
+                end = min(end, start + 1)
+            assert np.array_equal(sample[:start], prompt_sample[:start])
+            assert np.all(sample[end:] == self.params.padding_token)
+
+
+def _config(layer: typing.List[str], memory_reduction_strategy: str = "none", sequence_length: int = 8
+            ) -> typing.Dict[str, typing.Any]:
+    return {'depth': 2, 'features': 16, 'heads': 2, 'sequence_length': sequence_length, 'train_batch_size': 2,
+            'vocab_size': 32, 'memory_reduction_strategy': memory_reduction_strategy, 'use_video': False,
+            'use_language': True, 'use_autoregressive_sampling': True, 'initial_autoregressive_position': 3,
+            'sampling_temperature': 0, 'calculation_dtype': "float32", 'storage_dtype': "float32",
+            'slice_dtype': "float32", 'masked_attention_dimensions': [0],
+            'block_config': [{'layer': ['norm-group-shift-scale'] + layer}]}
+
+
+@pytest.mark.parametrize("layer", [['attention-dot_product-context'],
+                                   ['attention-dot_product-embedded-absolute-shared_key_value'],
+                                   ['attention-biased_attention_map-biased_softmax-absolute'],
+                                   ['convolution-4'],
+                                   ['attention-dot_product-context-blockwise:3', 'convolution-3']])
+@pytest.mark.parametrize("memory_reduction_strategy", ["revnet", "momentum", "checkpoint", "none"])
+def decode_test(layer: typing.List[str], memory_reduction_strategy: str):
+    config = _config(layer, memory_reduction_strategy)
+    assert decodable(ModelParameter(config))
+    Decode(config)()
+
+
+def decode_flops_test():
+    flops = {}
+    for sequence_length in (64, 128):
+        for use_decode_cache in (False, True):
+            with tf.Graph().as_default():
+                params = ModelParameter(_config(['attention-dot_product-context', 'feed_forward'],
+                                                sequence_length=sequence_length))
+                params.use_decode_cache = use_decode_cache
+                params.mesh = mtf.Mesh(mtf.Graph(), "MESH")
+                token_x = mtf.zeros(params.mesh, params.token_dim_shape, tf.int32)
+                autoregressive_model(params, token_x_input=token_x, token_y_input=token_x)
+                loop = next(op for op in params.mesh.graph.operations if isinstance(op, mtf.WhileLoopOperation))
+                flops[sequence_length, use_decode_cache] = sum(operation_flops(op) for op in loop._body_ops)
+
+    # a full forward pass per token grows at least linearly with the sequence, a cached step at most linearly
+    assert flops[128, False] >= 2 * flops[64, False]
+    assert flops[128, True] <= 2 * flops[64, True]
+    assert flops[128, True] * 32 < flops[128, False]
+
+
+class PrefixResume(Decode):
+    def __init__(self, config: typing.Dict[str, typing.Any], prefill_position: int, resume_position: int, **kwargs):
+        super(PrefixResume, self).__init__(config, **kwargs)
+        self.prefill_position = prefill_position
+        self.resume_position = resume_position
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.params
+        params.mesh = mesh
+        params.graph = graph
+        params.mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(self.mesh_shape, self.layout_rules, self.devices)
+        shape = params.token_dim_shape.to_integer_list
+        tokens = tf.random.uniform(shape, 0, params.vocab_size, dtype=tf.int32)
+        # Only the tokens before resume_position - 1 are shared with the prompt the states were prefilled with.
+        shared = tf.reshape(tf.range(shape[1]) < self.resume_position - 1, [1, shape[1]] + [1] * (len(shape) - 2))
+        other = tf.where(shared, tokens, tf.random.uniform(shape, 0, params.vocab_size, dtype=tf.int32))
+        token_x, other = [mtf.import_tf_tensor(mesh, t, params.token_dim_shape) for t in (tokens, other)]
+        initial_pos = self._per_sample([5, 7])
+
+        with preserve_names():
+            reference = autoregressive_model(params, token_x_input=token_x, token_y_input=token_x,
+                                             initial_pos=initial_pos)[0]
+        with preserve_names():
+            states = autoregressive_model(params, token_x_input=other, token_y_input=other,
+                                          initial_pos=self._per_sample([self.prefill_position] * 2))[2]
+        outputs = [reference]
+        for position, decode_states in ((self.resume_position, states), (0, [mtf.zeros_like(t) for t in states])):
+            with preserve_names():
+                outputs.append(autoregressive_model(params, token_x_input=token_x, token_y_input=token_x,
+                                                    initial_pos=initial_pos,
+                                                    decode_position=mtf.constant(mesh, position, dtype=tf.int32),
+                                                    decode_states=decode_states)[0])
+        return outputs, None
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        reference, resumed, prefilled = sess.run(outputs)
+        assert np.array_equal(reference, resumed)
+        assert np.array_equal(reference, prefilled)
+
+
+# Attention keys after the resumed position are overwritten before they are attended to, convolution windows only
+# hold the positions right before the one they were prefilled for.
+@pytest.mark.parametrize("layer,prefill_position,resume_position", [(['attention-dot_product-context'], 7, 3),
+                                                                     (['convolution-3'], 5, 5),
+                                                                     (['attention-dot_product-context',
+                                                                       'convolution-3'], 4, 4)])
+def decode_prefix_resume_test(layer: typing.List[str], prefill_position: int, resume_position: int):
+    PrefixResume(_config(layer), prefill_position, resume_position)()
+
+
+@pytest.mark.parametrize("layer", ['attention-biased_attention_map-absolute', 'convolution',
+                                   'split_path-add;attention-biased_attention_map-absolute,norm;feed_forward'])
+def decode_fallback_test(layer: str):
+    params = ModelParameter({'features': 16, 'use_video': False, 'use_language': True,
+                             'masked_attention_dimensions': [],
+                             'block_config': [{'layer': ['norm-group-shift-scale', layer]}]})
+    assert not decodable(params)
+
+
+@pytest.mark.parametrize("stop_tokens", [[], list(range(32))])
+def decode_early_exit_test(stop_tokens: typing.List[int]):
+    config = _config(['attention-dot_product-context', 'convolution-3'])
+    config['stop_tokens'] = stop_tokens
+    Decode(config, initial_pos=[2, 4], end_iterations=[5, 8])()
+
+
+class InfeedSlices(Decode):
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.params
+        params.mesh = mesh
+        params.graph = graph
+        mesh_impl = params.mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(self.mesh_shape, self.layout_rules,
+                                                                                 self.devices)
+        batch = mtf.Shape([params.batch_dim])
+        inputs = [(tf.random.uniform(params.token_dim_shape.to_integer_list, 0, params.vocab_size, dtype=tf.int32),
+                   params.token_dim_shape),
+                  (tf.constant(self.initial_pos, tf.int32), batch),
+                  (tf.constant(self.end_iterations, tf.int32), batch)]
+        # Every core is fed only its own slice, as infeed_from_session does.
+        sliced = [slice_for_cores(mesh_impl, tensor, shape) for tensor, shape in inputs]
+        infeed = [mtf.import_laid_out_tensor(mesh, mesh_impl.LaidOutTensor(slices), shape)
+                  for slices, (_, shape) in zip(sliced, inputs)]
+        full = [mtf.import_tf_tensor(mesh, tensor, shape) for tensor, shape in inputs]
+        outputs = []
+        for token_x, initial_pos, end_iterations in (full, infeed):
+            with preserve_names():
+                outputs.append(autoregressive_model(params, token_x_input=token_x, token_y_input=token_x,
+                                                    initial_pos=initial_pos, end_iterations=end_iterations)[0])
+        return outputs, [slices[0] for slices in sliced]
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        reference, infeed = sess.run(outputs)
+        assert np.array_equal(reference, infeed)
+        # The batch is split, so a core only gets its half of the prompts
+        assert all(shape[0] == self.params.train_batch_size // 2 for shape in (t.shape.as_list() for t in args))
+
+
+def decode_infeed_slices_test():
+    InfeedSlices(_config(['attention-dot_product-context', 'feed_forward']), initial_pos=[2, 4],
+                 end_iterations=[5, 8], mesh_shape="b:2", layout_rules="batch:b", devices=["cpu:0"] * 2)()
+
+
+class FilterLogits(BaseTest):
+    def __init__(self, config: typing.Dict[str, typing.Any], **kwargs):
+        super(FilterLogits, self).__init__(**kwargs)
+        self.params = ModelParameter(config)
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.params
+        params.mesh = mesh
+        logits = mtf.random_normal(mesh, [params.batch_dim, params.vocab_dim], stddev=3)
+        return [logits, _filter_logits(params, logits)], None
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        logits, filtered = sess.run(outputs)
+        probabilities = np.exp(logits - logits.max(-1, keepdims=True))
+        probabilities /= probabilities.sum(-1, keepdims=True)
+        for row, kept in zip(probabilities, filtered > -1e8):
+            ranked = np.sort(row)[::-1][:self.params.sampling_top_k or row.size]
+            count = ranked.size
+            if self.params.sampling_top_p < 1:  # the nucleus of what top-k left
+                count = np.searchsorted(np.cumsum(ranked / ranked.sum()), self.params.sampling_top_p - 1e-6) + 1
+            assert np.array_equal(kept, row >= ranked[count - 1])
+
+
+@pytest.mark.parametrize("top_k,top_p", [(0, 1.), (4, 1.), (0, 0.5), (0, 0.9), (8, 0.5), (3, 0.99)])
+def filter_logits_test(top_k: int, top_p: float):
+    FilterLogits({'features': 16, 'vocab_size': 64, 'train_batch_size': 16, 'sampling_top_k': top_k,
+                  'sampling_top_p': top_p, 'use_video': False, 'use_language': True})()
+
+
+class Speculative(Decode):
+    def __init__(self, config: typing.Dict[str, typing.Any], draft_config: typing.Dict[str, typing.Any], **kwargs):
+        super(Speculative, self).__init__(config, **kwargs)
+        self.draft_params = ModelParameter(draft_config)
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.params
+        params.mesh = mesh
+        params.mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(self.mesh_shape, self.layout_rules, self.devices)
+        token_x = mtf.import_tf_tensor(mesh, tf.random.uniform(params.token_dim_shape.to_integer_list, 0,
+                                                               params.vocab_size, dtype=tf.int32),
+                                       params.token_dim_shape)
+        outputs = []
+        for draft_params in (None, self.draft_params):
+            params.draft_params = draft_params
+            with preserve_names():  # the draft model changes nothing but the speed
+                outputs.append(autoregressive_model(params, token_x_input=token_x, token_y_input=token_x,
+                                                    initial_pos=self._per_sample(self.initial_pos),
+                                                    end_iterations=self._per_sample(self.end_iterations))[0])
+        return outputs, None
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        reference, speculative = sess.run(outputs)
+        assert np.array_equal(reference, speculative)
+
+
+@pytest.mark.parametrize("draft_tokens", [1, 3, 8])
+@pytest.mark.parametrize("initial_pos,end_iterations,stop_tokens", [(None, None, []),
+                                                                    ([2, 4], [5, 8], []),
+                                                                    ([2, 4], [8, 8], list(range(16)))])
+def decode_speculative_test(draft_tokens: int, initial_pos: typing.Optional[typing.List[int]],
+                            end_iterations: typing.Optional[typing.List[int]], stop_tokens: typing.List[int]):
+    config = _config(['attention-dot_product-context', 'convolution-3'])
+    config.update({'draft_tokens': draft_tokens, 'stop_tokens': stop_tokens})
+    draft_config = _config(['attention-dot_product-context'])
+    draft_config.update({'depth': 1, 'features': 8})
+    Speculative(config, draft_config, initial_pos=initial_pos, end_iterations=end_iterations)()
+
+
+class Rewind(Decode):
+    def __init__(self, config: typing.Dict[str, typing.Any], steps: int, count: int, **kwargs):
+        super(Rewind, self).__init__(config, **kwargs)
+        self.steps = steps
+        self.count = count
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.params
+        params.mesh = mesh
+        params.graph = graph
+        params.mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(self.mesh_shape, self.layout_rules, self.devices)
+        token_x = mtf.import_tf_tensor(mesh, tf.random.uniform(params.token_dim_shape.to_integer_list, 0,
+                                                               params.vocab_size, dtype=tf.int32),
+                                       params.token_dim_shape)
+        position = mtf.constant(mesh, 3, dtype=tf.int32)
+        prefill = _prefill(params, position, token_x, token_x)
+        with preserve_names():
+            _, state = _step(params, token_x, position - 1, self.steps, prefill.outputs, prefill.blocks)
+        singles = []
+        states = prefill.outputs
+        for i in range(self.steps):
+            with preserve_names():
+                singles.append(_step(params, token_x, position + (i - 1), 1, states, prefill.blocks)[1])
+            states = singles[-1].outputs
+        count = mtf.constant(mesh, self.count, dtype=tf.int32)
+        rewound = state.rewind(count)
+        return rewound + select_step(singles, count), len(rewound)
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        states = sess.run(outputs)
+        for rewound, selected in zip(states[:args], states[args:]):
+            assert np.allclose(rewound, selected, rtol=1e-4, atol=1e-5)
+
+
+# Feeding several positions at once and keeping the first count of them gives the states of count single steps.
+@pytest.mark.parametrize("count", [1, 2, 4])
+def decode_rewind_test(count: int):
+    Rewind(_config(['attention-dot_product-context', 'convolution-3']), 4, count)()
+
+
+def decode_speculative_flops_test():
+    flops = {}
+    for sequence_length in (64, 128):
+        draft_config = _config(['attention-dot_product-context'], sequence_length=sequence_length)
+        draft_config.update({'depth': 1, 'features': 8})
+        for use_decode_cache in (False, True):
+            for speculative in (False, True):
+                with tf.Graph().as_default():
+                    params = ModelParameter(_config(['attention-dot_product-context', 'feed_forward'],
+                                                    sequence_length=sequence_length))
+                    params.use_decode_cache = use_decode_cache
+                    params.draft_params = ModelParameter(draft_config) if speculative else None
+                    params.mesh = mtf.Mesh(mtf.Graph(), "MESH")
+                    token_x = mtf.zeros(params.mesh, params.token_dim_shape, tf.int32)
+                    autoregressive_model(params, token_x_input=token_x, token_y_input=token_x)
+                    loop = next(op for op in params.mesh.graph.operations if isinstance(op, mtf.WhileLoopOperation))
+                    flops[sequence_length, use_decode_cache, speculative] = sum(operation_flops(op)
+                                                                                for op in loop._body_ops)
+
+    # A round of speculative sampling with the decode cache grows at most linearly with the sequence, just like a
+    # cached step of the model, and costs little more than the draft_tokens + 1 steps it can replace.
+    assert flops[128, True, True] <= 2 * flops[64, True, True]
+    assert flops[128, True, True] < (params.draft_tokens + 2) * flops[128, True, False]
+    assert flops[128, True, True] * 8 < flops[128, False, True]
+
+
+class SpeculativeDistribution(Speculative):
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.params
+        params.mesh = mesh
+        params.mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(self.mesh_shape, self.layout_rules, self.devices)
+        params.draft_params = self.draft_params
+        token_x = mtf.zeros(mesh, params.token_dim_shape, tf.int32)  # every sample has the same distribution
+        position = mtf.constant(mesh, params.initial_autoregressive_position, dtype=tf.int32)
+        with preserve_names():
+            logits = _language_model(params, token_x, token_x)
+        logits = mtf.einsum([logits, mtf.one_hot(position - 1, params.sequence_dim, dtype=logits.dtype)],
+                            output_shape=logits.shape - params.sequence_dim)
+        tokens = autoregressive_model(params, token_x_input=token_x, token_y_input=token_x)[0]
+        tokens = mtf.einsum([tokens, mtf.one_hot(position, params.sequence_dim, dtype=tf.int32)],
+                            output_shape=tokens.shape - params.sequence_dim)
+        return [logits, tokens], None
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        logits, tokens = sess.run(outputs)
+        probabilities = np.exp(logits[0] / self.params.sampling_temperature)
+        probabilities /= probabilities.sum()
+        frequencies = np.bincount(tokens.reshape(-1), minlength=self.params.vocab_size) / tokens.size
+        assert np.abs(frequencies - probabilities).max() < 4 / tokens.size ** 0.5
+
+
+def decode_speculative_distribution_test():
+    config = _config(['attention-dot_product-context'])
+    config.update({'vocab_size': 4, 'train_batch_size': 2048, 'sampling_temperature': 1, 'draft_tokens': 2,
+                   'embedding_stddev': 1})
+    SpeculativeDistribution(config, config)()
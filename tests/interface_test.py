@@ -0,0 +1,28 @@
+import typing
+
+import numpy as np
+import pytest
+
+pytest.importorskip("transformers")
+
+from src.dataclass import ModelParameter
+from src.interface import InterfaceWrapper
+
+
+@pytest.mark.parametrize("sampled,expected", [([7, 8, 5, 0, 0, 0], [7, 8, 5]),  # stopped, the rest is padding
+                                              ([7, 8, 9, 10, 11, 12], [7, 8, 9, 10, 11, 12])])
+def complete_stop_token_test(sampled: typing.List[int], expected: typing.List[int]):
+    params = ModelParameter({'sequence_length': 16, 'vocab_size': 256, 'train_batch_size': 1, 'interface_slots': 2,
+                             'stop_tokens': [5], 'features': 32, 'use_video': False, 'use_language': True})
+    interface = InterfaceWrapper(params)
+    prompt = [1, 2, 3]
+    result = interface.complete(prompt, temperature=0., response_len=len(sampled), asynchronous=True)
+
+    tokens, iter_pos, _, end_iterations = interface.input_query()
+    assert iter_pos[0] == len(prompt)
+    assert end_iterations[0] == len(prompt) + len(sampled)
+    response = tokens.copy()
+    response.flat[len(prompt):len(prompt) + len(sampled)] = sampled
+    interface.output_responds([response])
+
+    assert result().tolist() == expected
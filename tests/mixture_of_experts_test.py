@@ -0,0 +1,97 @@
+import math
+import random
+import string
+import typing
+
+import mesh_tensorflow as mtf
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from backend import OperationTest
+from src.model import basic
+
+tf1 = tf.compat.v1
+
+
+def _einsum(inputs: typing.List[typing.Tuple[np.ndarray, mtf.Shape]], output: mtf.Shape) -> np.ndarray:
+    letters = {}
+    for name in [dim.name for _, shape in inputs for dim in shape.dims] + output.dimension_names:
+        letters.setdefault(name, string.ascii_letters[len(letters)])
+    equation = ','.join(''.join(letters[dim.name] for dim in shape.dims) for _, shape in inputs)
+    return np.einsum(f"{equation}->{''.join(letters[name] for name in output.dimension_names)}",
+                     *[array for array, _ in inputs])
+
+
+class MixtureOfExperts(OperationTest):
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.args.params
+        params.mesh = mesh
+        params.graph = graph
+        # The initializers draw their seeds from random, so that the same tokens exceed the capacity in every run
+        random.seed(0)
+        shape = mtf.Shape([params.batch_dim, params.sequence_dim] + params.feature_dims)
+        inp = np.random.default_rng(0).standard_normal(shape.to_integer_list)
+        inp = mtf.import_tf_tensor(mesh, tf.constant(inp, params.variable_dtype.activation_dtype), shape)
+        out = basic.mixture_of_experts(self.args(inp)(['mixture_of_experts']))[0]
+        gate, expert = sorted([var.outputs[0] for var in graph.trainable_variables], key=lambda var: var.shape.ndims)
+        assert gate.shape == mtf.Shape(params.feature_dims + [params.expert_dim])  # same variable as the dense version
+        # The output doesn't depend on the gate through the loss below, only the balance loss reaches it. Its
+        # gradient is scaled like the one the optimizer seeds the loss with.
+        gate_grads = []
+        for loss_gradient in (None, mtf.constant(mesh, 3, dtype=tf.float32)):
+            params.loss_gradient = loss_gradient
+            gate_grads.append(mtf.gradients([mtf.reduce_sum(out) * 0], [gate])[0])
+        params.loss_gradient = None
+        return [inp, gate, expert, out] + gate_grads, (inp.shape, gate.shape, expert.shape, out.shape)
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        params = self.args.params
+        inp, gate, expert, out, gate_grad, scaled_grad = sess.run(outputs)
+        inp_shape, gate_shape, expert_shape, out_shape = args
+        logits = _einsum([(inp, inp_shape), (gate, gate_shape)], mtf.Shape(inp_shape.dims[:2] + [params.expert_dim]))
+        probs = np.exp(logits - logits.max(-1, keepdims=True))
+        probs /= probs.sum(-1, keepdims=True)
+        choices = np.argsort(-probs, -1)[..., :params.expert_top_k]
+        weights = np.take_along_axis(probs, choices, -1)
+        if params.expert_top_k > 1:  # a single expert is scaled by its probability, so that the gate is trained
+            weights /= weights.sum(-1, keepdims=True)
+        # Every expert is applied to every token, then only the chosen ones are kept.
+        dense = _einsum([(inp, inp_shape), (expert, expert_shape)],
+                        mtf.Shape(out_shape.dims[:2] + [params.expert_dim] + out_shape.dims[2:]))
+        chosen = np.take_along_axis(dense, choices.reshape(choices.shape + (1,) * (dense.ndim - 3)), 2)
+
+        # Within every group of tokens, an expert takes first choices before second ones, each in token order, until
+        # its capacity is full. All later choices of it are dropped.
+        group = min(params.expert_group_size, inp_shape.dims[1].size)
+        capacity = math.ceil(params.expert_capacity_factor * choices.shape[-1] * group / params.experts)
+        grouped = choices.reshape(choices.shape[:1] + (-1, group) + choices.shape[2:])
+        routed = grouped[..., None] == np.arange(params.experts)
+        per_choice = routed.sum(2, keepdims=True)
+        position = np.cumsum(routed, 2) - routed + np.cumsum(per_choice, 3) - per_choice
+        kept = ((position * routed).sum(-1) < capacity).reshape(choices.shape)
+        if params.expert_capacity_factor >= params.experts:
+            assert kept.all()
+        else:
+            assert kept.any() and not kept.all()
+        weights = weights * kept
+
+        reference = (chosen * weights.reshape(weights.shape + (1,) * (dense.ndim - 3))).sum(2)
+        assert np.allclose(out, reference, rtol=1e-4, atol=1e-4)
+        assert np.abs(gate_grad).sum() > 0 if params.expert_balance_loss else not np.any(gate_grad)
+        assert np.allclose(scaled_grad, 3 * gate_grad, rtol=1e-5, atol=1e-7)
+
+
+@pytest.mark.parametrize("expert_top_k", [1, 2])
+@pytest.mark.parametrize("expert_group_size", [4, 8])
+@pytest.mark.parametrize("expert_capacity_factor,expert_balance_loss", [(8, 1e-2), (8, 0), (0.5, 1e-2)])
+@pytest.mark.parametrize("mesh_shape,layout_rules", [([], []), ("b:2", "batch:b,experts:b")])
+def mixture_of_experts_test(expert_top_k: int, expert_group_size: int, expert_capacity_factor: float,
+                            expert_balance_loss: float, mesh_shape: typing.Union[list, str],
+                            layout_rules: typing.Union[list, str]):
+    MixtureOfExperts(mesh_shape=mesh_shape, layout_rules=layout_rules, devices=["cpu:0"] * (2 if mesh_shape else 1),
+                     calculation_dtype="float32", storage_dtype="float32", slice_dtype="float32", features_per_head=8,
+                     heads=2, train_batch_size=2, sequence_length=8, experts=8, expert_top_k=expert_top_k,
+                     expert_group_size=expert_group_size, expert_capacity_factor=expert_capacity_factor,
+                     expert_balance_loss=expert_balance_loss)()
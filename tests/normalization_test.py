@@ -0,0 +1,90 @@
+import typing
+
+import mesh_tensorflow as mtf
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from backend import OperationTest
+from src.model.normalization import norm
+from src.utils_core import preserve_names
+
+tf1 = tf.compat.v1
+
+
+class Norm(OperationTest):
+    def __init__(self, extras: typing.List[str], mean: float = 2., **kwargs):
+        super(Norm, self).__init__(**kwargs)
+        self.extras = extras
+        self.mean = mean
+
+    def _norm(self, inp: mtf.Tensor, fused: bool) -> mtf.Tensor:
+        self.args.params.fused_norm = fused
+        return norm(self.args(inp)(self.extras))
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.args.params
+        params.mesh = mesh
+        params.graph = graph
+        inp = mtf.random_normal(mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims, mean=self.mean,
+                                dtype=params.variable_dtype.activation_dtype)
+
+        # Both versions get identical names, so they share all variables.
+        with preserve_names():
+            reference = self._norm(inp, False)
+        fused = self._norm(inp, True)
+        variables = [var.outputs[0] for var in graph.trainable_variables]
+        grads = []
+        for out in (reference, fused):
+            grads.extend(mtf.gradients([mtf.reduce_sum(mtf.square(out) * mtf.cos(inp))], [inp] + variables))
+        return [reference, fused] + grads, len(variables) + 1
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        reference, fused, *grads = sess.run(outputs)
+        assert np.allclose(reference, fused, rtol=1e-4, atol=1e-4)
+        for reference_grad, fused_grad in zip(grads[:args], grads[args:]):
+            assert np.allclose(reference_grad, fused_grad, rtol=1e-3, atol=1e-3)
+
+
+@pytest.mark.parametrize("extras", [[], ['scale'], ['shift'], ['scale', 'shift'], ['group', 'scale', 'shift']])
+@pytest.mark.parametrize("mesh_shape,layout_rules", [([], []), ("h:2", "heads:h"), ("b:2", "batch:b")])
+def norm_test(extras: typing.List[str], mesh_shape: typing.Union[list, str], layout_rules: typing.Union[list, str]):
+    Norm(extras, mesh_shape=mesh_shape, layout_rules=layout_rules, devices=["cpu:0"] * (2 if mesh_shape else 1),
+         calculation_dtype="float32", storage_dtype="float32", slice_dtype="float32", features_per_head=16, heads=2,
+         train_batch_size=4, sequence_length=8)()
+
+
+class NormOffset(Norm):
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.args.params
+        params.mesh = mesh
+        params.graph = graph
+        inp = mtf.random_normal(mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims, mean=self.mean,
+                                dtype=params.variable_dtype.activation_dtype)
+        weight = mtf.random_normal(mesh, inp.shape, dtype=inp.dtype)
+        out = self._norm(inp, True)
+        return [inp, weight, out, mtf.gradients([mtf.reduce_sum(out * weight)], [inp])[0]], None
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        inp, weight, out, grad = [value.astype(np.float64) for value in sess.run(outputs)]
+        axes = (-1,) if 'group' in self.extras else (-2, -1)
+        centered = inp - inp.mean(axes, keepdims=True)
+        rstd = 1 / np.sqrt(np.square(centered).mean(axes, keepdims=True) + 1e-5)
+        normalized = centered * rstd
+        expected = (weight - weight.mean(axes, keepdims=True)
+                    - normalized * (weight * normalized).mean(axes, keepdims=True)) * rstd
+        # x itself is rounded to about 1e-3 in float32
+        assert np.allclose(out, normalized, rtol=1e-2, atol=1e-2)
+        assert np.allclose(grad, expected, rtol=1e-2, atol=1e-2)
+
+
+# The mean of squares minus the squared mean of x cancels out in float32 once the offset dwarfs the deviation.
+@pytest.mark.parametrize("extras", [[], ['group']])
+@pytest.mark.parametrize("mesh_shape,layout_rules", [([], []), ("h:2", "heads:h"), ("b:2", "batch:b")])
+def norm_offset_test(extras: typing.List[str], mesh_shape: typing.Union[list, str],
+                     layout_rules: typing.Union[list, str]):
+    NormOffset(extras, 1e4, mesh_shape=mesh_shape, layout_rules=layout_rules,
+               devices=["cpu:0"] * (2 if mesh_shape else 1), calculation_dtype="float32", storage_dtype="float32",
+               slice_dtype="float32", features_per_head=16, heads=2, train_batch_size=4, sequence_length=8)()
@@ -0,0 +1,92 @@
+import typing
+
+import mesh_tensorflow as mtf
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from backend import BaseTest
+from src.dataclass import ModelParameter
+from src.model import _body
+from src.model.planner import block_cost, plan_memory_reduction
+from src.utils_core import preserve_names
+
+tf1 = tf.compat.v1
+
+
+@pytest.mark.parametrize("budget,strategy", [(2 ** 40, "none"), (1, "checkpoint")])
+@pytest.mark.parametrize("depth", [1, 3])
+def plan_memory_reduction_test(budget: int, strategy: str, depth: int):
+    with tf.Graph().as_default():
+        params = ModelParameter({'depth': depth, 'features': 32, 'sequence_length': 16, 'train_batch_size': 2,
+                                 'memory_reduction_strategy': 'auto', 'memory_budget_per_core': budget,
+                                 'use_video': False, 'use_language': True,
+                                 'block_config': [{'layer': ['norm-group-shift-scale',
+                                                             'feed_forward-in:relu-group']}]})
+        params.mesh = mtf.Mesh(mtf.Graph(), "MESH")
+        src = mtf.zeros(params.mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims)
+        operations = len(params.mesh.graph.operations)
+
+        blocks = plan_memory_reduction(params, src)
+
+        assert len(params.mesh.graph.operations) == operations
+        assert len(blocks) == depth
+        assert all(config.memory_reduction_strategy == strategy for configs in blocks for config in configs)
+
+
+@pytest.mark.parametrize("strategy", ["revnet", "momentum"])
+def plan_reversible_test(strategy: str):
+    with tf.Graph().as_default():
+        params = ModelParameter({'features': 32, 'sequence_length': 16, 'train_batch_size': 2,
+                                 'memory_reduction_strategy': 'auto', 'memory_planner_strategies': ['none', strategy],
+                                 'use_video': False, 'use_language': True})
+        params.mesh = mtf.Mesh(mtf.Graph(), "MESH")
+        with pytest.raises(ValueError):
+            plan_memory_reduction(params, mtf.zeros(params.mesh, [params.batch_dim, params.sequence_dim]
+                                                    + params.feature_dims))
+
+
+class PlannedLoss(BaseTest):
+    def __init__(self, config: typing.Dict[str, typing.Any], **kwargs):
+        super(PlannedLoss, self).__init__(**kwargs)
+        self.params = ModelParameter(config)
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.params
+        params.mesh = mesh
+        params.graph = graph
+        src = mtf.random_normal(mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims)
+        cost = block_cost(params, params.block_config[0], src)
+        # Everything stored, one block recomputed, everything recomputed
+        budgets = [2 ** 40, cost.activation_bytes * (params.depth - 1) + cost.input_bytes, 1]
+
+        outputs = []
+        plans = []
+        for budget in budgets:
+            params.memory_budget_per_core = budget
+            plans.append(sum(config.memory_reduction_strategy == "checkpoint"
+                             for configs in plan_memory_reduction(params, src) for config in configs))
+            with preserve_names():  # every plan has to share all variables
+                loss = mtf.reduce_sum(mtf.square(_body(params, src)))
+            variables = [var.outputs[0] for var in graph.trainable_variables]
+            outputs.extend([loss] + mtf.gradients([loss], variables))
+        assert plans == [0, 1, params.depth]
+        return outputs, len(variables)
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        values = sess.run(outputs)
+        reference = values[:args + 1]
+        for start in range(args + 1, len(values), args + 1):
+            for ref, val in zip(reference, values[start:start + args + 1]):
+                assert np.allclose(ref, val, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("mesh_shape,layout_rules", [([], []), ("b:2", "batch:b")])
+def planned_loss_test(mesh_shape: typing.Union[list, str], layout_rules: typing.Union[list, str]):
+    PlannedLoss({'depth': 3, 'features': 16, 'heads': 2, 'sequence_length': 8, 'train_batch_size': 2,
+                 'memory_reduction_strategy': 'auto', 'use_video': False, 'use_language': True,
+                 'calculation_dtype': "float32", 'storage_dtype': "float32", 'slice_dtype': "float32",
+                 'block_config': [{'layer': ['norm-group-shift-scale', 'attention-dot_product-context',
+                                             'feed_forward-in:relu-group']}]},
+                mesh_shape=mesh_shape, layout_rules=layout_rules, devices=["cpu:0"] * (2 if mesh_shape else 1))()
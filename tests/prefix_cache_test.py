@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from src.prefix_cache import PrefixCache
+
+
+def _states(value: float):
+    return [np.full([4, 2], value, np.float32), np.full([3], value, np.float32)]
+
+
+@pytest.mark.parametrize("shorter_prefixes", [True, False])
+def prefix_cache_lookup_test(shorter_prefixes: bool):
+    cache = PrefixCache(2 ** 20, shorter_prefixes, max_replay=8)
+    tokens = np.arange(1, 17, dtype=np.int32)
+    cache.store(tokens, 6, _states(1))
+
+    # Same prefix, longer prompt: resume where the states were prefilled and step through the remaining prompt.
+    position, states = cache.lookup([tokens], [9])
+    assert position == 6
+    assert np.array_equal(states[0][0], _states(1)[0])
+
+    # Only the first three tokens are shared: attention states still resume right after them, convolutions don't.
+    other = tokens.copy()
+    other[3] = 0
+    position, states = cache.lookup([other], [9])
+    assert position == (4 if shorter_prefixes else 0)
+
+    # A prompt shorter than the cached prefix
+    position, states = cache.lookup([tokens], [4])
+    assert position == (4 if shorter_prefixes else 0)
+
+    # Every prompt of a batch has to resume, and too much prompt left to step through prefills instead.
+    assert cache.lookup([tokens, np.zeros_like(tokens)], [9, 9]) == (0, None)
+    assert cache.lookup([tokens], [15]) == (0, None)
+    assert cache.hits == 1 + 2 * shorter_prefixes
+    assert cache.lookups == 6
+
+
+def prefix_cache_eviction_test():
+    size = 5 * 4 + sum(state.nbytes for state in _states(0))
+    cache = PrefixCache(2 * size, True, max_replay=8)
+    prompts = [np.full([16], value, np.int32) for value in range(1, 4)]
+    for value, prompt in enumerate(prompts[:2]):
+        cache.store(prompt, 6, _states(value))
+    assert cache.lookup([prompts[0]], [6])[0] == 6  # makes the second prompt the least recently used one
+
+    cache.store(prompts[2], 6, _states(2))
+    assert cache.size == 2 * size
+    assert cache.lookup([prompts[1]], [6]) == (0, None)
+    assert cache.lookup([prompts[0]], [6])[0] == 6
+    assert cache.lookup([prompts[2]], [6])[0] == 6
+    assert cache.reused_tokens == 3 * 5
@@ -0,0 +1,81 @@
+import itertools
+import typing
+
+import mesh_tensorflow as mtf
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from backend import OperationTest
+from src.model import basic
+from src.model.cost import operation_cost
+from src.model.embedding import Gather
+
+tf1 = tf.compat.v1
+
+
+class ProductKeys(OperationTest):
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.args.params
+        params.mesh = mesh
+        params.graph = graph
+        scores = mtf.random_normal(mesh, [params.batch_dim, params.sequence_dim, params.head_dim, params.pkm_dim,
+                                          params.key_dim], dtype=tf.float32)
+        slot_dim = mtf.Dimension("pkm_slots", min(params.pkm_top_k, params.product_key_value_vectors))
+        weight, idx = basic._product_keys(params, scores, slot_dim)
+        return [scores, weight, idx], slot_dim.size
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        scores, weight, idx = sess.run(outputs)
+        assert idx.dtype == np.int32
+        # Score of every slot, the first axis is the most significant digit of the slot's index
+        slots = sum(np.expand_dims(scores[..., axis, :], tuple(i + 3 for i in range(scores.shape[3]) if i != axis))
+                    for axis in range(scores.shape[3]))
+        slots = slots.reshape(scores.shape[:3] + (-1,))
+        normalizer = np.log(np.exp(slots).sum(-1, keepdims=True))
+        reference = np.argsort(-slots, -1, kind='stable')[..., :args]
+        assert np.array_equal(idx, reference)
+        assert np.allclose(weight, np.exp(np.take_along_axis(slots, reference, -1) - normalizer), rtol=1e-4)
+
+
+@pytest.mark.parametrize("pkm_axes", [1, 2, 3])
+@pytest.mark.parametrize("pkm_top_k", [1, 4, 32])
+def product_keys_test(pkm_axes: int, pkm_top_k: int):
+    ProductKeys(calculation_dtype="float32", storage_dtype="float32", slice_dtype="float32", features_per_head=8,
+                heads=2, train_batch_size=2, sequence_length=4, pkm_axes=pkm_axes, pkm_top_k=pkm_top_k)()
+
+
+class ProductKeyMemory(OperationTest):
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.args.params
+        params.mesh = mesh
+        params.graph = graph
+        inp = mtf.random_normal(mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims,
+                                dtype=params.variable_dtype.activation_dtype)
+        out = basic.product_key_memory(self.args(inp)(['absolute']))
+        variables = [var.outputs[0] for var in graph.trainable_variables]
+        grads = mtf.gradients([mtf.reduce_sum(mtf.square(out))], variables)
+        gather, = [op for op in graph.operations if isinstance(op, Gather)]
+        table = variables[-1]
+        return [out] + grads, (out.shape, operation_cost(gather).memory_traffic, table.size * table.dtype.size)
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        params = self.args.params
+        out, *grads = sess.run(outputs)
+        shape, gather_traffic, table_bytes = args
+        assert out.shape == tuple(shape.to_integer_list)
+        assert all(np.isfinite(grad).all() and np.any(grad) for grad in grads)
+
+        # Memory traffic of the lookup depends on the slots read, not on the size of the table.
+        slots = params.train_batch_size * params.sequence_length * params.heads * params.pkm_top_k
+        assert gather_traffic == slots * (2 * params.features_per_head + 1) * 4
+        assert gather_traffic < table_bytes
+
+
+@pytest.mark.parametrize("pkm_axes,pkm_top_k", list(itertools.product([2, 3], [1, 4])))
+def product_key_memory_test(pkm_axes: int, pkm_top_k: int):
+    ProductKeyMemory(mesh_shape="h:2", layout_rules="heads:h", devices=["cpu:0"] * 2, calculation_dtype="float32",
+                     storage_dtype="float32", slice_dtype="float32", features_per_head=16, heads=2,
+                     train_batch_size=2, sequence_length=4, pkm_axes=pkm_axes, pkm_top_k=pkm_top_k)()
@@ -0,0 +1,79 @@
+import typing
+
+import mesh_tensorflow as mtf
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from backend import OperationTest
+from src.dataclass import BlockArgs
+from src.model.embedding import Gather
+from src.mtf_wrapper import optimizer_scalar
+from src.optimizer import get_optimizer
+
+tf1 = tf.compat.v1
+
+
+class SparseUpdate(OperationTest):
+    def __init__(self, squeeze: bool, **kwargs):
+        super(SparseUpdate, self).__init__(**kwargs)
+        self.squeeze = squeeze
+        self.rng = np.random.RandomState(0)
+
+    def __call__(self, *args, **kwargs) -> None:
+        self._close_session()
+        params = self.args.params
+        with tf.Graph().as_default() as tf_graph, tf1.Session(config=self.session_config, graph=tf_graph) as sess:
+            graph = mtf.Graph()
+            mesh = mtf.Mesh(graph, "MESH")
+            params.mesh = mesh
+            params.graph = graph
+
+            rows = 16
+            table_dims = [mtf.Dimension("rows", rows)] + params.feature_dims
+            token_dims = [params.batch_dim, params.sequence_dim] + [params.head_dim] * self.squeeze
+            indices = self.rng.randint(0, rows // 2, [dim.size for dim in token_dims])  # duplicates and unused rows
+            table = mtf.get_variable(mesh, "embed", table_dims, initializer=tf1.random_normal_initializer())
+            gather = Gather(BlockArgs(params, mtf.import_tf_tensor(mesh, tf.constant(indices, tf.int32), token_dims), ['']), table,
+                            [params.head_dim] * self.squeeze)
+            out = gather.outputs[0]
+            weight = self.rng.normal(size=out.shape.to_integer_list).astype(np.float32)
+            loss = mtf.reduce_sum(out * mtf.import_tf_tensor(mesh, tf.constant(weight), out.shape))
+            update_ops, _ = get_optimizer([loss], params, optimizer_scalar(params, 0), "update")
+            assert any(op.name.startswith("sparse_rows") for op in graph.operations) == params.sparse_embedding_updates
+
+            mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(self.mesh_shape, self.layout_rules, self.devices)
+            lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+            value = lowering.export_to_tf_tensor(table)
+            update = tf.group([lowering.lowered_operation(op) for op in update_ops])
+            sess.run(tf1.global_variables_initializer())
+            sess.run(lowering.copy_masters_to_slices())
+
+            # Gradient of every row, the weights of all tokens that gathered it summed up
+            grad = np.zeros([rows] + [dim.size for dim in params.feature_dims])
+            for (batch, sequence, *head), idx in np.ndenumerate(indices):
+                grad[(idx, *head)] += weight[(batch, sequence, *head)]
+
+            expected = sess.run(value)
+            exp_avg_p1 = np.zeros_like(grad)
+            exp_avg_p2 = np.zeros_like(grad)
+            for _ in range(2):
+                sess.run(update)
+                exp_avg_p1 = params.opt_beta1 * exp_avg_p1 + (1 - params.opt_beta1) * grad
+                exp_avg_p2 = params.opt_beta2 * exp_avg_p2 + (1 - params.opt_beta2) * grad ** 2
+                expected -= (params.learning_rate * exp_avg_p1 / (1 - params.opt_beta1)
+                             / np.maximum(np.sqrt(exp_avg_p2 / (1 - params.opt_beta2)), 1e-5))
+                assert np.allclose(sess.run(value), expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("sparse_embedding_updates", [True, False])
+@pytest.mark.parametrize("squeeze,mesh_shape,layout_rules", [(False, [], []), (False, "b:2", "batch:b"),
+                                                             (True, "h:2", "heads:h")])
+def sparse_update_test(sparse_embedding_updates: bool, squeeze: bool, mesh_shape: typing.Union[list, str],
+                       layout_rules: typing.Union[list, str]):
+    SparseUpdate(squeeze, mesh_shape=mesh_shape, layout_rules=layout_rules,
+                 devices=["cpu:0"] * (2 if mesh_shape else 1), calculation_dtype="float32", storage_dtype="float32",
+                 slice_dtype="float32", optimizer_slice_dtype="float32", optimizer_calculation_dtype="float32",
+                 features_per_head=4, heads=2, train_batch_size=4, sequence_length=8, optimizer="adam-learning_rate",
+                 learning_rate=0.1, learning_rate_config={}, weight_decay=0,
+                 sparse_embedding_updates=sparse_embedding_updates)()
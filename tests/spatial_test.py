@@ -0,0 +1,157 @@
+import typing
+
+import mesh_tensorflow as mtf
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from backend import OperationTest
+from src.dataclass import BlockArgs, ModelParameter
+from src.model import _body, spatial
+from src.model.cost import operation_flops
+from src.utils_core import preserve_names, scoped
+
+tf1 = tf.compat.v1
+
+
+class BlockwiseAttention(OperationTest):
+    def __init__(self, extras: typing.List[str], block_size: int, **kwargs):
+        super(BlockwiseAttention, self).__init__(**kwargs)
+        self.extras = extras
+        self.block_size = block_size
+
+    def _attention(self, inp: mtf.Tensor, extras: typing.List[str]) -> mtf.Tensor:
+        self.args.params.attention_idx = 0
+        return spatial.attention(self.args(inp)(extras))
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.args.params
+        params.mesh = mesh
+        params.graph = graph
+        inp = mtf.random_normal(mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims,
+                                dtype=params.variable_dtype.activation_dtype)
+
+        # Both versions get identical names, so they share all variables.
+        with preserve_names():
+            dense = self._attention(inp, self.extras)
+        blockwise = self._attention(inp, self.extras + [f'blockwise:{self.block_size}'])
+        variables = [inp] + [var.outputs[0] for var in graph.trainable_variables]
+        grads = []
+        for out in (dense, blockwise):
+            grads.extend(mtf.gradients([mtf.reduce_sum(mtf.square(out))], variables))
+        return [dense, blockwise] + grads, len(variables)
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        dense, blockwise, *grads = sess.run(outputs)
+        assert np.allclose(dense, blockwise, rtol=1e-4, atol=1e-5)
+        for dense_grad, blockwise_grad in zip(grads[:args], grads[args:]):
+            assert np.allclose(dense_grad, blockwise_grad, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("extras", [['dot_product', 'context'],
+                                    ['dot_product', 'embedded', 'biased_softmax', 'absolute'],
+                                    ['dot_product', 'context', 'biased_attention_map', 'scale_attention_map',
+                                     'absolute'],
+                                    ['biased_softmax', 'input_as_value', 'absolute'],
+                                    ['biased_attention_map', 'absolute']])
+@pytest.mark.parametrize("block_size", [3, 8])
+@pytest.mark.parametrize("masked_attention_dimensions", [[0], []])
+@pytest.mark.parametrize("mesh_shape,layout_rules", [([], []), ("b:2", "batch:b"), ("h:2", "heads:h")])
+def blockwise_attention_test(extras: typing.List[str], block_size: int,
+                             masked_attention_dimensions: typing.List[int], mesh_shape: typing.Union[list, str],
+                             layout_rules: typing.Union[list, str]):
+    BlockwiseAttention(extras, block_size, mesh_shape=mesh_shape, layout_rules=layout_rules,
+                       devices=["cpu:0"] * (2 if mesh_shape else 1), calculation_dtype="float32",
+                       storage_dtype="float32", slice_dtype="float32", features_per_head=8, heads=2,
+                       train_batch_size=2, sequence_length=16,
+                       masked_attention_dimensions=masked_attention_dimensions)()
+
+
+class AttentionMemory(OperationTest):
+    def __init__(self, **kwargs):
+        super(AttentionMemory, self).__init__(**kwargs)
+        self.peak_bytes = 0
+
+    def build(self, graph: mtf.Graph, mesh: mtf.Mesh, *args, **kwargs
+              ) -> typing.Tuple[typing.List[mtf.Tensor], typing.Any]:
+        params = self.args.params
+        params.mesh = mesh
+        params.graph = graph
+        inp = mtf.random_normal(mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims,
+                                dtype=params.variable_dtype.activation_dtype)
+        loss = mtf.reduce_sum(_body(params, inp))
+        grads = mtf.gradients([loss], [inp] + [var.outputs[0] for var in graph.trainable_variables])
+        return [mtf.reduce_sum(grad) for grad in grads], None
+
+    def run(self, sess: tf1.Session, outputs: typing.List[tf.Tensor], args: typing.Any) -> None:
+        metadata = tf1.RunMetadata()
+        sess.run(outputs, options=tf1.RunOptions(trace_level=tf1.RunOptions.FULL_TRACE), run_metadata=metadata)
+        # Replay every allocation and deallocation of the step to find the peak of memory in use at the same time
+        records = sorted((record.alloc_micros, record.alloc_bytes) for device in metadata.step_stats.dev_stats
+                         for node in device.node_stats for memory in node.memory
+                         for record in memory.allocation_records)
+        self.peak_bytes = max(np.cumsum([alloc_bytes for _, alloc_bytes in records]))
+
+
+@pytest.mark.parametrize("memory_reduction_strategy", ["none", "checkpoint", "revnet"])
+def blockwise_attention_memory_test(memory_reduction_strategy: str):
+    peak_bytes = {}
+    for sequence_length in (512, 2048):
+        for blockwise in ([], ['blockwise:128']):
+            layer = '-'.join(['attention', 'dot_product', 'context'] + blockwise)
+            test = AttentionMemory(calculation_dtype="float32", storage_dtype="float32", slice_dtype="float32",
+                                   features_per_head=16, heads=4, train_batch_size=1, sequence_length=sequence_length,
+                                   depth=1, memory_reduction_strategy=memory_reduction_strategy,
+                                   use_video=False, use_language=True, block_config=[{'layer': [layer]}])
+            test()
+            peak_bytes[sequence_length, bool(blockwise)] = test.peak_bytes
+
+    # Forward and backward pass: dense attention grows quadratically, blockwise attention linearly
+    assert peak_bytes[2048, False] > 8 * peak_bytes[512, False]
+    assert peak_bytes[2048, True] < 6 * peak_bytes[512, True]
+    assert peak_bytes[2048, True] < peak_bytes[2048, False] / 4
+
+
+@pytest.mark.parametrize("block_size", [16, 32])
+def blockwise_attention_flops_test(block_size: int):
+    with tf.Graph().as_default():
+        params = ModelParameter({'features_per_head': 16, 'heads': 4, 'train_batch_size': 1, 'sequence_length': 256,
+                                 'use_video': False, 'use_language': True})
+        params.mesh = mtf.Mesh(mtf.Graph(), "MESH")
+        args = BlockArgs(params, mtf.zeros(params.mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims),
+                         [''])
+        spatial.attention(args(['dot_product', 'context']))
+        dense = sum(operation_flops(op) for op in params.mesh.graph.operations
+                    if isinstance(op, mtf.EinsumOperation) and len(op.inputs) > 1
+                    and any('_sequence' in t.shape.dimension_names for t in op.inputs)
+                    and set(d for t in op.inputs for d in t.shape.dimension_names)
+                    - set(op.outputs[0].shape.dimension_names))
+        out = spatial.attention(args(['dot_product', 'context', f'blockwise:{block_size}']))
+        op, = [op for op in params.mesh.graph.operations if isinstance(op, spatial.BlockwiseSoftmax)]
+        mtf.gradients([mtf.reduce_sum(out)], [args.tensor])
+        backward, = [op for op in params.mesh.graph.operations if isinstance(op, spatial.BlockwiseSoftmaxBackward)]
+
+    # Tiles above the diagonal are skipped: (n + 1) / 2n of the tiles remain for n tiles per dimension
+    tiles = 256 // block_size
+    assert operation_flops(op) == pytest.approx(dense * (tiles + 1) / (2 * tiles))
+    assert operation_flops(backward) == pytest.approx(operation_flops(op) * 2.5)
+
+
+@pytest.mark.parametrize("memory_reduction_strategy", ["revnet", "checkpoint", "none"])
+@pytest.mark.parametrize("blockwise", [[], ['blockwise:5']])
+def attention_mask_cache_test(memory_reduction_strategy: str, blockwise: typing.List[str]):
+    ranges = []
+    for depth in (1, 3):
+        with tf.Graph().as_default():
+            layer = '-'.join(['attention', 'dot_product', 'context', 'biased_attention_map', 'absolute'] + blockwise)
+            params = ModelParameter({'depth': depth, 'features': 32, 'sequence_length': 16, 'train_batch_size': 2,
+                                     'memory_reduction_strategy': memory_reduction_strategy,
+                                     'use_video': False, 'use_language': True,
+                                     'block_config': [{'layer': ['norm-group-shift-scale', layer]}]})
+            params.mesh = mtf.Mesh(mtf.Graph(), "MESH")
+            src = mtf.zeros(params.mesh, [params.batch_dim, params.sequence_dim] + params.feature_dims)
+            out = scoped("body", _body, params, src)
+            mtf.gradients([mtf.reduce_sum(out)], [v.outputs[0] for v in params.mesh.graph.trainable_variables])
+            ranges.append(sum(isinstance(op, mtf.RangeOperation) for op in params.mesh.graph.operations))
+    assert ranges[0] == ranges[1]